@@ -0,0 +1,77 @@
+'''
+Measures chunk packing throughput against the number of worker processes.
+
+    python -m core.benchmarks.compaction [--chunks 32] [--chunk-size 100] [--example-kib 64] [--workers 1 2 4]
+
+Synthetic gzipped examples are written to a temporary directory. The old packing
+(sequential tar.gz, recompressing every example) is measured once as a baseline.
+Run from the ppz_server directory.
+'''
+import argparse
+import gzip
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+from core.chunks import pack_chunks, CHUNK_SUFFIX
+from core.shards import pack_shard, SHARD_SUFFIX
+
+
+def write_examples(directory, count, size):
+    # half random, half zeros: compresses about as well as real examples
+    for game_number in range(1, count + 1):
+        data = os.urandom(size // 2) + bytes(size - size // 2)
+        with gzip.open(os.path.join(directory, str(game_number) + '.gz'), 'wb') as f:
+            f.write(data)
+
+
+def pack_tar_gz(jobs):
+    for directory, first_game_number, game_numbers in jobs:
+        with tarfile.open(os.path.join(directory, str(first_game_number) + '.tar.gz'), 'w:gz') as tar:
+            for game_number in game_numbers:
+                tar.add(os.path.join(directory, str(game_number) + '.gz'), arcname=str(game_number) + '.gz')
+
+
+def measure(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=32)
+    parser.add_argument('--chunk-size', type=int, default=100)
+    parser.add_argument('--example-kib', type=int, default=64)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='compaction-benchmark-')
+    try:
+        write_examples(directory, args.chunks * args.chunk_size, args.example_kib * 1024)
+        jobs = [(directory, first_game_number, list(range(first_game_number, first_game_number + args.chunk_size)))
+                for first_game_number in range(1, args.chunks * args.chunk_size + 1, args.chunk_size)]
+
+        print(f'{args.chunks} chunks of {args.chunk_size} examples, {args.example_kib} KiB each, '
+              f'{os.cpu_count()} cores')
+        print(f'{"packing":>16} {"workers":>8} {"chunks/s":>10}')
+
+        elapsed = measure(lambda: pack_tar_gz(jobs))
+        print(f'{"tar.gz":>16} {1:>8} {args.chunks / elapsed:>10.1f}')
+
+        shard_jobs = [(directory, first_game_number, [(game_number, 1) for game_number in game_numbers],
+                       1, 10, 10, args.chunk_size) for directory, first_game_number, game_numbers in jobs]
+
+        for workers in args.workers:
+            elapsed = measure(lambda: pack_chunks(jobs, workers))
+            print(f'{CHUNK_SUFFIX:>16} {workers:>8} {args.chunks / elapsed:>10.1f}')
+            elapsed = measure(lambda: pack_chunks(shard_jobs, workers, pack_shard))
+            print(f'{SHARD_SUFFIX:>16} {workers:>8} {args.chunks / elapsed:>10.1f}')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
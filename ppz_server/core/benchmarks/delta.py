@@ -0,0 +1,48 @@
+'''
+Compares network delta reconstruction with the old per-byte generator.
+
+    python -m core.benchmarks.delta [--sizes 1 8 32] [--repeat 3]
+
+Sizes are in MiB of decompressed weights, run from the ppz_server directory.
+'''
+import argparse
+import io
+import os
+import time
+from core.delta import xor_stream
+
+
+def xor_generator(prev_data, delta_data):
+    return bytes(p ^ d for d, p in zip(delta_data, prev_data))
+
+
+def measure(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'{"MiB":>6} {"generator, s":>14} {"xor_stream, s":>14} {"speedup":>9}')
+    for size in args.sizes:
+        prev_data = os.urandom(size * 1024 * 1024)
+        delta_data = os.urandom(size * 1024 * 1024)
+
+        generator_time = measure(lambda: xor_generator(prev_data, delta_data), args.repeat)
+        stream_time = measure(lambda: xor_stream(io.BytesIO(prev_data), io.BytesIO(delta_data), io.BytesIO()),
+                              args.repeat)
+
+        print(f'{size:>6} {generator_time:>14.3f} {stream_time:>14.4f} {generator_time / stream_time:>8.0f}x')
+
+
+if __name__ == '__main__':
+    main()
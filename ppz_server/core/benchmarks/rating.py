@@ -0,0 +1,62 @@
+'''
+Measures core.rating.fit_ratings on synthetic training runs.
+
+    python -m core.benchmarks.rating [--networks 1000 10000 30000] [--extra 0.25] [--games 400]
+
+Every network plays the previous one, like candidates play the current best, and
+--extra adds that share of matches between networks up to 20 apart. Reports cold fits,
+warm starts after 1% new networks, and the error against the true ratings.
+Run from the ppz_server directory.
+'''
+import argparse
+import time
+import numpy as np
+from core.rating import fit_ratings
+
+
+def synthetic_run(rng, networks, extra, games):
+    truth = np.cumsum(rng.normal(10, 30, networks))
+    first = np.arange(1, networks)
+    second = first - 1
+
+    count = int(networks * extra)
+    extra_first = rng.integers(1, networks, count)
+    extra_second = np.maximum(extra_first - rng.integers(1, 21, count), 0)
+    first = np.concatenate([first, extra_first])
+    second = np.concatenate([second, extra_second])
+
+    expected = 1 / (1 + 10 ** ((truth[second] - truth[first]) / 400))
+    wins = rng.binomial(games, expected)
+    return truth, first, second, wins, np.zeros_like(wins), games - wins
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--networks', type=int, nargs='+', default=[1000, 10000, 30000])
+    parser.add_argument('--extra', type=float, default=0.25)
+    parser.add_argument('--games', type=int, default=400)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f'{"networks":>9} {"matches":>8} {"cold, s":>8} {"steps":>6} {"warm, s":>8} {"steps":>6} {"rmse":>7}')
+    for networks in args.networks:
+        truth, first, second, wins, draws, losses = synthetic_run(rng, networks, args.extra, args.games)
+
+        start = time.perf_counter()
+        ratings, _, cold_steps = fit_ratings(networks, first, second, wins, draws, losses, anchors={0: truth[0]})
+        cold_time = time.perf_counter() - start
+
+        initial = ratings.copy()
+        initial[-max(networks // 100, 1):] = np.nan
+        start = time.perf_counter()
+        ratings, _, warm_steps = fit_ratings(networks, first, second, wins, draws, losses, initial)
+        warm_time = time.perf_counter() - start
+
+        # ratings are relative, the error of the chain of matches grows along it
+        rmse = np.sqrt(np.mean((ratings - truth) ** 2))
+        print(f'{networks:>9} {len(first):>8} {cold_time:>8.2f} {cold_steps:>6} {warm_time:>8.2f} {warm_steps:>6} '
+              f'{rmse:>7.1f}')
+
+
+if __name__ == '__main__':
+    main()
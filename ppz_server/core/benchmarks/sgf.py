@@ -0,0 +1,108 @@
+'''
+Measures match SGF processing in games/s over a synthetic corpus.
+
+    python -m core.benchmarks.sgf [--matches 64] [--games 20] [--moves 300] [--workers 1 2 4]
+
+Compares the unisgf parse of every game (when unisgf is installed, it is not a server requirement:
+pip install git+https://github.com/pymole/unisgf@master) with the root property fast path,
+then collect_match on a process pool.
+Run from the ppz_server directory.
+'''
+import argparse
+import os
+import random
+import shutil
+import string
+import tempfile
+import time
+from core.pool import starmap
+from core.sgf import collect_match, game_result
+
+COORDINATES = string.ascii_letters
+
+
+def match_sgf(rng, moves):
+    result = rng.choice(['W+', 'B+']) + str(rng.randint(1, 30))
+    nodes = ''.join(f';{"BW"[i % 2]}[{rng.choice(COORDINATES)}{rng.choice(COORDINATES)}]' for i in range(moves))
+    return f'(;GM[40]FF[4]CA[UTF-8]SZ[39:32]PB[best]PW[candidate]RE[{result}]{nodes})'
+
+
+def write_corpus(directory, matches, games, moves):
+    rng = random.Random(0)
+    jobs = []
+    for match_id in range(matches):
+        match_directory = os.path.join(directory, 'games', str(match_id))
+        os.makedirs(match_directory)
+        match_games = []
+        for game_id in range(games):
+            path = os.path.join(match_directory, f'{game_id}.sgf')
+            with open(path, 'w') as f:
+                f.write(match_sgf(rng, moves))
+            match_games.append((path, game_id % 2 == 0))
+        jobs.append((os.path.join(directory, 'collections', f'{match_id}.sgf'), match_games))
+    return jobs
+
+
+def parse_unisgf(jobs):
+    from unisgf import Parser, Renderer, Collection
+    parser = Parser()
+    renderer = Renderer()
+    for collection_path, games in jobs:
+        full_collection = Collection()
+        for path, _ in games:
+            with open(path, 'r') as f:
+                collection = parser.parse_string(f.read())
+            str(collection[0].get_root()['RE'].values[0])
+            full_collection += collection
+        os.makedirs(os.path.dirname(collection_path), exist_ok=True)
+        renderer.render_file(collection_path, full_collection)
+
+
+def read_results(jobs):
+    for _, games in jobs:
+        for path, _ in games:
+            with open(path, 'r') as f:
+                game_result(f.read())
+
+
+def measure(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--matches', type=int, default=64)
+    parser.add_argument('--games', type=int, default=20)
+    parser.add_argument('--moves', type=int, default=300)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='sgf-benchmark-')
+    try:
+        jobs = write_corpus(directory, args.matches, args.games, args.moves)
+        total = args.matches * args.games
+
+        print(f'{args.matches} matches of {args.games} games, {args.moves} moves each, {os.cpu_count()} cores')
+        print(f'{"processing":>24} {"workers":>8} {"games/s":>10}')
+
+        try:
+            elapsed = measure(lambda: parse_unisgf(jobs))
+            print(f'{"unisgf parse and render":>24} {1:>8} {total / elapsed:>10.0f}')
+        except ImportError:
+            print(f'{"unisgf parse and render":>24} {"-":>8} {"not installed":>10}')
+
+        elapsed = measure(lambda: read_results(jobs))
+        print(f'{"game_result":>24} {1:>8} {total / elapsed:>10.0f}')
+
+        for workers in args.workers:
+            elapsed = measure(lambda: starmap(collect_match, jobs, workers))
+            print(f'{"collect_match":>24} {workers:>8} {total / elapsed:>10.0f}')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+import os
+import tarfile
+from .files import atomic_write
+from .pool import starmap
+
+CHUNK_SUFFIX = '.tar'
+# chunks from before examples were packed without compressing the tar again
+LEGACY_CHUNK_SUFFIX = '.tar.gz'
+
+
+def pack_chunk(directory, first_game_number, game_numbers):
+    '''
+    Packs <game_number>.gz examples of directory into <first_game_number>.tar.
+    Examples are gzipped already, so the tar itself is not compressed.
+    The chunk is written to a temporary file and renamed, readers never see a partial chunk.
+    :return: (chunk path, game numbers whose examples are missing)
+    '''
+    output_path = os.path.join(directory, str(first_game_number) + CHUNK_SUFFIX)
+    missing = []
+
+    with atomic_write(output_path) as f, tarfile.open(fileobj=f, mode='w') as tar:
+        for game_number in game_numbers:
+            name = str(game_number) + '.gz'
+            try:
+                tar.add(os.path.join(directory, name), arcname=name)
+            except FileNotFoundError:
+                missing.append(game_number)
+
+    return output_path, missing
+
+
+def pack_chunks(jobs, workers=None, pack=pack_chunk):
+    '''
+    Packs chunks on a process pool, one chunk per task.
+    :param jobs: list of argument tuples of pack.
+    :param pack: pack_chunk or core.shards.pack_shard.
+    :param workers: number of processes, all cores if None.
+    :return: pack results in the order of jobs.
+    '''
+    return starmap(pack, jobs, workers)
@@ -0,0 +1,136 @@
+import atexit
+import logging
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from .models import TrainingRun, Network
+
+logger = logging.getLogger(__name__)
+
+
+class GameCounters:
+    '''
+    Keeps TrainingRun.last_game and Network.games_played consistent under concurrent game uploads
+    without a write to a hot row per upload.
+
+    Game numbers are reserved from TrainingRun.last_game in blocks of
+    INGEST['game_number_block'] with a single UPDATE ... RETURNING, so concurrent
+    uploads never get the same number. Numbers of different processes interleave, and the
+    unused rest of a block becomes a gap when the process exits or the block is older than
+    INGEST['game_number_block_age'] seconds. Compaction treats missing numbers as gaps once
+    COMPACTION['lag'] later games exist, so the lag must exceed the block times the processes.
+
+    Network.games_played increments are summed per process and written at most every
+    INGEST['games_played_flush'] seconds and when the process exits. A killed process
+    loses the increments of its last interval.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # training run id -> (next free number, last reserved number, monotonic time of the reservation)
+        self._blocks = {}
+        self._games_played = Counter()
+        # database the summed counts belong to, test runs switch databases
+        self._database = None
+        self._flushed_at = time.monotonic()
+
+    def next_game_numbers(self, training_run_id, count=1):
+        '''
+        :return: list of count unused game numbers of the training run.
+        :raises TrainingRun.DoesNotExist: unknown training run.
+        '''
+        numbers = self._take(training_run_id, count)
+        if len(numbers) == count:
+            return numbers
+
+        # the round trip is made without the lock so other threads can keep taking numbers
+        size = max(settings.INGEST['game_number_block'], count - len(numbers))
+        last_number = self._reserve(training_run_id, size)
+        next_number = last_number - size + 1 + count - len(numbers)
+        numbers.extend(range(last_number - size + 1, next_number))
+
+        with self._lock:
+            # when another thread reserved a block meanwhile, the rest of the one not kept is a gap
+            current_next, current_last, _ = self._blocks.get(training_run_id, (1, 0, 0))
+            if current_next > current_last:
+                self._blocks[training_run_id] = (next_number, last_number, time.monotonic())
+
+        return numbers
+
+    def count_games(self, network_id, count=1):
+        '''
+        Adds count games to Network.games_played, written with the next flush.
+        '''
+        with self._lock:
+            if self._database != connection.settings_dict['NAME']:
+                self._games_played.clear()
+                self._database = connection.settings_dict['NAME']
+            self._games_played[network_id] += count
+            if time.monotonic() - self._flushed_at < settings.INGEST['games_played_flush']:
+                return
+
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            games_played, self._games_played = self._games_played, Counter()
+            self._flushed_at = time.monotonic()
+            if self._database != connection.settings_dict['NAME']:
+                return
+
+        try:
+            add_games_played(games_played)
+        except Exception:
+            # kept for the next flush
+            with self._lock:
+                self._games_played.update(games_played)
+            raise
+
+    def _take(self, training_run_id, count):
+        with self._lock:
+            next_number, last_number, reserved_at = self._blocks.get(training_run_id, (1, 0, 0))
+            if time.monotonic() - reserved_at > settings.INGEST['game_number_block_age']:
+                # compaction may already have passed the rest of an old block
+                next_number = last_number + 1
+            stop = min(last_number + 1, next_number + count)
+            self._blocks[training_run_id] = (stop, last_number, reserved_at)
+
+        return list(range(next_number, stop))
+
+    @staticmethod
+    def _reserve(training_run_id, size):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {TrainingRun._meta.db_table} SET last_game = last_game + %s WHERE id = %s RETURNING last_game',
+                [size, training_run_id]
+            )
+            row = cursor.fetchone()
+
+        if row is None:
+            raise TrainingRun.DoesNotExist(f'Training run {training_run_id} does not exist.')
+
+        return row[0]
+
+
+def add_games_played(games_played):
+    '''
+    Adds the counts of a network id -> games Counter to Network.games_played.
+    Rows are updated in id order, so writers in concurrent transactions can't deadlock.
+    '''
+    for network_id, count in sorted(games_played.items()):
+        if count:
+            Network.objects.filter(id=network_id).update(games_played=F('games_played') + count)
+
+
+def _flush_at_exit():
+    try:
+        game_counters.flush()
+    except Exception:
+        logger.exception('Lost games_played increments at exit')
+
+
+game_counters = GameCounters()
+atexit.register(_flush_at_exit)
@@ -0,0 +1,50 @@
+import hashlib
+import numpy as np
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class DeltaError(ValueError):
+    pass
+
+
+def xor_stream(first, second, output, chunk_size=CHUNK_SIZE):
+    '''
+    Writes first XOR second to output chunk by chunk, so memory stays bounded by chunk_size.
+    Used to rebuild a network from the previous one and a delta, and to build deltas.
+    :param first: binary file object with decompressed data.
+    :param second: binary file object of the same length.
+    :param output: binary file object.
+    :return: sha256 hex digest of the written data.
+    :raises DeltaError: inputs have different lengths.
+    '''
+    sha = hashlib.sha256()
+    first_buffer = np.empty(chunk_size, dtype=np.uint8)
+    second_buffer = np.empty(chunk_size, dtype=np.uint8)
+
+    while True:
+        first_size = _read_into(first, first_buffer)
+        second_size = _read_into(second, second_buffer)
+        if first_size != second_size:
+            raise DeltaError("Data lengths don't match.")
+
+        if first_size == 0:
+            return sha.hexdigest()
+
+        result = np.bitwise_xor(first_buffer[:first_size], second_buffer[:second_size],
+                                out=first_buffer[:first_size])
+        data = result.data
+        sha.update(data)
+        output.write(data)
+
+
+def _read_into(file, buffer):
+    # gzip and socket streams may return less than asked
+    view = memoryview(buffer)
+    size = 0
+    while size < len(view):
+        read = file.readinto(view[size:])
+        if not read:
+            break
+        size += read
+    return size
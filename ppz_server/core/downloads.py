@@ -0,0 +1,118 @@
+import os
+import re
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# downloads are content-addressed, their bytes never change
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def blob_response(request, data, etag, filename, content_type='application/gzip', immutable=True):
+    '''
+    Serves data with a strong ETag, answering If-None-Match with 304 and
+    a single byte Range with 206. Other range forms get the full body.
+    immutable is for URLs that name the content, such as download_network/<sha>.
+    '''
+    quoted_etag = f'"{etag}"'
+
+    if etag_matches(request.META.get('HTTP_IF_NONE_MATCH'), quoted_etag):
+        response = HttpResponseNotModified()
+        _set_cache_headers(response, quoted_etag, immutable)
+        return response
+
+    size = len(data)
+    byte_range = None
+    if request.META.get('HTTP_IF_RANGE', quoted_etag) == quoted_etag:
+        byte_range = _parse_range(request.META.get('HTTP_RANGE'), size)
+
+    if byte_range == 'unsatisfiable':
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+    elif byte_range is not None:
+        start, end = byte_range
+        response = HttpResponse(data[start:end + 1], status=206, content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    else:
+        response = HttpResponse(data, content_type=content_type)
+
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    _set_cache_headers(response, quoted_etag, immutable)
+    return response
+
+
+def sendfile_response(request, path, etag, filename, content_type='application/gzip', immutable=True):
+    '''
+    Lets the front proxy send the file from disk, configured by NETWORK_DOWNLOADS['sendfile']:
+    'x-accel-redirect' (nginx, the file must be under NETWORK_DOWNLOADS['accel_root'])
+    or 'x-sendfile' (apache, lighttpd). The proxy handles ranges and conditional requests itself.
+    '''
+    quoted_etag = f'"{etag}"'
+    if etag_matches(request.META.get('HTTP_IF_NONE_MATCH'), quoted_etag):
+        response = HttpResponseNotModified()
+        _set_cache_headers(response, quoted_etag, immutable)
+        return response
+
+    response = HttpResponse(content_type=content_type)
+    if settings.NETWORK_DOWNLOADS['sendfile'] == 'x-accel-redirect':
+        relative_path = os.path.relpath(path, settings.NETWORK_DOWNLOADS['accel_root'])
+        response['X-Accel-Redirect'] = settings.NETWORK_DOWNLOADS['accel_prefix'] + relative_path
+    else:
+        response['X-Sendfile'] = path
+
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    _set_cache_headers(response, quoted_etag, immutable)
+    return response
+
+
+def _set_cache_headers(response, quoted_etag, immutable):
+    response['ETag'] = quoted_etag
+    # the rest may be cached but has to be revalidated with the etag
+    response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL if immutable else 'no-cache'
+
+
+def etag_matches(header, quoted_etag):
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    # weak comparison is what If-None-Match asks for
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == quoted_etag:
+            return True
+    return False
+
+
+def _parse_range(header, size):
+    '''
+    :return: inclusive (start, end), 'unsatisfiable' or None for no usable range.
+    '''
+    if not header:
+        return None
+
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        return None
+
+    start, end = match.groups()
+    if not start and not end:
+        return None
+
+    if not start:
+        # suffix range, the last n bytes
+        length = int(end)
+        if length == 0:
+            return 'unsatisfiable'
+        return max(size - length, 0), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        return 'unsatisfiable'
+
+    return start, end
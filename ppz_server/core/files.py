@@ -0,0 +1,58 @@
+'''
+Writing files that readers never see half written.
+'''
+import os
+import tempfile
+import uuid
+from contextlib import contextmanager
+
+# temporary files are kept in this subdirectory of their destination, out of sight of jobs listing it
+TEMP_DIRECTORY = '.tmp'
+
+
+def temp_directory(directory):
+    '''
+    :return: path of the temporary file directory of directory, created if needed.
+        Renames from it to directory or its subdirectories stay on one file system.
+    '''
+    path = os.path.join(directory, TEMP_DIRECTORY)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+@contextmanager
+def atomic_write(path, mode='wb'):
+    '''
+    Opens a temporary file that replaces path when the block exits without an exception,
+    otherwise it is removed. Readers see either the old file or the complete new one.
+
+        with atomic_write(path) as f:
+            f.write(data)
+    '''
+    fd, temp_path = tempfile.mkstemp(dir=temp_directory(os.path.dirname(path)))
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(temp_path, path)
+    finally:
+        remove_quietly(temp_path)
+
+
+def link_replace(path, target_path):
+    '''
+    Hard links path to target_path, atomically replacing it, without copying the data.
+    Both have to be on one file system.
+    '''
+    temp_path = os.path.join(temp_directory(os.path.dirname(target_path)), uuid.uuid4().hex)
+    os.link(path, temp_path)
+    try:
+        os.replace(temp_path, target_path)
+    finally:
+        remove_quietly(temp_path)
+
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
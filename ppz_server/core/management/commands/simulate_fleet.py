@@ -0,0 +1,275 @@
+'''
+Load test of a running server with simulated self-play clients.
+
+    python manage.py simulate_fleet --url http://127.0.0.1:8000 --clients 64 --duration 60 \
+        --network-interval 30 --training-run-id 1 --json fleet.json
+
+Every client thread runs the protocol loop of a real client: next_game, download_network for
+networks it doesn't have yet, then upload_training_game or upload_match_game with a synthetic
+SGF and gzipped example. Another thread uploads a candidate network every --network-interval
+seconds. Only the server is exercised, the simulator doesn't touch the database.
+'''
+import gzip
+import json
+import os
+import random
+import string
+import threading
+import time
+import uuid
+from collections import defaultdict
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+from django.core.management.base import BaseCommand
+
+COORDINATES = string.ascii_letters
+PERCENTILES = (50, 90, 99)
+# seconds before a client asks again when the server has no work or fails
+RETRY_DELAY = 1.0
+
+
+class FleetStats:
+    '''
+    Latencies and errors per request kind, shared by the client threads.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+        self.games = defaultdict(int)
+
+    def record(self, kind, seconds, error=None):
+        with self._lock:
+            self.latencies[kind].append(seconds)
+            if error is not None:
+                self.errors[kind][error] += 1
+
+    def count_error(self, kind, error):
+        with self._lock:
+            self.errors[kind][error] += 1
+
+    def count_game(self, game_type):
+        with self._lock:
+            self.games[game_type] += 1
+
+    def report(self, elapsed):
+        requests = {}
+        for kind, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            errors = sum(self.errors[kind].values())
+            requests[kind] = {
+                'count': len(latencies),
+                'per_second': len(latencies) / elapsed,
+                'error_rate': errors / len(latencies),
+                'errors': dict(self.errors[kind]),
+                **{f'p{p}_ms': 1000 * latencies[min(len(latencies) - 1, len(latencies) * p // 100)]
+                   for p in PERCENTILES},
+                'max_ms': 1000 * latencies[-1],
+            }
+
+        return {
+            'elapsed_seconds': elapsed,
+            'games': dict(self.games),
+            'games_per_second': sum(self.games.values()) / elapsed,
+            'requests': requests,
+        }
+
+
+class FleetClient:
+    def __init__(self, url, stats, timeout):
+        self.url = url.rstrip('/')
+        self.stats = stats
+        self.timeout = timeout
+
+    def request(self, kind, path, fields=None, files=None, method='POST'):
+        '''
+        Sends form fields (multipart when there are files) and records the latency under kind.
+        :return: response body, None if the request failed.
+        '''
+        url = f'{self.url}/{path}'
+        data = None
+        headers = {}
+        if method == 'GET' and fields:
+            url += '?' + urlencode(fields)
+        elif files:
+            data, headers['Content-Type'] = multipart_body(fields or {}, files)
+        elif fields:
+            data = urlencode(fields).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        start = time.perf_counter()
+        error = None
+        body = None
+        try:
+            with urlopen(Request(url, data, headers, method=method), timeout=self.timeout) as response:
+                body = response.read()
+        except HTTPError as e:
+            error = str(e.code)
+        except (URLError, OSError) as e:
+            error = type(getattr(e, 'reason', e)).__name__
+
+        self.stats.record(kind, time.perf_counter() - start, error)
+        return body
+
+
+def multipart_body(fields, files):
+    '''
+    :param fields: dict name -> value.
+    :param files: dict name -> (file name, bytes).
+    :return: (body, content type)
+    '''
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (file_name, data) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{file_name}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def synthetic_sgf(rng, field_width, field_height, moves):
+    result = rng.choice(['W+', 'B+']) + str(rng.randint(1, 30))
+    nodes = ''.join(f';{"BW"[i % 2]}[{COORDINATES[rng.randrange(field_width)]}{COORDINATES[rng.randrange(field_height)]}]'
+                    for i in range(moves))
+    return f'(;GM[40]FF[4]CA[UTF-8]SZ[{field_width}:{field_height}]RE[{result}]{nodes})'.encode()
+
+
+def self_play(client, stats, username, stop, options, rng):
+    # networks are kept by clients, like the real client caches them on disk
+    networks = set()
+
+    def download(sha):
+        if sha and sha not in networks:
+            if client.request('download_network', f'download_network/{sha}', method='GET') is not None:
+                networks.add(sha)
+
+    while not stop.is_set():
+        body = client.request('next_game', 'next_game', {'username': username, 'password': username})
+        try:
+            game = json.loads(body) if body is not None else {}
+        except ValueError:
+            game = {}
+
+        if 'game_type' not in game:
+            if body is not None:
+                stats.count_error('next_game', game.get('error', 'no game'))
+            stop.wait(RETRY_DELAY)
+            continue
+
+        download(game.get('best_network_sha'))
+        if game['game_type'] == 'match':
+            download(game.get('candidate_sha'))
+
+        if options['game_seconds']:
+            stop.wait(rng.uniform(0.5, 1.5) * options['game_seconds'])
+            if stop.is_set():
+                return
+
+        sgf = synthetic_sgf(rng, game['field_width'], game['field_height'], options['moves'])
+        if game['game_type'] == 'match':
+            uploaded = client.request('upload_match_game', 'upload_match_game', {
+                'username': username,
+                'match_game_id': game['match_game_id'],
+                'result': rng.choice([1, -1, 0]),
+            }, {'match_game_sgf': ('game.sgf', sgf)})
+        else:
+            example = gzip.compress(os.urandom(options['example_kib'] * 1024), compresslevel=1)
+            uploaded = client.request('upload_training_game', 'upload_training_game', {
+                'username': username,
+                'training_run_id': game['training_run_id'],
+                'network_id': game['network_id'],
+            }, {'training_game_sgf': ('game.sgf', sgf), 'training_example': ('game.gz', example)})
+
+        if uploaded is not None:
+            stats.count_game(game['game_type'])
+        else:
+            stop.wait(RETRY_DELAY)
+
+
+def upload_networks(client, stop, options):
+    while not stop.wait(options['network_interval']):
+        # random weights, so every network has a new sha
+        network = gzip.compress(os.urandom(options['network_kib'] * 1024), compresslevel=1)
+        client.request('upload_network', 'upload_network', {
+            'training_run_id': options['training_run_id'],
+            'field_width': options['field_width'],
+            'field_height': options['field_height'],
+        }, {'network': ('network.gz', network)})
+
+
+class Command(BaseCommand):
+    help = 'Simulates concurrent self-play clients against a running server and reports latencies.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000')
+        parser.add_argument('--clients', type=int, default=16)
+        parser.add_argument('--duration', type=float, default=60, help='seconds to run')
+        parser.add_argument('--game-seconds', type=float, default=0,
+                            help='mean self-play time of a game, 0 for back to back uploads')
+        parser.add_argument('--moves', type=int, default=300, help='moves of a synthetic game')
+        parser.add_argument('--example-kib', type=int, default=64)
+        parser.add_argument('--network-interval', type=float, default=0,
+                            help='seconds between candidate network uploads, 0 for none')
+        parser.add_argument('--training-run-id', type=int, help='training run of uploaded networks')
+        parser.add_argument('--network-kib', type=int, default=1024)
+        parser.add_argument('--field-width', type=int, default=39)
+        parser.add_argument('--field-height', type=int, default=32)
+        parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for a response')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--json', help='also write the report to this file')
+
+    def handle(self, *args, **options):
+        if options['network_interval'] and options['training_run_id'] is None:
+            self.stderr.write('--network-interval needs --training-run-id.')
+            return
+
+        stats = FleetStats()
+        client = FleetClient(options['url'], stats, options['timeout'])
+        stop = threading.Event()
+        seed = options['seed'] if options['seed'] is not None else random.randrange(2 ** 32)
+        # a fresh set of users per run, so assignment to training runs starts over
+        prefix = f'fleet-{seed}'
+
+        threads = [
+            threading.Thread(target=self_play, args=(client, stats, f'{prefix}-{i}', stop, options,
+                                                     random.Random(seed + i)), daemon=True)
+            for i in range(options['clients'])
+        ]
+        if options['network_interval']:
+            threads.append(threading.Thread(target=upload_networks, args=(client, stop, options), daemon=True))
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            stop.wait(options['duration'])
+        except KeyboardInterrupt:
+            pass
+        stop.set()
+        for thread in threads:
+            thread.join(options['timeout'])
+
+        report = stats.report(time.perf_counter() - start)
+        report['clients'] = options['clients']
+        self.write_report(report)
+
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+    def write_report(self, report):
+        self.stdout.write(f"{report['clients']} clients, {report['elapsed_seconds']:.1f} s, "
+                          f"{report['games_per_second']:.1f} games/s {report['games']}")
+        self.stdout.write(f'{"request":>22} {"count":>8} {"per s":>8} {"errors":>8} '
+                          + ' '.join(f'{f"p{p} ms":>8}' for p in PERCENTILES) + f' {"max ms":>8}')
+        for kind, request in report['requests'].items():
+            self.stdout.write(f"{kind:>22} {request['count']:>8} {request['per_second']:>8.1f} "
+                              f"{request['error_rate']:>8.1%} "
+                              + ' '.join(f"{request[f'p{p}_ms']:>8.1f}" for p in PERCENTILES)
+                              + f" {request['max_ms']:>8.1f}")
+            for error, count in request['errors'].items():
+                self.stdout.write(f'{"":>22} {count:>8} x {error}')
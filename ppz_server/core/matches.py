@@ -0,0 +1,187 @@
+import math
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Min
+from django.utils import timezone
+from .models import TrainingRun, Match, MatchGame
+from .scheduler import scheduler
+from .signals import bulk_saved
+
+
+def lease_match_game(match_id, user):
+    '''
+    Hands out one of the games_to_finish games of a match. A new game is created
+    while the match has games left and fewer than MATCHES['games_to_finish'] games
+    are unfinished, then unfinished games with expired leases are handed out again.
+    :return: (MatchGame, None) or (None, datetime until which every game is leased).
+    '''
+    now = timezone.now()
+    lease_expires_at = now + timedelta(seconds=settings.MATCHES['lease_time'])
+
+    with transaction.atomic():
+        # the counter row stays locked until the game exists, so a slot can't get lost.
+        # sprt matches may stop after any result, games played past that point are wasted,
+        # so only a fixed match worth of games is played at once
+        created = Match.objects.filter(
+            id=match_id, done=False, games_created__lt=F('games_to_finish')
+        ).filter(
+            games_created__lt=F('candidate_wins') + F('best_wins') + F('draws') + settings.MATCHES['games_to_finish']
+        ).update(games_created=F('games_created') + 1)
+
+        if created:
+            match_game = MatchGame.objects.create(user=user, match_id=match_id,
+                                                  lease_expires_at=lease_expires_at)
+            match_game.candidate_turns_first = bool(match_game.id % 2)
+            match_game.save(update_fields=['candidate_turns_first'])
+            return match_game, None
+
+    with transaction.atomic():
+        match_game = MatchGame.objects.select_for_update(of=('self',), skip_locked=True).filter(
+            match_id=match_id, match__done=False, done=False, lease_expires_at__lt=now).order_by('lease_expires_at').first()
+
+        if match_game is not None:
+            match_game.user = user
+            match_game.lease_expires_at = lease_expires_at
+            match_game.save(update_fields=['user', 'lease_expires_at'])
+            return match_game, None
+
+    leased_until = MatchGame.objects.filter(match_id=match_id, done=False).aggregate(
+        leased_until=Min('lease_expires_at'))['leased_until']
+
+    # every game is done, only the finalisation is left
+    if leased_until is None:
+        leased_until = lease_expires_at
+
+    return None, leased_until
+
+
+# match game result -> Match counter
+MATCH_RESULT_FIELDS = {
+    1: 'candidate_wins',
+    -1: 'best_wins',
+    0: 'draws',
+}
+
+
+def record_match_game_result(match_game_id, match_id, result):
+    '''
+    Counts the result with database-side increments, so concurrent uploads don't lose results.
+    :return: False if the game or the whole match is already done.
+    '''
+    field = MATCH_RESULT_FIELDS[result]
+
+    with transaction.atomic():
+        if not MatchGame.objects.filter(id=match_game_id, done=False).update(result=result, done=True):
+            return False
+
+        if not Match.objects.filter(id=match_id, done=False).update(**{field: F(field) + 1}):
+            transaction.set_rollback(True)
+            return False
+
+    return True
+
+
+def match_sprt(parameters):
+    '''
+    :return: SPRT settings of a match, MATCHES['sprt'] overridden by parameters['sprt'],
+        or None if the match plays a fixed number of games.
+    '''
+    sprt = (parameters or {}).get('sprt')
+    if sprt is None:
+        return None
+    return {**settings.MATCHES['sprt'], **sprt}
+
+
+def match_games_to_finish(parameters):
+    sprt = match_sprt(parameters)
+    if sprt is None:
+        return settings.MATCHES['games_to_finish']
+    # sprt matches stop earlier unless the networks are too close to tell apart
+    return sprt['max_games']
+
+
+def sprt_llr(wins, draws, losses, elo0, elo1):
+    '''
+    Log likelihood ratio of H1: candidate is elo1 stronger against H0: it is elo0 stronger,
+    with the normal approximation of the score distribution used by generalized SPRT.
+    Half a win and half a loss are added, so first games can't make the variance zero.
+    '''
+    wins += 0.5
+    losses += 0.5
+    games = wins + draws + losses
+
+    score = (wins + draws / 2) / games
+    variance = (wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score ** 2) / games
+
+    score0 = 1 / (1 + 10 ** (-elo0 / 400))
+    score1 = 1 / (1 + 10 ** (-elo1 / 400))
+    return games * (score1 - score0) * (2 * score - score0 - score1) / (2 * variance)
+
+
+def sprt_decision(wins, draws, losses, sprt):
+    '''
+    :return: True when H1 is accepted, False when H0 is accepted, None to keep playing.
+    '''
+    llr = sprt_llr(wins, draws, losses, sprt['elo0'], sprt['elo1'])
+    if llr >= math.log((1 - sprt['beta']) / sprt['alpha']):
+        return True
+    if llr <= math.log(sprt['beta'] / (1 - sprt['alpha'])):
+        return False
+    return None
+
+
+def sprt_result(wins, draws, losses, games_to_finish, sprt):
+    '''
+    No hypothesis is accepted before sprt['min_games'] games, the normal approximation
+    is too rough for the first few. A match that runs out of games undecided fails:
+    the candidate replaces the best network only when the test shows it is stronger.
+    :return: passed flag of a finished sprt match, None to keep playing.
+    '''
+    games_count = wins + draws + losses
+    passed = sprt_decision(wins, draws, losses, sprt) if games_count >= sprt['min_games'] else None
+    if passed is None and games_count >= games_to_finish:
+        return False
+    return passed
+
+
+def finalise_match(match_id):
+    '''
+    Finishes the match when it has enough games, or with sprt in match parameters as soon as
+    the test accepts a hypothesis. Concurrent callers race on a conditional update,
+    so pass/fail is decided and the candidate promoted exactly once.
+    :return: passed flag if this call finished the match, None otherwise.
+    '''
+    match = Match.objects.filter(id=match_id).values(
+        'training_run_id', 'candidate_id', 'current_best_id', 'parameters',
+        'candidate_wins', 'best_wins', 'draws', 'games_to_finish').first()
+
+    games_count = match['candidate_wins'] + match['best_wins'] + match['draws']
+    sprt = match_sprt(match['parameters'])
+
+    if sprt is not None:
+        passed = sprt_result(match['candidate_wins'], match['draws'], match['best_wins'],
+                             match['games_to_finish'], sprt)
+        if passed is None:
+            return None
+    else:
+        if games_count < match['games_to_finish']:
+            return None
+
+        mu = (match['candidate_wins'] + match['draws'] / 2) / games_count
+        passed = mu >= settings.MATCHES['update_threshold']
+
+    if not Match.objects.filter(id=match_id, done=False).update(done=True, passed=passed):
+        return None
+
+    if passed:
+        # a match against an outdated best network must not roll the run back
+        TrainingRun.objects.filter(id=match['training_run_id'], best_network_id=match['current_best_id']).update(
+            best_network_id=match['candidate_id'])
+
+    # queryset updates don't send signals
+    scheduler.invalidate()
+    bulk_saved.send(sender=Match)
+    bulk_saved.send(sender=TrainingRun)
+
+    return passed
@@ -57,11 +57,13 @@ class User(AbstractBaseUser, PermissionsMixin):
 class Network(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
 
-    sha = models.CharField(max_length=64, null=True)
+    sha = models.CharField(max_length=64, null=True, db_index=True)
     network_number = models.IntegerField()
     training_run = models.ForeignKey('TrainingRun', related_name='networks', on_delete=models.SET_NULL, null=True)
 
     elo = models.FloatField(null=True)
+    # half width of the 95% confidence interval of elo
+    elo_error = models.FloatField(null=True)
 
     # cached because of expensive COUNT(*) call
     games_played = models.IntegerField(default=0)
@@ -71,6 +73,11 @@ class Network(models.Model):
     field_width = models.IntegerField()
     field_height = models.IntegerField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['training_run', 'network_number']),
+        ]
+
 
 class TrainingRun(models.Model):
     best_network = models.ForeignKey(Network, related_name='+', on_delete=models.SET_NULL, null=True, blank=True)
@@ -83,8 +90,12 @@ class TrainingRun(models.Model):
     match_parameters = JSONField(blank=True)
 
     active = models.BooleanField(default=False)
+    # relative share of self-play clients, e.g. target games per hour
+    weight = models.FloatField(default=1.0)
 
     last_game = models.IntegerField(default=0)
+    # games up to this number are packed into chunks of TRAINING_CHUNK_SIZE
+    compacted_game = models.IntegerField(default=0)
     last_network = models.IntegerField(default=0)
 
     def __str__(self):
@@ -101,6 +112,16 @@ class TrainingGame(models.Model):
 
     compacted = models.BooleanField(default=False)
 
+    # id of the ingest spool record, makes spool replays idempotent
+    ingest_id = models.UUIDField(null=True, unique=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['training_run', 'game_number']),
+            # rollup_games recounts the last minutes
+            models.Index(fields=['created_at']),
+        ]
+
 
 class Match(models.Model):
     training_run = models.ForeignKey(TrainingRun, related_name='matches', on_delete=models.SET_NULL, null=True)
@@ -109,7 +130,7 @@ class Match(models.Model):
     candidate = models.ForeignKey(Network, related_name='+', on_delete=models.SET_NULL, null=True)
     current_best = models.ForeignKey(Network, related_name='+', on_delete=models.SET_NULL, null=True)
 
-    # TODO зачем это поле?
+    # number of match games handed out, never exceeds games_to_finish
     games_created = models.IntegerField(default=0)
 
     candidate_wins = models.IntegerField(default=0)
@@ -119,9 +140,18 @@ class Match(models.Model):
     games_to_finish = models.IntegerField()
     done = models.BooleanField(default=False)
     passed = models.BooleanField(null=True)
+    # games of the match are counted in network elo
+    elo_processed = models.BooleanField(default=False)
 
     created_at = models.DateTimeField(default=timezone.now)
 
+    class Meta:
+        indexes = [
+            # only matches waiting for elo update are indexed
+            models.Index(fields=['id'], name='match_elo_pending_idx',
+                         condition=models.Q(done=True, elo_processed=False)),
+        ]
+
 
 class MatchGame(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
@@ -135,3 +165,27 @@ class MatchGame(models.Model):
     result = models.IntegerField(null=True)
     done = models.BooleanField(default=False)
 
+    # unfinished game goes to another user after this moment
+    lease_expires_at = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['match', 'done', 'lease_expires_at']),
+        ]
+
+
+class GameRollup(models.Model):
+    '''
+    Training games per run and minute, filled by core.scripts.rollup_games.
+    '''
+    training_run = models.ForeignKey(TrainingRun, related_name='+', on_delete=models.SET_NULL, null=True)
+    minute = models.DateTimeField()
+    games = models.IntegerField(default=0)
+    # highest TrainingGame.id counted here, the largest one is where the next rollup starts
+    last_game_id = models.IntegerField()
+
+    class Meta:
+        unique_together = [('training_run', 'minute')]
+        indexes = [
+            models.Index(fields=['last_game_id']),
+        ]
@@ -0,0 +1,219 @@
+import fcntl
+import gzip
+import io
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from .scheduler import scheduler
+from .delta import xor_stream, DeltaError
+from .files import atomic_write, remove_quietly, temp_directory
+
+COPY_CHUNK_SIZE = 1024 * 1024
+# empty file next to where the delta of two networks without one would be
+NO_DELTA_SUFFIX = '.nodelta'
+
+
+class NetworkCache:
+    '''
+    Network blobs keyed by Network.sha.
+
+    Decompressed weights and gzipped files live in an in-memory LRU bounded by
+    NETWORK_CACHE['memory_bytes']. Decompressed weights pushed out of memory spill
+    to NETWORK_CACHE['spill_path'], bounded by NETWORK_CACHE['disk_bytes'], so
+    the next miss costs a plain read instead of a gunzip. Best networks of active
+    training runs are never evicted, every client asks for them, but they count
+    towards the bound: a network that doesn't fit next to them is not kept in memory.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (sha, compressed) -> bytes
+        self._blobs = OrderedDict()
+        self._size = 0
+        # size of the spill directory when it was last listed plus what this process spilled since,
+        # other processes' spills are only seen by the next listing
+        self._spill_size = None
+
+    def get(self, sha):
+        '''
+        :return: decompressed network weights.
+        :raises FileNotFoundError: the network file is missing.
+        '''
+        data = self._get_memory((sha, False))
+        if data is not None:
+            return data
+
+        spill_path = self._spill_path(sha)
+        try:
+            with open(spill_path, 'rb') as f:
+                data = f.read()
+            # spill files are evicted by modification time
+            os.utime(spill_path)
+        except FileNotFoundError:
+            with gzip.open(self.path(sha), 'rb') as f:
+                data = f.read()
+
+        self._put_memory((sha, False), data)
+        return data
+
+    def get_compressed(self, sha):
+        '''
+        :return: gzipped network file.
+        :raises FileNotFoundError: the network file is missing.
+        '''
+        data = self._get_memory((sha, True))
+        if data is None:
+            with open(self.path(sha), 'rb') as f:
+                data = f.read()
+            self._put_memory((sha, True), data)
+        return data
+
+    def open(self, sha):
+        '''
+        :return: binary file object with decompressed network weights. Networks that aren't in memory
+            are read from their spill file, written first if needed, so memory use doesn't depend on
+            network size.
+        :raises FileNotFoundError: the network file is missing.
+        '''
+        data = self._get_memory((sha, False))
+        if data is not None:
+            return io.BytesIO(data)
+
+        spill_path = self._spill_path(sha)
+        if not os.path.exists(spill_path):
+            with gzip.open(self.path(sha), 'rb') as source:
+                self._spill(sha, source)
+
+        try:
+            f = open(spill_path, 'rb')
+        except FileNotFoundError:
+            # evicted by another process meanwhile
+            return gzip.open(self.path(sha), 'rb')
+
+        os.utime(spill_path)
+        return f
+
+    def delta_path(self, from_sha, to_sha):
+        '''
+        Builds the gzipped XOR delta between two networks once and keeps it in NETWORK_DELTAS_PATH.
+        A pair without a delta is remembered by a marker file, later requests don't load the networks.
+        :return: path of the delta or None if networks have different sizes.
+        :raises FileNotFoundError: one of the networks is missing.
+        '''
+        name = f'{from_sha}_{to_sha}'
+        path = os.path.join(settings.NETWORK_DELTAS_PATH, name + '.gz')
+        no_delta_path = os.path.join(settings.NETWORK_DELTAS_PATH, name + NO_DELTA_SUFFIX)
+        if os.path.exists(path):
+            return path
+        if os.path.exists(no_delta_path):
+            return None
+
+        # concurrent first requests of processes wait for one build instead of building it each
+        lock_path = os.path.join(temp_directory(settings.NETWORK_DELTAS_PATH), name + '.lock')
+        with open(lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(path):
+                return path
+            if os.path.exists(no_delta_path):
+                return None
+
+            try:
+                with self.open(from_sha) as first, self.open(to_sha) as second, \
+                        atomic_write(path) as f, gzip.open(f, 'wb') as output:
+                    xor_stream(first, second, output)
+            except DeltaError:
+                open(no_delta_path, 'wb').close()
+                return None
+            finally:
+                # waiters holding the old lock file find the delta once they get the lock
+                remove_quietly(lock_path)
+
+        return path
+
+    def path(self, sha):
+        '''
+        :return: path of the gzipped network in NETWORKS_PATH, fetched from cloud storage if needed.
+        '''
+        path = os.path.join(settings.NETWORKS_PATH, sha + '.gz')
+        if settings.CLOUD_STORAGE and not os.path.exists(path):
+            with atomic_write(path) as f:
+                settings.S3.download_fileobj(settings.S3_NETWORKS_BUCKET_NAME, sha + '.gz', f)
+        return path
+
+    def _get_memory(self, key):
+        with self._lock:
+            data = self._blobs.get(key)
+            if data is not None:
+                self._blobs.move_to_end(key)
+            return data
+
+    def _put_memory(self, key, data):
+        pinned = scheduler.best_network_shas()
+        memory_bytes = settings.NETWORK_CACHE['memory_bytes']
+
+        spilled = []
+        with self._lock:
+            if key in self._blobs:
+                return
+
+            pinned_size = sum(len(blob) for blob_key, blob in self._blobs.items() if blob_key[0] in pinned)
+            if pinned_size + len(data) <= memory_bytes:
+                self._blobs[key] = data
+                self._size += len(data)
+
+                for evicted_key in list(self._blobs):
+                    if self._size <= memory_bytes:
+                        break
+                    if evicted_key[0] in pinned or evicted_key == key:
+                        continue
+
+                    evicted = self._blobs.pop(evicted_key)
+                    self._size -= len(evicted)
+                    if not evicted_key[1]:
+                        spilled.append((evicted_key[0], evicted))
+            elif not key[1]:
+                spilled.append((key[0], data))
+
+        for sha, evicted in spilled:
+            self._spill(sha, io.BytesIO(evicted))
+
+    @staticmethod
+    def _spill_path(sha):
+        return os.path.join(settings.NETWORK_CACHE['spill_path'], sha)
+
+    def _spill(self, sha, source):
+        spill_path = self._spill_path(sha)
+        if os.path.exists(spill_path):
+            return
+
+        with atomic_write(spill_path) as f:
+            shutil.copyfileobj(source, f, COPY_CHUNK_SIZE)
+            size = f.tell()
+
+        with self._lock:
+            if self._spill_size is not None:
+                self._spill_size += size
+                if self._spill_size <= settings.NETWORK_CACHE['disk_bytes']:
+                    return
+
+        self._evict_spilled(keep=spill_path)
+
+    def _evict_spilled(self, keep):
+        # oldest first, the file just spilled is kept even if it alone is over the bound
+        files = [entry for entry in os.scandir(settings.NETWORK_CACHE['spill_path'])
+                 if entry.is_file() and entry.path != keep]
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        size = os.path.getsize(keep) + sum(entry.stat().st_size for entry in files)
+        for entry in files:
+            if size <= settings.NETWORK_CACHE['disk_bytes']:
+                break
+            size -= entry.stat().st_size
+            remove_quietly(entry.path)
+
+        with self._lock:
+            self._spill_size = size
+
+
+network_cache = NetworkCache()
@@ -0,0 +1,28 @@
+from billiard.pool import Pool
+
+
+def starmap(function, jobs, workers=None):
+    '''
+    Runs function(*job) for every job on a process pool, in the caller for a single job or worker.
+    function must be importable by name, it is pickled.
+    :param workers: number of processes, one if None. Pools are per process, inside Celery
+        workers keep it at the number of cores divided by the worker concurrency.
+    :return: results in the order of jobs.
+    '''
+    workers = workers or 1
+    if workers <= 1 or len(jobs) <= 1:
+        return [function(*job) for job in jobs]
+
+    return _pool(workers).starmap(function, jobs)
+
+
+def _pool(workers):
+    # pools live as long as the process, shutting one down takes about a second.
+    # billiard processes may start children inside daemonic Celery workers
+    pool = _pools.get(workers)
+    if pool is None:
+        pool = _pools[workers] = Pool(workers)
+    return pool
+
+
+_pools = {}
@@ -0,0 +1,241 @@
+'''
+Maximum likelihood ratings of networks over the whole match graph.
+
+Bradley-Terry model on the Elo scale: a network rated d higher scores 1 / (1 + 10 ** (-d / 400)).
+A draw counts as half a win for both sides. Like BayesElo, every pair that played gets
+PRIOR_DRAWS virtual draws, so a network that won all of its games still has a finite rating.
+
+The likelihood is maximised with Newton steps whose linear systems are solved by conjugate
+gradients preconditioned with a spanning tree of the match graph. Every operation works on
+arrays of matched pairs or walks the tree, so an iteration costs O(pairs) and no
+players x players matrix is ever built.
+'''
+import math
+import numpy as np
+
+ELO_SCALE = 400 / math.log(10)
+PRIOR_DRAWS = 2.0
+# two-sided 95% interval
+CONFIDENCE_Z = 1.96
+# largest Newton step in natural log units, about 350 Elo
+MAX_STEP = 2.0
+MIN_WEIGHT = 1e-12
+
+
+def fit_ratings(players, first, second, wins, draws, losses, initial=None, anchors=None,
+                prior_draws=PRIOR_DRAWS, tolerance=1e-3, max_iterations=50):
+    '''
+    :param players: number of players, pairs refer to them by index.
+    :param first: array of first player indices of the pairs, a pair may repeat.
+    :param second: array of second player indices.
+    :param wins: games won by the first player of each pair, draws and losses likewise.
+    :param initial: Elo ratings to start from, nan where unknown. Unknown players start
+        from a rated neighbour plus the rating difference their games with it suggest.
+    :param anchors: dict player index -> Elo rating fixed for its connected component. Other
+        components keep the rating of their lowest index player from initial, 0 if unknown.
+    :param tolerance: stop when no rating moves by more Elo in a step.
+    :return: (Elo ratings, half widths of 95% intervals, Newton iterations)
+    '''
+    first, second, wins, games = _merge_pairs(players, first, second, wins, draws, losses, prior_draws)
+    forest = _spanning_forest(players, first, second)
+
+    if initial is None:
+        initial = np.full(players, np.nan)
+    initial = np.asarray(initial, dtype=np.float64)
+
+    ratings = _initial_ratings(forest, first, wins, games, initial / ELO_SCALE)
+    # first player score counts for it and against the second player
+    actual = np.bincount(first, wins, players) - np.bincount(second, wins, players)
+
+    iterations = 0
+    for iterations in range(1, max_iterations + 1):
+        expected_score = _expected(ratings, first, second)
+        gradient = np.bincount(first, games * expected_score, players) \
+            - np.bincount(second, games * expected_score, players) - actual
+        weights = games * expected_score * (1 - expected_score)
+
+        step = _conjugate_gradient(forest, first, second, weights, -gradient, tolerance / ELO_SCALE)
+        # far from the optimum the quadratic model overshoots
+        np.clip(step, -MAX_STEP, MAX_STEP, out=step)
+        ratings += step
+        if np.abs(step).max(initial=0) * ELO_SCALE < tolerance:
+            break
+
+    expected_score = _expected(ratings, first, second)
+    weights = games * expected_score * (1 - expected_score)
+    information = np.bincount(first, weights, players) + np.bincount(second, weights, players)
+    # error against the networks it played, the path to the anchor is not counted
+    with np.errstate(divide='ignore'):
+        errors = CONFIDENCE_Z * ELO_SCALE / np.sqrt(information)
+
+    ratings *= ELO_SCALE
+    _anchor(ratings, forest, initial, anchors or {})
+    return ratings, errors, iterations
+
+
+class _Forest:
+    '''
+    Breadth-first spanning forest of the match graph. Trees start at the lowest index player
+    of each connected component, and the match graphs of training runs are trees
+    or close to them, so the forest solves Newton systems almost exactly.
+    '''
+
+    def __init__(self, players, order, parent, parent_pair, roots):
+        self.players = players
+        # players in breadth-first order, parents before children
+        self.order = order
+        self.parent = parent
+        self.parent_pair = parent_pair
+        # root player of every player
+        self.roots = roots
+
+
+def _merge_pairs(players, first, second, wins, draws, losses, prior_draws):
+    first = np.asarray(first, dtype=np.int64)
+    second = np.asarray(second, dtype=np.int64)
+    wins = np.asarray(wins, dtype=np.float64)
+    draws = np.asarray(draws, dtype=np.float64)
+    losses = np.asarray(losses, dtype=np.float64)
+
+    # (a, b) and (b, a) are the same pair with scores swapped
+    swap = first > second
+    low = np.where(swap, second, first)
+    high = np.where(swap, first, second)
+    low_wins = np.where(swap, losses, wins)
+    low_losses = np.where(swap, wins, losses)
+
+    keys, inverse = np.unique(low * players + high, return_inverse=True)
+    merged_wins = np.bincount(inverse, low_wins + draws / 2, len(keys)) + prior_draws / 2
+    merged_games = merged_wins + np.bincount(inverse, low_losses + draws / 2, len(keys)) + prior_draws / 2
+    return keys // players, keys % players, merged_wins, merged_games
+
+
+def _spanning_forest(players, first, second):
+    neighbours = [[] for _ in range(players)]
+    for pair, (a, b) in enumerate(zip(first.tolist(), second.tolist())):
+        neighbours[a].append((b, pair))
+        neighbours[b].append((a, pair))
+
+    parent = [-1] * players
+    parent_pair = [-1] * players
+    roots = [-1] * players
+    order = []
+    for root in range(players):
+        if roots[root] != -1:
+            continue
+
+        roots[root] = root
+        start = len(order)
+        order.append(root)
+        while start < len(order):
+            player = order[start]
+            start += 1
+            for neighbour, pair in neighbours[player]:
+                if roots[neighbour] == -1:
+                    roots[neighbour] = root
+                    parent[neighbour] = player
+                    parent_pair[neighbour] = pair
+                    order.append(neighbour)
+
+    return _Forest(players, order, parent, parent_pair, roots)
+
+
+def _expected(ratings, first, second):
+    return 1 / (1 + np.exp(ratings[second] - ratings[first]))
+
+
+def _laplacian_product(players, first, second, weights, vector):
+    difference = weights * (vector[first] - vector[second])
+    return np.bincount(first, difference, players) - np.bincount(second, difference, players)
+
+
+def _tree_solve(forest, tree_weights, rhs):
+    '''
+    Solves the laplacian system of the spanning forest: the weighted difference across a tree
+    edge equals the sum of rhs below it. Roots get 0.
+    '''
+    parent = forest.parent
+    sums = rhs.tolist()
+    for player in reversed(forest.order):
+        if parent[player] != -1:
+            sums[parent[player]] += sums[player]
+
+    x = [0.0] * forest.players
+    for player in forest.order:
+        if parent[player] != -1:
+            x[player] = x[parent[player]] + sums[player] / tree_weights[player]
+    return np.array(x)
+
+
+def _conjugate_gradient(forest, first, second, weights, rhs, tolerance):
+    '''
+    Solves L x = rhs for the weighted laplacian L of the match graph, preconditioned
+    by the laplacian of the spanning forest. L is singular along constant vectors of
+    connected components; rhs sums to zero over each component, so the solve is consistent.
+    '''
+    players = forest.players
+    # weights of tree edges by child player
+    pair_weights = np.maximum(weights, MIN_WEIGHT)
+    tree_weights = [pair_weights[pair] if pair != -1 else 1.0 for pair in forest.parent_pair]
+
+    x = np.zeros(players)
+    residual = rhs.copy()
+    preconditioned = _tree_solve(forest, tree_weights, residual)
+    direction = preconditioned.copy()
+    rho = residual @ preconditioned
+
+    for _ in range(max(players, 1)):
+        if rho <= 0:
+            break
+        product = _laplacian_product(players, first, second, weights, direction)
+        curvature = direction @ product
+        if curvature <= 0:
+            break
+
+        alpha = rho / curvature
+        x += alpha * direction
+        residual -= alpha * product
+
+        preconditioned = _tree_solve(forest, tree_weights, residual)
+        next_rho = residual @ preconditioned
+        if np.abs(alpha * direction).max(initial=0) < tolerance:
+            break
+        direction = preconditioned + next_rho / rho * direction
+        rho = next_rho
+
+    return x
+
+
+def _initial_ratings(forest, first, wins, games, initial):
+    ratings = initial.tolist()
+    log_odds = np.log(wins / (games - wins)).tolist()
+    first = first.tolist()
+
+    for player in forest.order:
+        if not math.isnan(ratings[player]):
+            continue
+
+        pair = forest.parent_pair[player]
+        if pair == -1 or math.isnan(ratings[forest.parent[player]]):
+            ratings[player] = 0.0
+            continue
+
+        # difference the games of the tree edge suggest
+        difference = log_odds[pair] if first[pair] == player else -log_odds[pair]
+        ratings[player] = ratings[forest.parent[player]] + difference
+
+    return np.array(ratings)
+
+
+def _anchor(ratings, forest, initial, anchors):
+    # ratings are only defined up to a shift per connected component
+    offsets = {}
+    for player, rating in anchors.items():
+        offsets.setdefault(forest.roots[player], rating - ratings[player])
+
+    for root in set(forest.roots):
+        if root not in offsets:
+            rating = initial[root] if not np.isnan(initial[root]) else 0.0
+            offsets[root] = rating - ratings[root]
+
+    ratings += np.array([offsets[root] for root in forest.roots])
@@ -0,0 +1,149 @@
+import gzip
+import os
+import random
+import struct
+from bisect import bisect_right
+from collections import OrderedDict
+from django.conf import settings
+from django.utils.module_loading import import_string
+from .models import TrainingRun, TrainingGame
+from .shards import Shard, shard_paths, SHARD_SUFFIX
+
+# sample_examples stream: a batch header with the number of positions, then every position length-prefixed
+BATCH_HEADER = struct.Struct('>I')
+POSITION_HEADER = struct.Struct('>I')
+
+
+def whole_example(data):
+    '''
+    Default SAMPLER['decoder']: the whole decompressed example of a game is one position.
+    '''
+    return [data]
+
+
+class ExampleReader:
+    '''
+    Reads decompressed examples of a training run from its shards, or from
+    <game_number>.gz files for games that are not compacted yet.
+    At most SAMPLER['open_shards'] shards are mapped at once.
+    '''
+
+    def __init__(self, training_run_id):
+        self.directory = os.path.join(settings.TRAINING_EXAMPLES_PATH, str(training_run_id))
+        self._shards = OrderedDict()
+        self._shard_paths = []
+        self._shard_starts = []
+        self.refresh()
+
+    def refresh(self):
+        # picks up shards compacted since the last call
+        self._shard_paths = shard_paths(self.directory)
+        self._shard_starts = [int(os.path.basename(path)[:-len(SHARD_SUFFIX)]) for path in self._shard_paths]
+
+    def read(self, game_number):
+        '''
+        :return: decompressed example or None if it is missing or corrupted.
+        '''
+        try:
+            position = bisect_right(self._shard_starts, game_number) - 1
+            if position >= 0:
+                shard = self._open(self._shard_paths[position])
+                if game_number in shard:
+                    return shard.read(game_number)
+
+            with gzip.open(os.path.join(self.directory, str(game_number) + '.gz'), 'rb') as f:
+                return f.read()
+        except (OSError, EOFError):
+            return None
+
+    def close(self):
+        for shard in self._shards.values():
+            shard.close()
+        self._shards.clear()
+
+    def _open(self, path):
+        shard = self._shards.get(path)
+        if shard is not None:
+            self._shards.move_to_end(path)
+            return shard
+
+        shard = self._shards[path] = Shard(path)
+        if len(self._shards) > settings.SAMPLER['open_shards']:
+            _, evicted = self._shards.popitem(last=False)
+            evicted.close()
+        return shard
+
+
+def window_games(training_run_id):
+    '''
+    :return: game numbers of the last training_parameters['window'] games of the training run.
+    :raises TrainingRun.DoesNotExist: unknown training run.
+    '''
+    last_game, training_parameters = TrainingRun.objects.filter(id=training_run_id).values_list(
+        'last_game', 'training_parameters').get()
+    window = (training_parameters or {}).get('window', settings.SAMPLER['window'])
+
+    return list(TrainingGame.objects.filter(
+        training_run_id=training_run_id, game_number__gt=last_game - window
+    ).values_list('game_number', flat=True))
+
+
+def sample_positions(training_run_id, shuffle_buffer=None, rng=None):
+    '''
+    Endless iterator of positions sampled from the window of the training run.
+
+    Every pass visits the games of the window in random order, so games are sampled
+    uniformly; positions of a game are spread out by a shuffle buffer. The window is
+    loaded once, games uploaded meanwhile are sampled by the next call. Memory is bounded
+    by the window, the buffer and the open shards. Stops if the window has no readable games.
+    '''
+    decoder = import_string(settings.SAMPLER['decoder'])
+    shuffle_buffer = shuffle_buffer or settings.SAMPLER['shuffle_buffer']
+    rng = rng or random.Random()
+    game_numbers = window_games(training_run_id)
+    reader = ExampleReader(training_run_id)
+    buffer = []
+
+    try:
+        while True:
+            rng.shuffle(game_numbers)
+            reader.refresh()
+
+            read_any = False
+            for game_number in game_numbers:
+                data = reader.read(game_number)
+                if data is None:
+                    continue
+                read_any = True
+
+                for position in decoder(data):
+                    if len(buffer) < shuffle_buffer:
+                        buffer.append(position)
+                        continue
+
+                    index = rng.randrange(shuffle_buffer)
+                    yield buffer[index]
+                    buffer[index] = position
+
+            if not read_any:
+                return
+    finally:
+        reader.close()
+
+
+def sample_batches(training_run_id, batch_size=None, shuffle_buffer=None, rng=None):
+    '''
+    Endless iterator of lists of batch_size positions, see sample_positions.
+    '''
+    batch_size = batch_size or settings.SAMPLER['batch_size']
+    batch = []
+    for position in sample_positions(training_run_id, shuffle_buffer, rng):
+        batch.append(position)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+
+def encode_batch(batch):
+    return BATCH_HEADER.pack(len(batch)) + b''.join(
+        POSITION_HEADER.pack(len(position)) + position for position in batch)
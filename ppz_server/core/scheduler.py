@@ -0,0 +1,107 @@
+import hashlib
+import math
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import TrainingRun, Match
+
+
+ScheduledRun = namedtuple('ScheduledRun', [
+    'id', 'weight', 'field_width', 'field_height', 'training_parameters',
+    'best_network_id', 'best_network_sha', 'matches'
+])
+
+ScheduledMatch = namedtuple('ScheduledMatch', [
+    'id', 'training_run_id', 'parameters', 'candidate_sha', 'current_best_sha'
+])
+
+
+class WorkScheduler:
+    '''
+    Keeps active training runs and their open matches in process memory, so
+    polling clients don't hit the database for work selection.
+
+    The snapshot is dropped on TrainingRun/Network/Match changes (see signals.py)
+    and reloaded at least every SCHEDULER['cache_ttl'] seconds, which covers
+    changes made by other processes.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._runs = None
+        self._expires_at = 0
+        # match id -> moment when the first lease of a fully leased match expires
+        self._leased_until = {}
+
+    def invalidate(self):
+        with self._lock:
+            self._runs = None
+
+    def training_runs(self):
+        runs = self._runs
+        if runs is not None and time.monotonic() < self._expires_at:
+            return runs
+
+        with self._lock:
+            if self._runs is None or time.monotonic() >= self._expires_at:
+                self._runs = self._load()
+                open_match_ids = {match.id for run in self._runs for match in run.matches}
+                self._leased_until = {match_id: leased_until for match_id, leased_until in
+                                      self._leased_until.items() if match_id in open_match_ids}
+                self._expires_at = time.monotonic() + settings.SCHEDULER['cache_ttl']
+            return self._runs
+
+    def choose_training_run(self, user_id):
+        '''
+        Weighted rendezvous hashing: every user sticks to one run while the set of
+        active runs is unchanged, and the share of users a run gets is proportional
+        to its weight.
+        :return: ScheduledRun or None if there is no active training run.
+        '''
+        best_run = None
+        best_score = None
+        for run in self.training_runs():
+            score = run.weight / -math.log(_uniform_hash(user_id, run.id))
+            if best_score is None or score > best_score:
+                best_run, best_score = run, score
+
+        return best_run
+
+    def open_matches(self, training_run):
+        '''
+        :return: matches of the run that may still have games to hand out.
+        '''
+        now = timezone.now()
+        return [match for match in training_run.matches if self._leased_until.get(match.id, now) <= now]
+
+    def mark_leased(self, match_id, leased_until):
+        self._leased_until[match_id] = leased_until
+
+    def best_network_shas(self):
+        return {run.best_network_sha for run in self.training_runs()}
+
+    @staticmethod
+    def _load():
+        runs = TrainingRun.objects.filter(active=True, best_network__isnull=False, weight__gt=0).values_list(
+            'id', 'weight', 'field_width', 'field_height', 'training_parameters',
+            'best_network_id', 'best_network__sha').order_by('id')
+
+        matches = {}
+        for match in Match.objects.filter(training_run__active=True, done=False).values_list(
+                'id', 'training_run_id', 'parameters', 'candidate__sha', 'current_best__sha').order_by('id'):
+            matches.setdefault(match[1], []).append(ScheduledMatch(*match))
+
+        return [ScheduledRun(*run, matches=matches.get(run[0], [])) for run in runs]
+
+
+def _uniform_hash(user_id, training_run_id):
+    digest = hashlib.blake2b(f'{user_id}:{training_run_id}'.encode(), digest_size=8).digest()
+    # map into the open interval (0, 1)
+    return (int.from_bytes(digest, 'big') + 1) / (2 ** 64 + 2)
+
+
+scheduler = WorkScheduler()
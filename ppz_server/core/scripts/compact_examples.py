@@ -1,48 +1,126 @@
-# TODO compact examples in tar.gz
 from django.conf import settings
 from django.db import transaction
-from core.models import TrainingGame
-import os
+from django.db.models import F
+from core.models import TrainingGame, TrainingRun
+from core.chunks import pack_chunks
+from core.shards import pack_shard
 from collections import defaultdict
-import tarfile
-from itertools import islice, chain
+from kombu.exceptions import OperationalError
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# chunks packed per round of compact_training_run for every worker process
+CHUNKS_PER_WORKER = 8
 
 
 def compact_examples():
-    training_games = TrainingGame.objects.filter(compacted=False).values_list(
-        'id', 'game_number', 'training_run_id').order_by('id').all()
-
-    # sort games by training runs
-    games_numbers = defaultdict(list)
-    games_ids = defaultdict(list)
-    for game_id, game_number, training_run_id in training_games:
-        games_numbers[training_run_id].append(game_number)
-        games_ids[training_run_id].append(game_id)
-
-    for training_run_id in list(games_ids.keys()):
-        ids = games_ids[training_run_id]
-        if len(ids) < settings.TRAINING_CHUNK_SIZE:
-            print(f"Not enough games at training run {training_run_id}")
-            games_ids.pop(training_run_id)
-            continue
-
-        # trim excess games
-        numbers = games_numbers[training_run_id]
-        stop = len(numbers)//settings.TRAINING_CHUNK_SIZE * settings.TRAINING_CHUNK_SIZE
-        games_ids[training_run_id] = ids[:stop]
-
-        # compact games in .tar.gz
-        training_run_path = os.path.join(settings.TRAINING_EXAMPLES_PATH, str(training_run_id))
-        for chunk_idx in range(0, len(numbers), settings.TRAINING_CHUNK_SIZE):
-            first_game_number = numbers[chunk_idx]
-            output_path = os.path.join(training_run_path, str(first_game_number) + '.tar.gz')
-            with tarfile.open(output_path, 'w:gz') as tar:
-                for game_number in islice(numbers, chunk_idx, chunk_idx + settings.TRAINING_CHUNK_SIZE, 1):
-                    game_path = os.path.join(training_run_path, str(game_number) + '.gz')
-                    tar.add(game_path)
-
-    #
-    # with transaction.atomic():
-    #     for id in chain.from_iterable(games_ids.values()):
-    #         TrainingGame.objects.filter(id=id).update(compacted=True)
+    '''
+    Safety net for chunks whose compaction was not enqueued or failed.
+    Only runs with a full chunk past their compaction cursor are touched.
+    '''
+    training_run_ids = TrainingRun.objects.filter(
+        last_game__gte=F('compacted_game') + settings.TRAINING_CHUNK_SIZE
+    ).values_list('id', flat=True)
+
+    for training_run_id in training_run_ids:
+        compact_training_run(training_run_id)
+
+
+def compact_training_run(training_run_id):
+    '''
+    Packs complete chunks after TrainingRun.compacted_game in order, up to COMPACTION['workers']
+    at once. Every chunk is packed once: the cursor moves with a conditional update,
+    so a worker that lost the race stops.
+    '''
+    chunk_size = settings.TRAINING_CHUNK_SIZE
+    workers = settings.COMPACTION['workers']
+    directory = os.path.join(settings.TRAINING_EXAMPLES_PATH, str(training_run_id))
+
+    while True:
+        compacted_game, last_game, field_width, field_height = TrainingRun.objects.filter(
+            id=training_run_id).values_list('compacted_game', 'last_game', 'field_width', 'field_height').get()
+
+        chunks = ready_chunks(training_run_id, compacted_game, last_game, workers * CHUNKS_PER_WORKER)
+        if not chunks:
+            return
+
+        if settings.COMPACTION['format'] == 'shard':
+            results = pack_chunks([
+                (directory, first_game_number, games, training_run_id, field_width, field_height, chunk_size,
+                 settings.COMPACTION['shard_compressed'])
+                for first_game_number, games in chunks
+            ], workers, pack_shard)
+        else:
+            results = pack_chunks([
+                (directory, first_game_number, [game_number for game_number, _ in games])
+                for first_game_number, games in chunks
+            ], workers)
+
+        for chunk_path, missing in results:
+            if missing:
+                logger.warning('%s is packed without missing examples %s', chunk_path, missing)
+
+        last_compacted = chunks[-1][0] + chunk_size - 1
+        moved = TrainingRun.objects.filter(id=training_run_id, compacted_game=compacted_game).update(
+            compacted_game=last_compacted)
+        if not moved:
+            return
+
+        TrainingGame.objects.filter(
+            training_run_id=training_run_id, game_number__range=(compacted_game + 1, last_compacted)
+        ).update(compacted=True)
+        logger.info('Games %s-%s of training run %s compacted', compacted_game + 1, last_compacted, training_run_id)
+
+
+def ready_chunks(training_run_id, compacted_game, last_game, max_chunks):
+    '''
+    :return: list of (first game number, [(game number, network id)]) of consecutive complete chunks
+        after compacted_game.
+    '''
+    chunk_size = settings.TRAINING_CHUNK_SIZE
+    stop = min(last_game, compacted_game + chunk_size * max_chunks)
+    stop -= (stop - compacted_game) % chunk_size
+    if stop <= compacted_game:
+        return []
+
+    games = TrainingGame.objects.filter(
+        training_run_id=training_run_id, game_number__range=(compacted_game + 1, stop)
+    ).order_by('game_number').values_list('game_number', 'network_id')
+
+    chunks = defaultdict(list)
+    for game_number, network_id in games:
+        chunks[compacted_game + (game_number - compacted_game - 1) // chunk_size * chunk_size + 1].append(
+            (game_number, network_id))
+
+    ready = []
+    for first_game_number in range(compacted_game + 1, stop, chunk_size):
+        chunk = chunks[first_game_number]
+        # reserved numbers may still be uploading, after the lag the missing ones are gaps
+        if len(chunk) < chunk_size and last_game < first_game_number + chunk_size - 1 + settings.COMPACTION['lag']:
+            logger.info('Chunk %s of training run %s is not complete yet', first_game_number, training_run_id)
+            break
+        ready.append((first_game_number, chunk))
+
+    return ready
+
+
+def enqueue_compaction(training_run_id, game_numbers):
+    '''
+    Called with new game numbers, enqueues compaction of the run once the transaction
+    commits when one of them closes a chunk. Uploads don't depend on the broker: when
+    it is down the chunk is left to the compact_examples safety net.
+    '''
+    if any(game_number % settings.TRAINING_CHUNK_SIZE == 0 for game_number in game_numbers):
+        transaction.on_commit(lambda: _send_compaction(training_run_id))
+
 
+def _send_compaction(training_run_id):
+    # core.tasks imports the scripts
+    from core.tasks import task_compact_training_run
+    try:
+        task_compact_training_run.apply_async((training_run_id,), countdown=settings.COMPACTION['delay'],
+                                              retry=False)
+    except OperationalError as e:
+        logger.warning('Compaction of training run %s not enqueued: %s', training_run_id, e)
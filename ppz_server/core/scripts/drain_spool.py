@@ -0,0 +1,145 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from core.models import TrainingGame, MatchGame, Match, Network
+from core.counters import game_counters, add_games_played
+from core.files import link_replace
+from core.matches import MATCH_RESULT_FIELDS, finalise_match
+from core.scripts.compact_examples import enqueue_compaction
+from core.spool import seal_stale_segments, sealed_segments, read_segment, remove_segment
+from collections import Counter, defaultdict
+from itertools import islice
+import fcntl
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def drain_spool():
+    '''
+    Commits uploads accepted into the ingest spool. A segment is deleted only after all
+    of its records are committed, so a crash replays it: training games already committed
+    are recognised by TrainingGame.ingest_id and match games by MatchGame.done.
+    '''
+    seal_stale_segments(settings.INGEST['spool_segment_age'] * 2)
+
+    for segment_path in sealed_segments():
+        try:
+            segment = open(segment_path, 'rb')
+        except FileNotFoundError:
+            continue
+
+        with segment:
+            # another drain is still busy with this segment
+            try:
+                fcntl.flock(segment, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+
+            if not os.path.exists(segment_path):
+                continue
+
+            records = read_segment(segment_path)
+            while True:
+                batch = list(islice(records, settings.INGEST['spool_batch']))
+                if not batch:
+                    break
+
+                commit_training_games([record for record in batch if record.kind == 'training_game'])
+                commit_match_games([record for record in batch if record.kind == 'match_game'])
+
+            remove_segment(segment_path)
+            logger.info('Drained spool segment %s', segment_path)
+
+
+def commit_training_games(records):
+    if not records:
+        return
+
+    committed = {ingest_id.hex for ingest_id in TrainingGame.objects.filter(
+        ingest_id__in=[record.id for record in records]).values_list('ingest_id', flat=True)}
+    records = [record for record in records if record.id not in committed]
+
+    # invalid ids were accepted without a db round trip, drop such records now
+    known_networks = set(Network.objects.filter(
+        id__in={record.fields['network_id'] for record in records}).values_list('id', 'training_run_id'))
+
+    runs_records = defaultdict(list)
+    for record in records:
+        if (record.fields['network_id'], record.fields['training_run_id']) in known_networks:
+            runs_records[record.fields['training_run_id']].append(record)
+        else:
+            logger.warning('Dropped spooled training game %s: unknown training run or network.', record.id)
+
+    training_games = []
+    runs_game_numbers = {}
+    for training_run_id, run_records in runs_records.items():
+        game_numbers = game_counters.next_game_numbers(training_run_id, len(run_records))
+        runs_game_numbers[training_run_id] = game_numbers
+
+        # files go first, a crash before the insert leaves only unreferenced files behind
+        for record, game_number in zip(run_records, game_numbers):
+            try:
+                link_replace(record.files['training_game_sgf'], os.path.join(
+                    settings.TRAINING_SGF_PATH, str(training_run_id), str(game_number) + '.sgf'))
+                link_replace(record.files['training_example'], os.path.join(
+                    settings.TRAINING_EXAMPLES_PATH, str(training_run_id), str(game_number) + '.gz'))
+            except FileNotFoundError:
+                logger.warning('Dropped spooled training game %s: its files are missing.', record.id)
+                continue
+
+            training_games.append(TrainingGame(
+                ingest_id=record.id, user_id=record.fields['user_id'], training_run_id=training_run_id,
+                network_id=record.fields['network_id'], game_number=game_number
+            ))
+
+    # a replay skips committed games by ingest_id, their counts must commit with them
+    with transaction.atomic():
+        TrainingGame.objects.bulk_create(training_games)
+
+        for training_run_id, game_numbers in runs_game_numbers.items():
+            enqueue_compaction(training_run_id, game_numbers)
+
+        add_games_played(Counter(game.network_id for game in training_games))
+
+
+def commit_match_games(records):
+    if not records:
+        return
+
+    with transaction.atomic():
+        match_games = MatchGame.objects.select_for_update(of=('self',)).select_related('match').filter(
+            id__in=[record.fields['match_game_id'] for record in records], match__isnull=False).in_bulk()
+        # games done by an earlier drain of a replayed segment too, it may have died before finalising
+        match_ids = {match_game.match_id for match_game in match_games.values() if not match_game.match.done}
+
+        updated = []
+        results = defaultdict(Counter)
+        for record in records:
+            # the same game may be spooled twice by clients whose leases expired
+            match_game = match_games.pop(record.fields['match_game_id'], None)
+            if match_game is None or match_game.done or match_game.match.done:
+                continue
+
+            match = match_game.match
+            try:
+                link_replace(record.files['match_game_sgf'], os.path.join(
+                    settings.MATCH_SGF_PATH, str(match.training_run_id), str(match.id), str(match_game.id) + '.sgf'))
+            except FileNotFoundError:
+                logger.warning('Dropped spooled match game %s: its sgf is missing.', record.id)
+                continue
+
+            match_game.result = record.fields['result']
+            match_game.done = True
+            updated.append(match_game)
+            results[match.id][MATCH_RESULT_FIELDS[match_game.result]] += 1
+
+        MatchGame.objects.bulk_update(updated, ['result', 'done'])
+
+        for match_id, counts in results.items():
+            Match.objects.filter(id=match_id, done=False).update(
+                **{field: F(field) + count for field, count in counts.items()})
+
+    for match_id in match_ids:
+        finalise_match(match_id)
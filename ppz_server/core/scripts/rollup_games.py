@@ -0,0 +1,88 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Max
+from django.db.models.functions import TruncMinute
+from django.utils import timezone
+from core.models import GameRollup, TrainingGame
+from core.signals import bulk_saved
+
+# pg_try_advisory_xact_lock key, one rollup at a time
+ROLLUP_LOCK = 0x70707a01
+
+
+def rollup_games():
+    '''
+    Counts training games inserted since the last run into GameRollup. Games younger than
+    GAME_ROLLUPS['lag'] seconds wait for the next run. Uploads that got their id earlier
+    but committed after the run passed it are counted by recounting the last
+    GAME_ROLLUPS['recount_minutes'] minutes.
+    '''
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_xact_lock(%s)', [ROLLUP_LOCK])
+            if not cursor.fetchone()[0]:
+                return
+
+        last_id = GameRollup.objects.aggregate(last_id=Max('last_game_id'))['last_id'] or 0
+        settled_id = TrainingGame.objects.filter(
+            id__gt=last_id, created_at__lt=timezone.now() - timedelta(seconds=settings.GAME_ROLLUPS['lag'])
+        ).aggregate(settled_id=Max('id'))['settled_id']
+
+        while settled_id is not None and last_id < settled_id:
+            # ids may have gaps, take the id that ends a full batch
+            stop = TrainingGame.objects.filter(id__gt=last_id, id__lte=settled_id).order_by('id').values_list(
+                'id', flat=True)[settings.GAME_ROLLUPS['batch'] - 1:settings.GAME_ROLLUPS['batch']].first()
+            stop = stop or settled_id
+
+            rows = TrainingGame.objects.filter(id__gt=last_id, id__lte=stop).annotate(
+                minute=TruncMinute('created_at')).values('training_run_id', 'minute').annotate(
+                games=Count('id'), last_game_id=Max('id')).order_by()
+
+            add_rollups(rows)
+            last_id = stop
+            bulk_saved.send(sender=GameRollup)
+
+        if recount_rollups(last_id):
+            bulk_saved.send(sender=GameRollup)
+
+        GameRollup.objects.filter(
+            minute__lt=timezone.now() - timedelta(days=settings.GAME_ROLLUPS['retention_days'])
+        ).exclude(last_game_id=last_id).delete()
+
+
+def recount_rollups(last_id):
+    '''
+    Sets the games of the last GAME_ROLLUPS['recount_minutes'] minutes to the count of games up
+    to last_id. Counts are replaced, not added, so a recount is idempotent, and games after
+    last_id are left to the next run.
+    :return: True if a rollup changed.
+    '''
+    since = timezone.now().replace(second=0, microsecond=0) - timedelta(
+        minutes=settings.GAME_ROLLUPS['recount_minutes'])
+    rows = TrainingGame.objects.filter(created_at__gte=since, id__lte=last_id).annotate(
+        minute=TruncMinute('created_at')).values('training_run_id', 'minute').annotate(
+        games=Count('id'), last_game_id=Max('id')).order_by()
+
+    rolled_up = {
+        (rollup['training_run_id'], rollup['minute']): rollup['games']
+        for rollup in GameRollup.objects.filter(minute__gte=since).values('training_run_id', 'minute', 'games')
+    }
+    changed = [row for row in rows if rolled_up.get((row['training_run_id'], row['minute'])) != row['games']]
+    add_rollups(changed, replace=True)
+    return bool(changed)
+
+
+def add_rollups(rows, replace=False):
+    '''
+    Upserts rollup rows, adding their games to existing rows or replacing them.
+    '''
+    table = GameRollup._meta.db_table
+    games = 'EXCLUDED.games' if replace else f'{table}.games + EXCLUDED.games'
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'INSERT INTO {table} (training_run_id, minute, games, last_game_id) VALUES (%s, %s, %s, %s) '
+            f'ON CONFLICT (training_run_id, minute) DO UPDATE SET games = {games}, '
+            f'last_game_id = GREATEST({table}.last_game_id, EXCLUDED.last_game_id)',
+            [(row['training_run_id'], row['minute'], row['games'], row['last_game_id']) for row in rows]
+        )
@@ -2,6 +2,7 @@ import subprocess
 from django.conf import settings
 from django.db.models import F
 from core.models import Network
+from core.network_cache import network_cache
 import os
 import json
 
@@ -28,7 +29,9 @@ def run_training():
         config = json.load(f)
 
     config["input_path"] = os.path.join(settings.TRAINING_EXAMPLES_PATH, str(training_run_id))
-    config["model_input"] = os.path.join(settings.NETWORKS_PATH, best_sha+'.gz')
+    # shards are read with core.shards.iter_examples
+    config["input_format"] = settings.COMPACTION['format']
+    config["model_input"] = network_cache.path(best_sha)
     config["upload"]["params"] = {
         "blocks": blocks,
         "filters": filters,
@@ -1,118 +1,132 @@
 from core.models import Match, MatchGame, Network
 from django.conf import settings
 from django.db import transaction
+from django.db.models import Q
+import logging
+import math
 import os
-from unisgf import Collection, Parser, Renderer
+from collections import Counter, defaultdict
+from core.pool import starmap
+from core.rating import fit_ratings
+from core.sgf import collect_match
+from core.signals import bulk_saved
 
+logger = logging.getLogger(__name__)
 
-# TODO https://docs.djangoproject.com/en/3.0/topics/db/optimization/
-
-def compute_elo(first_rating, second_rating, first_actual_score):
-    # compute elo
-    E = lambda ra, rb: 1 / (1 + 10 ** ((ra - rb) / 400))
-    D = lambda s, e: 20 * (s - e)
-
-    second_actual_score = 1 - first_actual_score
-
-    expected_result = E(first_rating, second_rating)
-    first_diff = D(first_actual_score, expected_result)
-    second_diff = D(second_actual_score, expected_result)
-
-    return first_diff, second_diff
+# ratings that moved less are not written back
+ELO_WRITE_THRESHOLD = 0.01
 
 
 def update_elo():
     '''
-    Reconstructs SGF files and computes elo.
+    Renders collection SGFs of matches finished since the last run and refits ratings of
+    their training runs over recent matches (core.rating, fit_training_run), starting
+    from the current ratings. Processed matches are marked with Match.elo_processed
+    in the transaction that writes ratings.
     :return:
     '''
-    parser = Parser()
-    renderer = Renderer()
     # get only matches that have all games done
-    # TODO add field that tracks computed matches to prevent additional db queries
-    matches = Match.objects.filter(done=True).order_by('id').values(
-        'id', 'candidate_id', 'current_best_id', 'training_run_id').all()
+    matches = list(Match.objects.filter(done=True, elo_processed=False).order_by('id').values(
+        'id', 'training_run_id', 'candidate_wins', 'best_wins', 'draws'))
 
-    networks = Network.objects.filter(
-        training_run_id__in=[match['training_run_id'] for match in matches]).values_list('id', 'elo').all()
+    if not matches:
+        return
 
-    networks_elo = {network_id: network_elo for network_id, network_elo in networks}
-    update_networks = set()
+    render_collections(matches)
 
+    first_match_ids = {}
     for match in matches:
-        filename = os.path.join(str(match['training_run_id']), str(match['id']) + '.sgf')
-        filepath = os.path.join(settings.MATCH_COLLECTION_SGF_PATH, filename)
-
-        if os.path.exists(filepath):
-            continue
-
-        # construct collection of multiple games
-        full_collection = Collection()
-
-        candidate_id = match['candidate_id']
-        current_best_id = match['current_best_id']
-
-        initial_current_best_elo = networks_elo[current_best_id]
-
-        # it was first match of candidate network. Assign its elo to best elo.
-        if networks_elo[candidate_id] is None:
-            networks_elo[candidate_id] = networks_elo[current_best_id]
+        if match['training_run_id']:
+            first_match_ids.setdefault(match['training_run_id'], match['id'])
 
-        match_games = MatchGame.objects.filter(match_id=match['id'], done=True).values_list(
-            'id', 'candidate_turns_first').all()
+    networks = []
+    for training_run_id, first_match_id in sorted(first_match_ids.items()):
+        networks.extend(fit_training_run(training_run_id, first_match_id))
 
-        # each match game changes elo
-        for match_game_id, candidate_turns_first in match_games:
-            sgf_path = os.path.join(settings.MATCH_SGF_PATH, str(match['training_run_id']),
-                                    str(match['id']), str(match_game_id) + '.sgf')
-            with open(sgf_path, 'r') as f:
-                match_sgf = f.read()
-
-            try:
-                collection = parser.parse_string(match_sgf)
-            except SyntaxError:
-                continue
-
-            game_tree = collection[0]
-            root = game_tree.get_root()
-
-            # extract result of the game
-            result = str(root['RE'].values[0])
-            if result[0] == 'B':
-                candidate_score = 0
-            elif result[0] == 'W':
-                candidate_score = 1
-            else:
-                candidate_score = 0.5
-
-            if candidate_turns_first:
-                candidate_score = 1 - candidate_score
+    with transaction.atomic():
+        Network.objects.bulk_update(networks, ['elo', 'elo_error'], batch_size=1000)
+        Match.objects.filter(id__in=[match['id'] for match in matches]).update(elo_processed=True)
+    bulk_saved.send(sender=Network)
+    logger.info('Ratings of %s networks updated from %s matches', len(networks), len(matches))
 
-            # compute elo differences
-            candidate_diff, current_best_diff = compute_elo(networks_elo[candidate_id], networks_elo[current_best_id],
-                                                            candidate_score)
 
-            print(f'{result} {candidate_score}, {candidate_diff}, {current_best_diff}')
+def render_collections(matches):
+    matches_games = defaultdict(list)
+    for match_id, match_game_id, candidate_turns_first in MatchGame.objects.filter(
+            match_id__in=[match['id'] for match in matches], done=True
+    ).order_by('id').values_list('match_id', 'id', 'candidate_turns_first'):
+        matches_games[match_id].append((match_game_id, candidate_turns_first))
 
-            # update only candidate elo
-            update_networks.add(candidate_id)
-            # change best network rating only to save elo formula balance and then
-            # restore after match calculated
-            networks_elo[current_best_id] += current_best_diff
-            networks_elo[candidate_id] += candidate_diff
+    jobs = []
+    for match in matches:
+        collection_path = os.path.join(settings.MATCH_COLLECTION_SGF_PATH, str(match['training_run_id']),
+                                       str(match['id']) + '.sgf')
+        games = [(os.path.join(settings.MATCH_SGF_PATH, str(match['training_run_id']), str(match['id']),
+                               str(match_game_id) + '.sgf'), candidate_turns_first)
+                 for match_game_id, candidate_turns_first in matches_games[match['id']]]
+        jobs.append((collection_path, games))
 
-            # TODO make some game tree checks; date, players and source link inserts
-            full_collection += collection
+    # reading and rendering sgf is the slow part
+    matches_scores = starmap(collect_match, jobs, settings.MATCHES['collection_workers'])
 
-        # restore rating of the current best network
-        networks_elo[current_best_id] = initial_current_best_elo
+    # ratings use results reported with the games, sgf results only cross-check them
+    for match, scores in zip(matches, matches_scores):
+        counts = Counter(score for _, score in scores)
+        if (counts[1], counts[0], counts[0.5]) != (match['candidate_wins'], match['best_wins'], match['draws']):
+            logger.warning('Match %s: sgf results %s/%s/%s differ from reported %s/%s/%s', match['id'],
+                           counts[1], counts[0], counts[0.5], match['candidate_wins'], match['best_wins'], match['draws'])
 
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        renderer.render_file(filepath, full_collection)
 
-    # update when all ratings recalculated
-    with transaction.atomic():
-        for network_id in update_networks:
-            elo = networks_elo[network_id]
-            print(network_id, elo)
-            Network.objects.filter(id=network_id).update(elo=elo)
+def fit_training_run(training_run_id, first_match_id):
+    '''
+    Refits ratings over done matches of the training run from first_match_id on and
+    MATCHES['elo_history'] done matches before it, so a run costs the same however long
+    the match history is. The oldest network of the window keeps its rating and the others
+    are placed relative to it; networks that also played older matches keep their ratings,
+    only part of their games is in the fit.
+    :return: networks of the training run whose elo or elo_error changed, with new values set.
+    '''
+    fields = ('id', 'candidate_id', 'current_best_id', 'candidate_wins', 'draws', 'best_wins')
+    done_matches = Match.objects.filter(training_run_id=training_run_id, done=True,
+                                        candidate__isnull=False, current_best__isnull=False)
+    history = settings.MATCHES['elo_history']
+    window = done_matches
+    if history is not None:
+        earlier = done_matches.filter(id__lt=first_match_id).order_by('-id').values('id')[:history]
+        window = window.filter(Q(id__gte=first_match_id) | Q(id__in=earlier))
+    rows = list(window.values_list(*fields))
+
+    if not rows:
+        return []
+
+    match_ids, *pairs = zip(*rows)
+    network_ids = sorted(set(pairs[0]) | set(pairs[1]))
+    partial = set()
+    if history is not None:
+        for ids in done_matches.filter(id__lt=min(match_ids)).filter(
+                Q(candidate_id__in=network_ids) | Q(current_best_id__in=network_ids)
+        ).values_list('candidate_id', 'current_best_id'):
+            partial.update(ids)
+
+    indices = {network_id: index for index, network_id in enumerate(network_ids)}
+    current = {network_id: (elo, elo_error) for network_id, elo, elo_error in Network.objects.filter(
+        id__in=network_ids).values_list('id', 'elo', 'elo_error')}
+
+    initial = [math.nan if current[network_id][0] is None else current[network_id][0] for network_id in network_ids]
+    candidates, bests, wins, draws, losses = pairs
+    ratings, errors, iterations = fit_ratings(
+        len(network_ids), [indices[network_id] for network_id in candidates],
+        [indices[network_id] for network_id in bests], wins, draws, losses, initial
+    )
+    logger.info('Training run %s: %s networks rated over %s matches in %s iterations',
+                training_run_id, len(network_ids), len(match_ids), iterations)
+
+    networks = []
+    for network_id, elo, elo_error in zip(network_ids, ratings.tolist(), errors.tolist()):
+        if network_id in partial:
+            continue
+        old_elo, old_elo_error = current[network_id]
+        if old_elo is None or abs(old_elo - elo) > ELO_WRITE_THRESHOLD or old_elo_error is None \
+                or abs(old_elo_error - elo_error) > ELO_WRITE_THRESHOLD:
+            networks.append(Network(id=network_id, elo=elo, elo_error=elo_error))
+    return networks
@@ -1,11 +1,16 @@
 # cloud upload
 from django.conf import settings
+from core.chunks import CHUNK_SUFFIX, LEGACY_CHUNK_SUFFIX
 import glob
 import os
 
 
 def upload_examples():
-    chunks = glob.glob(os.path.join(settings.TRAINING_EXAMPLES_PATH, '*', '*.tar.gz'), recursive=True)
+    # shards are read in place by the sampler, only tar chunks leave the server
+    chunks = [
+        chunk_path for suffix in (CHUNK_SUFFIX, LEGACY_CHUNK_SUFFIX)
+        for chunk_path in glob.glob(os.path.join(settings.TRAINING_EXAMPLES_PATH, '*', '*' + suffix), recursive=True)
+    ]
     for chunk_path in chunks:
         key = os.path.relpath(chunk_path, settings.TRAINING_EXAMPLES_PATH)
         print(key)
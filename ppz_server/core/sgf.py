@@ -0,0 +1,86 @@
+'''
+Fast paths for match SGFs: root properties are read without building the game tree,
+and collections are rendered by joining game trees, which is what an SGF collection is.
+'''
+import re
+from .files import atomic_write
+
+NODE_START_RE = re.compile(r'\s*\(\s*;')
+PROPERTY_RE = re.compile(r'\s*([A-Za-z]+)((?:\s*\[(?:\\.|[^\\\]])*\])+)', re.DOTALL)
+VALUE_RE = re.compile(r'\[((?:\\.|[^\\\]])*)\]', re.DOTALL)
+ESCAPE_RE = re.compile(r'\\(.)', re.DOTALL)
+
+
+def root_properties(text):
+    '''
+    :return: dict property name -> list of values of the root node of the first game tree.
+    :raises SyntaxError: text doesn't start with a game tree.
+    '''
+    match = NODE_START_RE.match(text)
+    if match is None:
+        raise SyntaxError('SGF must start with a game tree.')
+
+    properties = {}
+    position = match.end()
+    while True:
+        match = PROPERTY_RE.match(text, position)
+        if match is None:
+            return properties
+
+        name, values = match.groups()
+        properties[name] = [ESCAPE_RE.sub(r'\1', value) for value in VALUE_RE.findall(values)]
+        position = match.end()
+
+
+def game_result(text):
+    '''
+    :return: RE value of the game or None if the game has no result or is not an SGF.
+    '''
+    try:
+        values = root_properties(text).get('RE')
+    except SyntaxError:
+        return None
+    return values[0] if values else None
+
+
+def candidate_score(result, candidate_turns_first):
+    # white wins are candidate wins when the current best turns first
+    if result[0] == 'B':
+        score = 0
+    elif result[0] == 'W':
+        score = 1
+    else:
+        score = 0.5
+
+    if candidate_turns_first:
+        score = 1 - score
+    return score
+
+
+def collect_match(collection_path, games):
+    '''
+    Reads results of match games and renders the games with a result into one collection file.
+    Runs on a process pool, see update_elo.
+    :param games: list of (sgf path, candidate_turns_first) in game order.
+    :return: list of (result, candidate score) of games with a result.
+    '''
+    scores = []
+    game_trees = []
+    for sgf_path, candidate_turns_first in games:
+        try:
+            with open(sgf_path, 'r') as f:
+                text = f.read()
+        except FileNotFoundError:
+            continue
+
+        result = game_result(text)
+        if not result:
+            continue
+
+        scores.append((result, candidate_score(result, candidate_turns_first)))
+        game_trees.append(text.strip())
+
+    with atomic_write(collection_path, 'w') as f:
+        f.write('\n'.join(game_trees))
+
+    return scores
@@ -0,0 +1,207 @@
+'''
+Training shards: one file per chunk of training examples with an offset index,
+so a reader can mmap it and fetch any game without unpacking the rest.
+
+    header    magic, version, flags, field width, field height, training run id,
+              first and last game number of the chunk, record count, index offset
+    records   examples one after another, gzipped as uploaded or decompressed (FLAG_GZIP unset)
+    index     (game number, network id, offset, length) per record, sorted by game number
+
+All integers are big endian. Network id 0 means the network is unknown.
+'''
+import gzip
+import mmap
+import os
+import struct
+from bisect import bisect_left
+from collections import namedtuple
+from .files import atomic_write
+
+SHARD_MAGIC = b'PPZS'
+SHARD_VERSION = 1
+SHARD_SUFFIX = '.shard'
+
+HEADER = struct.Struct('>4sHHHHIIIIQ')
+INDEX_ENTRY = struct.Struct('>IIQQ')
+
+# records are gzip members
+FLAG_GZIP = 1
+
+COPY_CHUNK_SIZE = 64 * 1024
+
+ShardRecord = namedtuple('ShardRecord', ['game_number', 'network_id', 'data'])
+
+
+class ShardError(ValueError):
+    pass
+
+
+def pack_shard(directory, first_game_number, games, training_run_id, field_width, field_height,
+               chunk_size, compressed=True):
+    '''
+    Packs <game_number>.gz examples of directory into <first_game_number>.shard.
+    The shard is written to a temporary file and renamed, readers never see a partial shard.
+    :param games: list of (game number, network id) sorted by game number.
+    :param compressed: keep examples gzipped, otherwise store them decompressed so
+        readers get them straight from the page cache.
+    :return: (shard path, game numbers whose examples are missing)
+    '''
+    output_path = os.path.join(directory, str(first_game_number) + SHARD_SUFFIX)
+    missing = []
+    index = []
+
+    with atomic_write(output_path) as f:
+        f.seek(HEADER.size)
+        for game_number, network_id in games:
+            offset = f.tell()
+            try:
+                example = open(os.path.join(directory, str(game_number) + '.gz'), 'rb')
+            except FileNotFoundError:
+                missing.append(game_number)
+                continue
+
+            with example:
+                source = example if compressed else gzip.open(example, 'rb')
+                for data in iter(lambda: source.read(COPY_CHUNK_SIZE), b''):
+                    f.write(data)
+
+            index.append(INDEX_ENTRY.pack(game_number, network_id or 0, offset, f.tell() - offset))
+
+        index_offset = f.tell()
+        f.write(b''.join(index))
+
+        f.seek(0)
+        f.write(HEADER.pack(SHARD_MAGIC, SHARD_VERSION, FLAG_GZIP if compressed else 0,
+                            field_width, field_height, training_run_id,
+                            first_game_number, first_game_number + chunk_size - 1, len(index), index_offset))
+
+    return output_path, missing
+
+
+class Shard:
+    '''
+    Memory-mapped shard. Records are read lazily, only the index is parsed on open.
+
+        with Shard(path) as shard:
+            example = shard.read(game_number)
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            if len(self._map) < HEADER.size:
+                raise ShardError(f'{path} is too short for a shard.')
+
+            (magic, version, flags, self.field_width, self.field_height, self.training_run_id,
+             self.first_game_number, self.last_game_number, count, index_offset) = HEADER.unpack_from(self._map)
+            if magic != SHARD_MAGIC:
+                raise ShardError(f'{path} is not a shard.')
+            if version != SHARD_VERSION:
+                raise ShardError(f'{path} has unsupported shard version {version}.')
+            if index_offset + count * INDEX_ENTRY.size > len(self._map):
+                raise ShardError(f'{path} is truncated.')
+
+            self.compressed = bool(flags & FLAG_GZIP)
+            self._index = list(INDEX_ENTRY.iter_unpack(self._map[index_offset:index_offset + count * INDEX_ENTRY.size]))
+            self._game_numbers = [entry[0] for entry in self._index]
+        except Exception:
+            self._map.close()
+            raise
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        for game_number, network_id, offset, length in self._index:
+            yield ShardRecord(game_number, network_id or None, self._decode(offset, length))
+
+    def __contains__(self, game_number):
+        return self._find(game_number) is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def game_numbers(self):
+        return list(self._game_numbers)
+
+    def network_id(self, game_number):
+        return self._entry(game_number)[1] or None
+
+    def raw(self, game_number):
+        '''
+        :return: stored record without a copy, gzipped if the shard is compressed.
+            Release the view before the shard is closed.
+        '''
+        _, _, offset, length = self._entry(game_number)
+        return memoryview(self._map)[offset:offset + length]
+
+    def read(self, game_number):
+        '''
+        :return: decompressed example of the game.
+        :raises KeyError: the game is not in the shard.
+        '''
+        _, _, offset, length = self._entry(game_number)
+        return self._decode(offset, length)
+
+    def close(self):
+        self._map.close()
+
+    def _decode(self, offset, length):
+        data = self._map[offset:offset + length]
+        if self.compressed:
+            # examples may be multi-member gzip files
+            return gzip.decompress(data)
+        return data
+
+    def _find(self, game_number):
+        position = bisect_left(self._game_numbers, game_number)
+        if position < len(self._game_numbers) and self._game_numbers[position] == game_number:
+            return self._index[position]
+        return None
+
+    def _entry(self, game_number):
+        entry = self._find(game_number)
+        if entry is None:
+            raise KeyError(game_number)
+        return entry
+
+
+def shard_paths(directory):
+    '''
+    :return: shard paths of a training run directory ordered by first game number.
+    '''
+    if not os.path.isdir(directory):
+        return []
+
+    paths = [entry.path for entry in os.scandir(directory)
+             if entry.name.endswith(SHARD_SUFFIX) and not entry.name.startswith('.')]
+    return sorted(paths, key=lambda path: int(os.path.basename(path)[:-len(SHARD_SUFFIX)]))
+
+
+def iter_shards(directory, first_game_number=None):
+    '''
+    Opens shards of a training run directory one at a time, each is closed when the next one is taken.
+    :param first_game_number: skip shards that end before this game.
+    '''
+    for path in shard_paths(directory):
+        with Shard(path) as shard:
+            if first_game_number is not None and shard.last_game_number < first_game_number:
+                continue
+            yield shard
+
+
+def iter_examples(directory, first_game_number=None):
+    '''
+    Yields ShardRecord of every game in the shards of a training run directory in game order.
+    '''
+    for shard in iter_shards(directory, first_game_number):
+        for record in shard:
+            if first_game_number is None or record.game_number >= first_game_number:
+                yield record
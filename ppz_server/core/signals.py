@@ -0,0 +1,14 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver, Signal
+from .models import TrainingRun, Network, Match
+from .scheduler import scheduler
+
+# sent with the model as sender after queryset updates and bulk writes of its rows, which send no post_save
+bulk_saved = Signal()
+
+
+@receiver([post_save, post_delete], sender=TrainingRun)
+@receiver([post_save, post_delete], sender=Network)
+@receiver([post_save, post_delete], sender=Match)
+def invalidate_scheduler(sender, **kwargs):
+    scheduler.invalidate()
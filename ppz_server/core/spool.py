@@ -0,0 +1,268 @@
+import fcntl
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import uuid
+import zlib
+from collections import namedtuple
+from django.conf import settings
+from .files import remove_quietly
+
+# magic, crc32 of meta, meta length
+RECORD_HEADER = struct.Struct('>4sII')
+RECORD_MAGIC = b'PPZR'
+# offset and length of a record in its segment
+INDEX_ENTRY = struct.Struct('>QQ')
+
+OPEN_SUFFIX = '.open'
+SEALED_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+# uploaded files of records, <segment name>-<record id>-<file name>.blob
+BLOB_SUFFIX = '.blob'
+
+# files: file name -> path of its blob
+SpoolRecord = namedtuple('SpoolRecord', ['id', 'kind', 'fields', 'files'])
+
+
+class Spool:
+    '''
+    Local append-only ingest spool in INGEST['spool_path'].
+
+    Every process appends to its own segment file and records the offset of every
+    record in an index next to it. Uploaded files of a record are not copied into the
+    segment: upload handlers stream them into the temporary directory of the spool
+    (see core.files) and append() renames them to blobs next to the segment, which the
+    drain task hard links into place. An upload is written once, so INGEST['spool_path']
+    has to be on the file system of the upload directories.
+
+    Blobs, the record, its index entry and the directory are fsynced before append()
+    returns, so an acknowledged upload survives a crash. Segments are sealed when they
+    grow past INGEST['spool_segment_bytes'] or get older than INGEST['spool_segment_age']
+    seconds, and the drain task (core.scripts.drain_spool) commits and deletes sealed
+    segments with their blobs.
+
+    Writers and the drain task take an flock on the open segment, so the drain task
+    can seal segments of idle or dead processes without losing appends.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._segment = None
+        self._index = None
+        self._name = None
+        self._path = None
+        self._opened_at = 0
+        self._sequence = 0
+
+    def append(self, kind, fields, files):
+        '''
+        :param kind: record type, decides how the drain task commits it.
+        :param fields: json serializable dict.
+        :param files: dict name -> StreamedUploadedFile written to the temporary directory of the spool.
+        :return: record id, the drain task uses it to skip records committed before.
+        '''
+        record_id = uuid.uuid4().hex
+        fsync = settings.INGEST['spool_fsync']
+        for file in files.values():
+            file.file.flush()
+            if fsync:
+                os.fsync(file.file.fileno())
+
+        with self._lock:
+            segment = self._writable_segment()
+            fcntl.flock(segment, fcntl.LOCK_EX)
+            try:
+                if not self._is_current(segment):
+                    # sealed by the drain task, start a new segment
+                    fcntl.flock(segment, fcntl.LOCK_UN)
+                    self._close()
+                    segment = self._writable_segment()
+                    fcntl.flock(segment, fcntl.LOCK_EX)
+
+                # blobs are named after the segment, so they go with it even if the record is never written
+                blobs = []
+                for name, file in files.items():
+                    blob = f'{self._name}-{record_id}-{name}{BLOB_SUFFIX}'
+                    file.save_as(os.path.join(os.path.dirname(self._path), blob))
+                    blobs.append((name, blob))
+
+                meta = json.dumps({'id': record_id, 'kind': kind, 'fields': fields, 'files': blobs}).encode()
+                self._write_record(segment, meta)
+            finally:
+                fcntl.flock(segment, fcntl.LOCK_UN)
+
+        # blob renames and new segment files
+        if fsync:
+            _fsync_directory(settings.INGEST['spool_path'])
+
+        return record_id
+
+    def _write_record(self, segment, meta):
+        offset = segment.seek(0, os.SEEK_END)
+        segment.write(RECORD_HEADER.pack(RECORD_MAGIC, zlib.crc32(meta), len(meta)))
+        segment.write(meta)
+        end = segment.tell()
+        segment.flush()
+        self._index.write(INDEX_ENTRY.pack(offset, end - offset))
+        self._index.flush()
+
+        if settings.INGEST['spool_fsync']:
+            os.fsync(segment.fileno())
+            os.fsync(self._index.fileno())
+
+    def _writable_segment(self):
+        segment = self._segment
+        if segment is not None:
+            too_big = segment.tell() >= settings.INGEST['spool_segment_bytes']
+            too_old = time.monotonic() - self._opened_at >= settings.INGEST['spool_segment_age']
+            if too_big or too_old:
+                self._seal_own()
+
+        if self._segment is None:
+            spool_path = settings.INGEST['spool_path']
+            os.makedirs(spool_path, exist_ok=True)
+            self._sequence += 1
+            self._name = f'{socket.gethostname()}-{os.getpid()}-{int(time.time() * 1000)}-{self._sequence}'
+            self._path = os.path.join(spool_path, self._name + OPEN_SUFFIX)
+            self._segment = open(self._path, 'w+b')
+            self._index = open(os.path.join(spool_path, self._name + INDEX_SUFFIX), 'ab')
+            self._opened_at = time.monotonic()
+
+        return self._segment
+
+    def _is_current(self, segment):
+        try:
+            return os.stat(self._path).st_ino == os.fstat(segment.fileno()).st_ino
+        except FileNotFoundError:
+            return False
+
+    def _seal_own(self):
+        segment = self._segment
+        fcntl.flock(segment, fcntl.LOCK_EX)
+        try:
+            if self._is_current(segment):
+                os.replace(self._path, self._path[:-len(OPEN_SUFFIX)] + SEALED_SUFFIX)
+        finally:
+            fcntl.flock(segment, fcntl.LOCK_UN)
+        self._close()
+
+    def _close(self):
+        self._segment.close()
+        self._index.close()
+        self._segment = self._index = self._name = self._path = None
+
+
+def seal_stale_segments(max_age):
+    '''
+    Seals open segments not written for max_age seconds, their processes are idle or dead.
+    '''
+    spool_path = settings.INGEST['spool_path']
+    if not os.path.isdir(spool_path):
+        return
+
+    for entry in os.scandir(spool_path):
+        if not entry.name.endswith(OPEN_SUFFIX) or time.time() - entry.stat().st_mtime < max_age:
+            continue
+
+        try:
+            segment = open(entry.path, 'rb')
+        except FileNotFoundError:
+            continue
+
+        with segment:
+            fcntl.flock(segment, fcntl.LOCK_EX)
+            try:
+                os.replace(entry.path, entry.path[:-len(OPEN_SUFFIX)] + SEALED_SUFFIX)
+            except FileNotFoundError:
+                pass
+            finally:
+                fcntl.flock(segment, fcntl.LOCK_UN)
+
+
+def sealed_segments():
+    spool_path = settings.INGEST['spool_path']
+    if not os.path.isdir(spool_path):
+        return []
+
+    paths = [entry.path for entry in os.scandir(spool_path) if entry.name.endswith(SEALED_SUFFIX)]
+    return sorted(paths, key=os.path.getmtime)
+
+
+def read_segment(path):
+    '''
+    Yields records of a sealed segment. Offsets come from the index; records written
+    after the last index entry (crash between the two writes) are found by scanning.
+    A torn record at the end of the segment was never acknowledged and is skipped.
+    '''
+    index_path = path[:-len(SEALED_SUFFIX)] + INDEX_SUFFIX
+    offsets = []
+    if os.path.exists(index_path):
+        with open(index_path, 'rb') as f:
+            data = f.read()
+        offsets = [INDEX_ENTRY.unpack_from(data, position)[0]
+                   for position in range(0, len(data) - len(data) % INDEX_ENTRY.size, INDEX_ENTRY.size)]
+
+    with open(path, 'rb') as segment:
+        size = os.fstat(segment.fileno()).st_size
+
+        next_offset = 0
+        for offset in offsets:
+            record, next_offset = _read_record(segment, offset, size)
+            if record is not None:
+                yield record
+
+        while next_offset is not None and next_offset < size:
+            record, next_offset = _read_record(segment, next_offset, size)
+            if record is not None:
+                yield record
+
+
+def remove_segment(path):
+    '''
+    Removes a sealed segment, its index and blobs, those of records never written included.
+    '''
+    name = os.path.basename(path)[:-len(SEALED_SUFFIX)]
+    for entry in os.scandir(os.path.dirname(path)):
+        if entry.name.startswith(name + '-') and entry.name.endswith(BLOB_SUFFIX):
+            remove_quietly(entry.path)
+
+    # blobs go first, a replay of the segment skips records committed before without them
+    remove_quietly(path[:-len(SEALED_SUFFIX)] + INDEX_SUFFIX)
+    remove_quietly(path)
+
+
+def _fsync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _read_record(segment, offset, size):
+    '''
+    :return: (record or None if it is torn or corrupted, offset of the next record or None)
+    '''
+    if offset + RECORD_HEADER.size > size:
+        return None, None
+
+    segment.seek(offset)
+    magic, crc, meta_size = RECORD_HEADER.unpack(segment.read(RECORD_HEADER.size))
+    end = offset + RECORD_HEADER.size + meta_size
+    if magic != RECORD_MAGIC or end > size:
+        return None, None
+
+    meta = segment.read(meta_size)
+    if zlib.crc32(meta) != crc:
+        return None, end
+
+    meta = json.loads(meta)
+    directory = os.path.dirname(segment.name)
+    files = {name: os.path.join(directory, blob) for name, blob in meta['files']}
+    return SpoolRecord(meta['id'], meta['kind'], meta['fields'], files), end
+
+
+spool = Spool()
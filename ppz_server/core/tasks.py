@@ -1,7 +1,9 @@
 from core.scripts.update_elo import update_elo
 from core.scripts.run_training import run_training
-from core.scripts.compact_examples import compact_examples
+from core.scripts.compact_examples import compact_examples, compact_training_run
 from core.scripts.upload_examples import upload_examples
+from core.scripts.drain_spool import drain_spool
+from core.scripts.rollup_games import rollup_games
 from celery import shared_task
 from django.conf import settings
 
@@ -16,11 +18,26 @@ def task_run_training():
     run_training()
 
 
+@shared_task()
+def task_drain_spool():
+    drain_spool()
+
+
+@shared_task()
+def task_rollup_games():
+    rollup_games()
+
+
 @shared_task()
 def task_compact_examples():
     compact_examples()
 
 
+@shared_task()
+def task_compact_training_run(training_run_id):
+    compact_training_run(training_run_id)
+
+
 if settings.CLOUD_STORAGE:
     @shared_task()
     def task_upload_examples():
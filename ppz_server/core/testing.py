@@ -0,0 +1,268 @@
+'''
+Synthetic data and measuring helpers for the benchmark suites in core/tests.py and monitoring/tests.py.
+
+    PPZ_BENCHMARK_SCALE=1 PPZ_BENCHMARK_OUTPUT=results/ python manage.py test core monitoring
+
+Sizes are FULL_SIZE times PPZ_BENCHMARK_SCALE (0.01 by default, so the suites stay quick
+in a regular test run); scale 1 seeds 10 training runs, 30000 networks and 3 million training
+games. Every run repeats each request PPZ_BENCHMARK_REPEAT times and fails when a request
+issues more queries than its budget. Results are written as JSON to <PPZ_BENCHMARK_OUTPUT>/<suite>.json
+when the variable is set and only logged at DEBUG level otherwise.
+
+Rows are generated by Postgres with generate_series, the only database the server runs on.
+'''
+import gzip
+import hashlib
+import json
+import logging
+import os
+import statistics
+import tempfile
+import time
+from collections import namedtuple
+from celery import current_app
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from .models import User, TrainingRun, Network, Match, MatchGame, TrainingGame
+from .scheduler import scheduler
+from .scripts.rollup_games import rollup_games
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_SCALE = float(os.environ.get('PPZ_BENCHMARK_SCALE', '0.01'))
+BENCHMARK_REPEAT = int(os.environ.get('PPZ_BENCHMARK_REPEAT', '5'))
+BENCHMARK_OUTPUT = os.environ.get('PPZ_BENCHMARK_OUTPUT')
+
+FULL_SIZE = {
+    'training_runs': 10,
+    'networks': 30000,
+    'games': 3000000,
+    'users': 1000,
+}
+# small sizes still need a few of everything
+MIN_SIZE = {
+    'training_runs': 3,
+    'networks': 30,
+    'games': 3000,
+    'users': 10,
+}
+# games of a match between consecutive networks
+MATCH_GAMES = 20
+# unfinished match games per run for match game uploads
+OPEN_MATCH_GAMES = 200
+# examples on disk in the sampling window of the first run
+WINDOW_GAMES = 256
+NETWORK_BYTES = 64 * 1024
+FIELD_SIZE = 10
+
+SeededData = namedtuple('SeededData', [
+    'training_run_ids', 'usernames', 'best_network_ids', 'best_network_shas', 'open_match_game_ids'
+])
+
+
+def benchmark_settings():
+    '''
+    :return: settings for override_settings: files in a temporary directory, a local memory cache
+        and no spool, so every request of a kind issues the same queries.
+    '''
+    directory = tempfile.mkdtemp(prefix='ppz-benchmark-')
+    return {
+        'MATCH_SGF_PATH': os.path.join(directory, 'sgf', 'matches'),
+        'MATCH_COLLECTION_SGF_PATH': os.path.join(directory, 'sgf', 'match_collection'),
+        'TRAINING_SGF_PATH': os.path.join(directory, 'sgf', 'training'),
+        'TRAINING_EXAMPLES_PATH': os.path.join(directory, 'examples'),
+        'NETWORKS_PATH': os.path.join(directory, 'networks'),
+        'NETWORK_DELTAS_PATH': os.path.join(directory, 'networks', 'deltas'),
+        'NETWORK_CACHE': {**settings.NETWORK_CACHE, 'spill_path': os.path.join(directory, 'cache', 'networks')},
+        # counts are written right away, none are left for the exit of the test process
+        'INGEST': {**settings.INGEST, 'spool': False, 'games_played_flush': 0},
+        # open matches are seeded with OPEN_MATCH_GAMES unfinished games and must still create games
+        'MATCHES': {**settings.MATCHES, 'games_to_finish': 2 * OPEN_MATCH_GAMES},
+        # the seeded window is small, a full buffer would take many passes over it
+        'SAMPLER': {**settings.SAMPLER, 'shuffle_buffer': WINDOW_GAMES // 4},
+        'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        'CLOUD_STORAGE': False,
+    }
+
+
+def benchmark_size(name, scale=None):
+    scale = BENCHMARK_SCALE if scale is None else scale
+    return max(MIN_SIZE[name], int(FULL_SIZE[name] * scale))
+
+
+def network_sha(training_run_id, network_number):
+    return hashlib.sha256(f'{training_run_id}:{network_number}'.encode()).hexdigest()
+
+
+def seed(scale=None):
+    '''
+    Seeds users, active training runs with rated networks, finished matches between consecutive
+    networks, training games spread over the last two days and their rollups, one open match per
+    run and the files needed to download best networks and sample examples of the first run.
+    :return: SeededData
+    '''
+    training_runs = benchmark_size('training_runs', scale)
+    networks = benchmark_size('networks', scale) // training_runs
+    games = benchmark_size('games', scale) // training_runs
+
+    User.objects.bulk_create([User(username=f'user{i}', password='!') for i in range(benchmark_size('users', scale))])
+    usernames = list(User.objects.order_by('id').values_list('username', flat=True))
+    first_user_id = User.objects.order_by('id').values_list('id', flat=True).first()
+
+    training_run_ids = []
+    best_network_ids = []
+    best_network_shas = []
+    open_match_game_ids = []
+    for _ in range(training_runs):
+        training_run = TrainingRun.objects.create(
+            field_width=FIELD_SIZE, field_height=FIELD_SIZE, training_parameters={'window': WINDOW_GAMES},
+            match_parameters={}, active=True, last_game=games, last_network=networks + 1)
+
+        Network.objects.bulk_create([
+            Network(training_run=training_run, network_number=number, sha=network_sha(training_run.id, number),
+                    elo=2.0 * number, elo_error=30.0, games_played=games // networks,
+                    field_width=FIELD_SIZE, field_height=FIELD_SIZE)
+            for number in range(1, networks + 1)
+        ], batch_size=5000)
+        network_ids = list(Network.objects.filter(training_run=training_run).order_by('network_number').values_list(
+            'id', flat=True))
+
+        Match.objects.bulk_create([
+            Match(training_run=training_run, candidate_id=candidate_id, current_best_id=current_best_id,
+                  parameters={}, games_created=MATCH_GAMES, candidate_wins=MATCH_GAMES // 2,
+                  best_wins=MATCH_GAMES // 4, draws=MATCH_GAMES - MATCH_GAMES // 2 - MATCH_GAMES // 4,
+                  games_to_finish=MATCH_GAMES, done=True, passed=True, elo_processed=True)
+            for current_best_id, candidate_id in zip(network_ids, network_ids[1:])
+        ], batch_size=5000)
+
+        # the open match: an unrated candidate against the best network
+        candidate = Network.objects.create(training_run=training_run, network_number=networks + 1,
+                                           sha=network_sha(training_run.id, networks + 1),
+                                           field_width=FIELD_SIZE, field_height=FIELD_SIZE)
+        match = Match.objects.create(training_run=training_run, candidate=candidate,
+                                     current_best_id=network_ids[-1], parameters={},
+                                     games_to_finish=100 * OPEN_MATCH_GAMES, games_created=OPEN_MATCH_GAMES)
+        MatchGame.objects.bulk_create([
+            MatchGame(match=match, user_id=first_user_id, candidate_turns_first=i % 2 == 0)
+            for i in range(OPEN_MATCH_GAMES)
+        ])
+        open_match_game_ids.append(list(MatchGame.objects.filter(match=match).order_by('id').values_list(
+            'id', flat=True)))
+
+        seed_training_games(training_run.id, network_ids, first_user_id, games)
+
+        TrainingRun.objects.filter(id=training_run.id).update(best_network_id=network_ids[-1])
+        training_run_ids.append(training_run.id)
+        best_network_ids.append(network_ids[-1])
+        best_network_shas.append(network_sha(training_run.id, networks))
+
+    write_files(training_run_ids, best_network_shas, games)
+    # queryset updates don't send signals
+    scheduler.invalidate()
+    # in a TestCase foreign keys are checked when each test ends, once here is enough for seeded rows
+    connection.check_constraints()
+
+    return SeededData(training_run_ids, usernames, best_network_ids, best_network_shas, open_match_game_ids)
+
+
+def seed_training_games(training_run_id, network_ids, user_id, games):
+    # game g was played by network g * networks / games, newer games have bigger numbers
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {TrainingGame._meta.db_table} '
+            f'(created_at, game_number, user_id, training_run_id, network_id, compacted) '
+            f'SELECT now() - (%s - g) * interval \'2 days\' / %s, g, %s, %s, '
+            f'(%s::int[])[1 + (g - 1)::bigint * %s / %s], false FROM generate_series(1, %s) AS g',
+            [games, games, user_id, training_run_id, network_ids, len(network_ids), games, games]
+        )
+    rollup_games()
+
+
+def write_files(training_run_ids, best_network_shas, games):
+    os.makedirs(settings.NETWORKS_PATH, exist_ok=True)
+    for sha in best_network_shas:
+        with gzip.open(os.path.join(settings.NETWORKS_PATH, sha + '.gz'), 'wb') as f:
+            f.write(os.urandom(NETWORK_BYTES))
+
+    directory = os.path.join(settings.TRAINING_EXAMPLES_PATH, str(training_run_ids[0]))
+    os.makedirs(directory, exist_ok=True)
+    for game_number in range(games - WINDOW_GAMES + 1, games + 1):
+        with gzip.open(os.path.join(directory, str(game_number) + '.gz'), 'wb') as f:
+            f.write(os.urandom(512))
+
+
+class BenchmarkMixin:
+    '''
+    TestCase mixin that measures requests against query budgets and collects the results
+    of the suite, written out by tearDownClass. Celery tasks run eagerly.
+    '''
+    suite = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.results = []
+        cls._always_eager = current_app.conf.task_always_eager
+        current_app.conf.task_always_eager = True
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        current_app.conf.task_always_eager = cls._always_eager
+        write_results(cls.suite, cls.results)
+
+    def measure(self, name, budget, request, status=200, before=None):
+        '''
+        Calls request BENCHMARK_REPEAT times and records its wall time and queries.
+        :param budget: most queries a call may issue.
+        :param request: callable that makes the request and returns the response.
+        :param before: callable run before every call, not measured.
+        :return: response of the last call
+        '''
+        timings = []
+        queries = 0
+        response = None
+        for _ in range(BENCHMARK_REPEAT):
+            if before is not None:
+                before()
+
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                response = request()
+                # streamed bodies are produced while they are read
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                timings.append(time.perf_counter() - start)
+
+            self.assertEqual(response.status_code, status, f'{name}: {getattr(response, "data", None)}')
+            self.assertLessEqual(len(captured), budget, f'{name} queries:\n' + '\n'.join(
+                query['sql'] for query in captured.captured_queries))
+            queries = max(queries, len(captured))
+
+        self.results.append({
+            'name': name,
+            'queries': queries,
+            'budget': budget,
+            'median_seconds': statistics.median(timings),
+            'max_seconds': max(timings),
+            'repeat': BENCHMARK_REPEAT,
+        })
+        return response
+
+
+def write_results(suite, results):
+    report = {
+        'suite': suite,
+        'scale': BENCHMARK_SCALE,
+        'sizes': {name: benchmark_size(name) for name in FULL_SIZE},
+        'results': results,
+    }
+
+    if BENCHMARK_OUTPUT is None:
+        logger.debug('%s', json.dumps(report))
+        return
+
+    os.makedirs(BENCHMARK_OUTPUT, exist_ok=True)
+    with open(os.path.join(BENCHMARK_OUTPUT, f'{suite}.json'), 'w') as f:
+        json.dump(report, f, indent=2)
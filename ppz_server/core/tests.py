@@ -1,3 +1,634 @@
-from django.test import TestCase
+import gzip
+import hashlib
+import io
+import os
+import random
+import tarfile
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from kombu.exceptions import OperationalError
+from .counters import GameCounters
+from .matches import (lease_match_game, record_match_game_result, match_games_to_finish, sprt_decision, sprt_result,
+                      finalise_match)
+from .models import User, TrainingRun, Network, TrainingGame, Match, MatchGame, GameRollup
+from .network_cache import network_cache
+from .rating import fit_ratings
+from .scripts import compact_examples
+from .scripts.drain_spool import drain_spool
+from .scripts.rollup_games import rollup_games
+from .scripts.update_elo import update_elo
+from .scripts.upload_examples import upload_examples
+from .spool import seal_stale_segments, sealed_segments
+from .scheduler import scheduler
+from .shards import Shard, ShardError, SHARD_SUFFIX, iter_examples, shard_paths
+from .testing import BenchmarkMixin, benchmark_settings, seed, FIELD_SIZE
 
-# Create your tests here.
+
+def upload(name, data):
+    f = io.BytesIO(data)
+    f.name = name
+    return f
+
+
+@override_settings(**benchmark_settings())
+class CoreApiBenchmark(BenchmarkMixin, TestCase):
+    '''
+    Query budgets and timings of core.urls endpoints, see core.testing.
+    '''
+    suite = 'core'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed()
+
+    def setUp(self):
+        scheduler.invalidate()
+        cache.clear()
+        self.client = APIClient()
+        self.training_run_id = self.data.training_run_ids[0]
+        self.network_id = self.data.best_network_ids[0]
+
+    # budgets include the scheduler snapshot load of the first request, setUp drops it
+
+    def test_next_game(self):
+        usernames = iter(self.data.usernames)
+        response = self.measure('next_game', 9, lambda: self.client.post('/next_game', {'username': next(usernames)}))
+        self.assertEqual(response.data['game_type'], 'match')
+
+    def test_upload_network(self):
+        self.measure('upload_network', 5, lambda: self.client.post('/upload_network', {
+            'network': upload('network.gz', gzip.compress(os.urandom(4096))),
+            'training_run_id': self.training_run_id,
+            'field_width': FIELD_SIZE,
+            'field_height': FIELD_SIZE,
+        }, format='multipart'))
+
+    def test_download_network(self):
+        sha = self.data.best_network_shas[0]
+        response = self.measure('download_network', 3, lambda: self.client.get(f'/download_network/{sha}'))
+        self.measure('download_network not modified', 1, lambda: self.client.get(
+            f'/download_network/{sha}', HTTP_IF_NONE_MATCH=response['ETag']), status=304)
+
+    def test_upload_match_game(self):
+        match_game_ids = iter(self.data.open_match_game_ids[0])
+        self.measure('upload_match_game', 7, lambda: self.client.post('/upload_match_game', {
+            'username': self.data.usernames[0],
+            'match_game_id': next(match_game_ids),
+            'result': 1,
+            'match_game_sgf': upload('game.sgf', b'(;GM[40]FF[4]SZ[10:10]RE[W+1];B[aa];W[bb])'),
+        }, format='multipart'))
+
+    def test_upload_training_game(self):
+        self.measure('upload_training_game', 5, lambda: self.client.post('/upload_training_game', {
+            'username': self.data.usernames[0],
+            'training_run_id': self.training_run_id,
+            'network_id': self.network_id,
+            'training_game_sgf': upload('game.sgf', b'(;GM[40]FF[4]SZ[10:10]RE[W+1];B[aa];W[bb])'),
+            'training_example': upload('game.gz', gzip.compress(os.urandom(2048))),
+        }, format='multipart'))
+
+    def test_upload_training_games(self):
+        games = 16
+
+        def games_tar():
+            data = io.BytesIO()
+            with tarfile.open(fileobj=data, mode='w') as tar:
+                for i in range(games):
+                    for name, content in ((f'{i}.sgf', b'(;GM[40]RE[B+1])'), (f'{i}.gz', gzip.compress(os.urandom(2048)))):
+                        member = tarfile.TarInfo(name)
+                        member.size = len(content)
+                        tar.addfile(member, io.BytesIO(content))
+            return upload('games.tar', data.getvalue())
+
+        response = self.measure('upload_training_games', 5, lambda: self.client.post('/upload_training_games', {
+            'username': self.data.usernames[0],
+            'training_run_id': self.training_run_id,
+            'network_id': self.network_id,
+            'games': games_tar(),
+        }, format='multipart'))
+        self.assertEqual(len(response.data['game_numbers']), games)
+
+    def test_sample_examples(self):
+        self.measure('sample_examples', 3, lambda: self.client.get('/sample_examples', {
+            'training_run_id': self.training_run_id,
+            'batch_size': 32,
+            'batches': 4,
+        }))
+
+
+class GameCountersTest(TestCase):
+    def setUp(self):
+        self.training_run = TrainingRun.objects.create(
+            field_width=FIELD_SIZE, field_height=FIELD_SIZE, training_parameters={}, match_parameters={})
+
+    def last_game(self):
+        return TrainingRun.objects.values_list('last_game', flat=True).get(id=self.training_run.id)
+
+    @override_settings(INGEST={**settings.INGEST, 'game_number_block': 5})
+    def test_processes_reserve_disjoint_blocks(self):
+        first, second = GameCounters(), GameCounters()
+
+        self.assertEqual(first.next_game_numbers(self.training_run.id), [1])
+        self.assertEqual(second.next_game_numbers(self.training_run.id, 2), [6, 7])
+        self.assertEqual(first.next_game_numbers(self.training_run.id, 3), [2, 3, 4])
+        # the rest of the block, then a new block of the missing count
+        self.assertEqual(first.next_game_numbers(self.training_run.id, 7), [5, 11, 12, 13, 14, 15, 16])
+        self.assertEqual(second.next_game_numbers(self.training_run.id, 3), [8, 9, 10])
+        self.assertEqual(self.last_game(), 16)
+
+    @override_settings(INGEST={**settings.INGEST, 'game_number_block': 1})
+    def test_numbers_follow_last_game(self):
+        TrainingRun.objects.filter(id=self.training_run.id).update(last_game=41)
+        self.assertEqual(GameCounters().next_game_numbers(self.training_run.id, 2), [42, 43])
+        self.assertEqual(self.last_game(), 43)
+
+    def test_unknown_training_run(self):
+        with self.assertRaises(TrainingRun.DoesNotExist):
+            GameCounters().next_game_numbers(self.training_run.id + 1)
+
+    @override_settings(INGEST={**settings.INGEST, 'game_number_block': 5, 'game_number_block_age': 10})
+    def test_old_blocks_are_dropped(self):
+        counters = GameCounters()
+        self.assertEqual(counters.next_game_numbers(self.training_run.id), [1])
+        with mock.patch('core.counters.time.monotonic', return_value=time.monotonic() + 11):
+            self.assertEqual(counters.next_game_numbers(self.training_run.id), [6])
+
+    @override_settings(INGEST={**settings.INGEST, 'games_played_flush': 10})
+    def test_games_played_is_written_per_interval(self):
+        network = Network.objects.create(training_run=self.training_run, network_number=1, sha='0' * 64,
+                                         field_width=FIELD_SIZE, field_height=FIELD_SIZE)
+        counters = GameCounters()
+        with self.assertNumQueries(0):
+            counters.count_games(network.id)
+            counters.count_games(network.id, 3)
+
+        with mock.patch('core.counters.time.monotonic', return_value=time.monotonic() + 11), \
+                self.assertNumQueries(1):
+            counters.count_games(network.id)
+        network.refresh_from_db()
+        self.assertEqual(network.games_played, 5)
+
+        counters.count_games(network.id, 2)
+        counters.flush()
+        network.refresh_from_db()
+        self.assertEqual(network.games_played, 7)
+
+
+class UploadNetworkTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.training_run = TrainingRun.objects.create(
+            field_width=FIELD_SIZE, field_height=FIELD_SIZE, training_parameters={}, match_parameters={})
+        self.previous = os.urandom(4096)
+        self.previous_sha = hashlib.sha256(self.previous).hexdigest()
+        best = Network.objects.create(training_run=self.training_run, network_number=1, sha=self.previous_sha,
+                                      field_width=FIELD_SIZE, field_height=FIELD_SIZE)
+        TrainingRun.objects.filter(id=self.training_run.id).update(best_network=best, last_network=1)
+
+    @override_settings(CLOUD_STORAGE=True, NETWORKS_PATH=tempfile.mkdtemp(prefix='ppz-networks-'))
+    def test_rebuilt_network_is_uploaded_whole(self):
+        network = os.urandom(4096)
+        delta = bytes(a ^ b for a, b in zip(self.previous, network))
+        uploaded = {}
+
+        def upload_file(path, bucket, key):
+            with gzip.open(path) as f:
+                uploaded[key] = f.read()
+            uploaded['path'] = path
+
+        with mock.patch('core.views.network_cache.open', return_value=io.BytesIO(self.previous)), \
+                self.settings(S3=mock.Mock(upload_file=upload_file), S3_NETWORKS_BUCKET_NAME='networks'):
+            response = self.client.post('/upload_network', {
+                'network': upload('delta.gz', gzip.compress(delta)), 'prev_delta_sha': self.previous_sha,
+                'training_run_id': self.training_run.id, 'field_width': FIELD_SIZE, 'field_height': FIELD_SIZE,
+            }, format='multipart')
+
+        self.assertEqual(response.status_code, 200, response.data)
+        sha = hashlib.sha256(network).hexdigest()
+        self.assertEqual(uploaded[sha + '.gz'], network)
+        self.assertFalse(os.path.exists(uploaded['path']))
+        self.assertTrue(Network.objects.filter(sha=sha, network_number=2).exists())
+
+
+@override_settings(NETWORK_DELTAS_PATH=tempfile.mkdtemp(prefix='ppz-deltas-'))
+class NetworkDeltaTest(SimpleTestCase):
+    def test_pair_without_delta_is_not_rebuilt(self):
+        networks = {'a': os.urandom(4096), 'b': os.urandom(8192)}
+
+        with mock.patch('core.network_cache.network_cache.open', side_effect=lambda sha: io.BytesIO(networks[sha])) \
+                as open_network:
+            self.assertIsNone(network_cache.delta_path('a', 'b'))
+            self.assertIsNone(network_cache.delta_path('a', 'b'))
+
+        self.assertEqual(open_network.call_count, 2)
+
+
+@override_settings(TRAINING_EXAMPLES_PATH=tempfile.mkdtemp(prefix='ppz-compaction-'), TRAINING_CHUNK_SIZE=10,
+                   COMPACTION={'delay': 0, 'lag': 5, 'workers': 1, 'format': 'tar', 'shard_compressed': True})
+class CompactionTest(TestCase):
+    def setUp(self):
+        self.training_run = TrainingRun.objects.create(
+            field_width=FIELD_SIZE, field_height=FIELD_SIZE, training_parameters={}, match_parameters={})
+
+    def add_games(self, game_numbers, last_game):
+        run_directory = os.path.join(settings.TRAINING_EXAMPLES_PATH, str(self.training_run.id))
+        os.makedirs(run_directory, exist_ok=True)
+        for game_number in game_numbers:
+            with open(os.path.join(run_directory, f'{game_number}.gz'), 'wb') as f:
+                f.write(gzip.compress(str(game_number).encode()))
+        TrainingGame.objects.bulk_create([
+            TrainingGame(training_run=self.training_run, game_number=game_number) for game_number in game_numbers
+        ])
+        TrainingRun.objects.filter(id=self.training_run.id).update(last_game=last_game)
+
+    def compacted_game(self):
+        return TrainingRun.objects.values_list('compacted_game', flat=True).get(id=self.training_run.id)
+
+    def chunk_members(self, first_game_number):
+        path = os.path.join(settings.TRAINING_EXAMPLES_PATH, str(self.training_run.id), f'{first_game_number}.tar')
+        with tarfile.open(path) as tar:
+            return tar.getnames()
+
+    def test_cursor_moves_over_complete_chunks(self):
+        self.add_games(range(1, 26), 25)
+        compact_examples.compact_training_run(self.training_run.id)
+
+        self.assertEqual(self.compacted_game(), 20)
+        self.assertEqual(self.chunk_members(11), [f'{number}.gz' for number in range(11, 21)])
+        self.assertEqual(set(TrainingGame.objects.filter(compacted=True).values_list('game_number', flat=True)),
+                         set(range(1, 21)))
+
+    def test_incomplete_chunk_waits_for_the_lag(self):
+        self.add_games([number for number in range(1, 11) if number != 7], 10)
+        compact_examples.compact_training_run(self.training_run.id)
+        # 7 may still be uploading
+        self.assertEqual(self.compacted_game(), 0)
+
+        TrainingRun.objects.filter(id=self.training_run.id).update(last_game=15)
+        compact_examples.compact_training_run(self.training_run.id)
+        self.assertEqual(self.compacted_game(), 10)
+        self.assertNotIn('7.gz', self.chunk_members(1))
+
+    def test_moved_cursor_is_not_packed_again(self):
+        self.add_games(range(1, 11), 10)
+        with mock.patch.object(compact_examples, 'pack_chunks', wraps=compact_examples.pack_chunks) as pack_chunks:
+            compact_examples.compact_training_run(self.training_run.id)
+            compact_examples.compact_training_run(self.training_run.id)
+            compact_examples.compact_examples()
+
+        self.assertEqual(pack_chunks.call_count, 1)
+        self.assertEqual(self.compacted_game(), 10)
+
+    def test_shards_round_trip(self):
+        self.add_games([number for number in range(1, 21) if number != 7], 25)
+        network = Network.objects.create(training_run=self.training_run, network_number=1, sha='0' * 64,
+                                         field_width=FIELD_SIZE, field_height=FIELD_SIZE)
+        TrainingGame.objects.filter(game_number__lte=10).update(network=network)
+        run_directory = os.path.join(settings.TRAINING_EXAMPLES_PATH, str(self.training_run.id))
+
+        for compressed in (True, False):
+            TrainingRun.objects.filter(id=self.training_run.id).update(compacted_game=0)
+            with self.settings(COMPACTION={**settings.COMPACTION, 'format': 'shard', 'shard_compressed': compressed}):
+                compact_examples.compact_training_run(self.training_run.id)
+
+            self.assertEqual(shard_paths(run_directory),
+                             [os.path.join(run_directory, f'{number}{SHARD_SUFFIX}') for number in (1, 11)])
+            with Shard(os.path.join(run_directory, f'1{SHARD_SUFFIX}')) as shard:
+                self.assertEqual(shard.compressed, compressed)
+                self.assertEqual((shard.training_run_id, shard.first_game_number, shard.last_game_number),
+                                 (self.training_run.id, 1, 10))
+                self.assertNotIn(7, shard)
+                self.assertEqual(shard.read(8), b'8')
+                self.assertEqual(shard.network_id(8), network.id)
+                with self.assertRaises(KeyError):
+                    shard.read(7)
+
+            records = list(iter_examples(run_directory, first_game_number=10))
+            self.assertEqual([record.game_number for record in records], list(range(10, 21)))
+            self.assertEqual([record.data for record in records], [str(number).encode() for number in range(10, 21)])
+            self.assertEqual([record.network_id for record in records[:2]], [network.id, None])
+
+    def test_upload_keeps_shards(self):
+        run_directory = os.path.join(settings.TRAINING_EXAMPLES_PATH, str(self.training_run.id))
+        os.makedirs(run_directory, exist_ok=True)
+        names = ['1.tar', '11.tar.gz', f'21{SHARD_SUFFIX}']
+        for name in names:
+            open(os.path.join(run_directory, name), 'wb').close()
+
+        with mock.patch('builtins.print'):
+            upload_examples()
+        self.assertEqual(os.listdir(run_directory), [f'21{SHARD_SUFFIX}'])
+
+    def test_broken_shard_is_rejected(self):
+        path = os.path.join(settings.TRAINING_EXAMPLES_PATH, f'broken{SHARD_SUFFIX}')
+        with open(path, 'wb') as f:
+            f.write(b'PPZT' + bytes(64))
+        with self.assertRaises(ShardError):
+            Shard(path)
+
+    def test_compaction_is_enqueued_after_commit(self):
+        with mock.patch.object(compact_examples.transaction, 'on_commit') as on_commit:
+            compact_examples.enqueue_compaction(self.training_run.id, [9])
+            on_commit.assert_not_called()
+            compact_examples.enqueue_compaction(self.training_run.id, [9, 10])
+            on_commit.assert_called_once()
+
+    def test_broker_errors_are_not_raised(self):
+        with mock.patch('core.tasks.task_compact_training_run.apply_async',
+                        side_effect=OperationalError('Connection refused.')) as apply_async:
+            compact_examples._send_compaction(self.training_run.id)
+        apply_async.assert_called_once()
+
+
+class RollupGamesTest(TestCase):
+    def setUp(self):
+        self.training_run = TrainingRun.objects.create(
+            field_width=FIELD_SIZE, field_height=FIELD_SIZE, training_parameters={}, match_parameters={})
+        self.minute = timezone.now().replace(second=0, microsecond=0) - timedelta(minutes=1)
+
+    def add_game(self, game_id):
+        TrainingGame.objects.create(id=game_id, training_run=self.training_run, game_number=game_id,
+                                    created_at=self.minute + timedelta(seconds=5))
+
+    def rolled_up(self):
+        return list(GameRollup.objects.filter(training_run=self.training_run).values_list('minute', 'games'))
+
+    def test_late_commits_are_counted_once(self):
+        self.add_game(1000010)
+        rollup_games()
+        self.assertEqual(self.rolled_up(), [(self.minute, 1)])
+
+        # committed after the rollup passed its id
+        self.add_game(1000005)
+        self.add_game(1000011)
+        rollup_games()
+        self.assertEqual(self.rolled_up(), [(self.minute, 3)])
+
+        rollup_games()
+        self.assertEqual(self.rolled_up(), [(self.minute, 3)])
+
+
+def spool_settings():
+    directory = tempfile.mkdtemp(prefix='ppz-spool-')
+    return {
+        'TRAINING_SGF_PATH': os.path.join(directory, 'sgf', 'training'),
+        'TRAINING_EXAMPLES_PATH': os.path.join(directory, 'examples'),
+        'MATCH_SGF_PATH': os.path.join(directory, 'sgf', 'matches'),
+        'INGEST': {**settings.INGEST, 'spool': True, 'spool_path': os.path.join(directory, 'spool'),
+                   'spool_fsync': False},
+    }
+
+
+@override_settings(**spool_settings())
+class SpoolReplayTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.training_run = TrainingRun.objects.create(
+            field_width=FIELD_SIZE, field_height=FIELD_SIZE, training_parameters={}, match_parameters={})
+        best, candidate = [
+            Network.objects.create(training_run=self.training_run, network_number=number, sha=str(number) * 64,
+                                   field_width=FIELD_SIZE, field_height=FIELD_SIZE)
+            for number in (1, 2)
+        ]
+        self.match = Match.objects.create(training_run=self.training_run, candidate=candidate, current_best=best,
+                                          parameters={}, games_to_finish=100, games_created=2)
+        self.match_games = [MatchGame.objects.create(match=self.match) for _ in range(2)]
+
+        for i in range(3):
+            self.client.post('/upload_training_game', {
+                'username': 'player', 'password': 'secret', 'training_run_id': self.training_run.id,
+                'network_id': best.id, 'training_game_sgf': upload('game.sgf', b'sgf %d' % i),
+                'training_example': upload('game.gz', b'example %d' % i),
+            }, format='multipart')
+        # the second upload of a game is dropped
+        for match_game in (*self.match_games, self.match_games[0]):
+            self.client.post('/upload_match_game', {
+                'username': 'player', 'password': 'secret', 'match_game_id': match_game.id, 'result': 1,
+                'match_game_sgf': upload('match.sgf', b'match sgf'),
+            }, format='multipart')
+        seal_stale_segments(0)
+
+    def assert_committed_once(self):
+        self.assertEqual(sorted(TrainingGame.objects.filter(training_run=self.training_run).values_list(
+            'game_number', flat=True)), [1, 2, 3])
+        self.match.refresh_from_db()
+        self.assertEqual(self.match.candidate_wins, 2)
+
+        examples = os.path.join(settings.TRAINING_EXAMPLES_PATH, str(self.training_run.id))
+        contents = set()
+        for game_number in (1, 2, 3):
+            with open(os.path.join(examples, f'{game_number}.gz'), 'rb') as f:
+                contents.add(f.read())
+        self.assertEqual(contents, {b'example 0', b'example 1', b'example 2'})
+
+    def test_uploads_wait_for_the_drain(self):
+        self.assertEqual(len(sealed_segments()), 1)
+        self.assertFalse(TrainingGame.objects.exists())
+
+    def test_replay_after_a_crash_commits_nothing_twice(self):
+        # the drain dies before the segment is removed
+        with mock.patch('core.scripts.drain_spool.remove_segment'):
+            drain_spool()
+        self.assert_committed_once()
+        self.assertEqual(len(sealed_segments()), 1)
+
+        drain_spool()
+        self.assert_committed_once()
+        self.assertEqual(sealed_segments(), [])
+        self.assertEqual([entry.name for entry in os.scandir(settings.INGEST['spool_path']) if entry.is_file()], [])
+
+    def test_replay_finalises_a_match_finished_before_a_crash(self):
+        Match.objects.filter(id=self.match.id).update(games_to_finish=2)
+        # the drain dies after committing the last games of the match
+        with mock.patch('core.scripts.drain_spool.finalise_match', side_effect=RuntimeError), \
+                self.assertRaises(RuntimeError):
+            drain_spool()
+        self.match.refresh_from_db()
+        self.assertFalse(self.match.done)
+
+        drain_spool()
+        self.match.refresh_from_db()
+        self.assertEqual((self.match.done, self.match.passed, self.match.candidate_wins), (True, True, 2))
+
+    def test_games_commit_with_their_counts(self):
+        with mock.patch('core.scripts.drain_spool.add_games_played', side_effect=RuntimeError), \
+                self.assertRaises(RuntimeError):
+            drain_spool()
+        self.assertFalse(TrainingGame.objects.exists())
+
+        # the numbers reserved by the failed drain stay a gap
+        drain_spool()
+        self.assertEqual(TrainingGame.objects.filter(training_run=self.training_run).count(), 3)
+        self.assertEqual(Network.objects.get(network_number=1, training_run=self.training_run).games_played, 3)
+
+
+class MatchesTest(TestCase):
+    def setUp(self):
+        self.training_run = TrainingRun.objects.create(
+            field_width=FIELD_SIZE, field_height=FIELD_SIZE, training_parameters={}, match_parameters={})
+        self.best, self.candidate = [
+            Network.objects.create(training_run=self.training_run, network_number=number, sha=str(number) * 64,
+                                   field_width=FIELD_SIZE, field_height=FIELD_SIZE)
+            for number in (1, 2)
+        ]
+        self.user = User.objects.create(username='player', password='!')
+
+    def create_match(self, parameters):
+        return Match.objects.create(training_run=self.training_run, candidate=self.candidate,
+                                    current_best=self.best, parameters=parameters,
+                                    games_to_finish=match_games_to_finish(parameters))
+
+    @override_settings(MATCHES={**settings.MATCHES, 'games_to_finish': 2})
+    def test_expired_leases_are_handed_out_again(self):
+        match = self.create_match({})
+        first, _ = lease_match_game(match.id, self.user)
+        second, _ = lease_match_game(match.id, self.user)
+
+        other = User.objects.create(username='other', password='!')
+        match_game, leased_until = lease_match_game(match.id, other)
+        self.assertIsNone(match_game)
+        self.assertEqual(leased_until, first.lease_expires_at)
+
+        MatchGame.objects.filter(id=second.id).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        match_game, _ = lease_match_game(match.id, other)
+        self.assertEqual(match_game.id, second.id)
+        self.assertEqual(match_game.user_id, other.id)
+        self.assertGreater(match_game.lease_expires_at, timezone.now())
+
+        # a finished game is never handed out again
+        record_match_game_result(first.id, match.id, 1)
+        MatchGame.objects.filter(id=first.id).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertIsNone(lease_match_game(match.id, other)[0])
+        self.assertEqual(Match.objects.values_list('games_created', flat=True).get(id=match.id), 2)
+
+    @override_settings(MATCHES={**settings.MATCHES, 'games_to_finish': 2})
+    def test_sprt_match_caps_unfinished_games(self):
+        match = self.create_match({'sprt': {}})
+        first, _ = lease_match_game(match.id, self.user)
+        lease_match_game(match.id, self.user)
+
+        match_game, leased_until = lease_match_game(match.id, self.user)
+        self.assertIsNone(match_game)
+        self.assertIsNotNone(leased_until)
+
+        record_match_game_result(first.id, match.id, 1)
+        match_game, _ = lease_match_game(match.id, self.user)
+        self.assertIsNotNone(match_game)
+        self.assertEqual(Match.objects.values_list('games_created', flat=True).get(id=match.id), 3)
+
+    def test_sprt_decisions(self):
+        sprt = settings.MATCHES['sprt']
+        self.assertIs(sprt_result(90, 30, 30, sprt['max_games'], sprt), True)
+        self.assertIs(sprt_result(40, 30, 80, sprt['max_games'], sprt), False)
+        # ten straight wins would pass without the minimum
+        self.assertIs(sprt_decision(10, 0, 0, sprt), True)
+        self.assertIsNone(sprt_result(10, 0, 0, sprt['max_games'], sprt))
+        # out of games and still undecided
+        self.assertIsNone(sprt_decision(150, 100, 150, sprt))
+        self.assertIs(sprt_result(150, 100, 150, sprt['max_games'], sprt), False)
+
+    def test_finalise_sprt_match_once(self):
+        TrainingRun.objects.filter(id=self.training_run.id).update(best_network=self.best)
+        match = self.create_match({'sprt': {}})
+        Match.objects.filter(id=match.id).update(candidate_wins=9, draws=3, best_wins=3)
+        self.assertIsNone(finalise_match(match.id))
+
+        Match.objects.filter(id=match.id).update(candidate_wins=90, draws=30, best_wins=30)
+        self.assertIs(finalise_match(match.id), True)
+        self.assertIsNone(finalise_match(match.id))
+        self.assertEqual(TrainingRun.objects.values_list('best_network_id', flat=True).get(id=self.training_run.id),
+                         self.candidate.id)
+
+    def test_sprt_false_positive_rate(self):
+        # equally strong networks are the hardest H0 case, elo0 = 0
+        sprt = settings.MATCHES['sprt']
+        rng = random.Random(1)
+        matches = 500
+        draw_rate = 0.1
+        passed = 0
+        for _ in range(matches):
+            wins = draws = losses = 0
+            result = None
+            while result is None:
+                outcome = rng.random()
+                if outcome < draw_rate:
+                    draws += 1
+                elif outcome < (1 + draw_rate) / 2:
+                    wins += 1
+                else:
+                    losses += 1
+                result = sprt_result(wins, draws, losses, sprt['max_games'], sprt)
+            passed += result
+
+        self.assertLessEqual(passed / matches, sprt['alpha'])
+
+
+class UpdateEloTest(TestCase):
+    def setUp(self):
+        self.training_run = TrainingRun.objects.create(
+            field_width=FIELD_SIZE, field_height=FIELD_SIZE, training_parameters={}, match_parameters={})
+        self.networks = [
+            Network.objects.create(training_run=self.training_run, network_number=number, sha=str(number) * 64,
+                                   field_width=FIELD_SIZE, field_height=FIELD_SIZE, elo=elo, elo_error=elo_error)
+            for number, elo, elo_error in ((1, 0.0, 30.0), (2, 100.0, 30.0), (3, 200.0, 30.0), (4, None, None))
+        ]
+        for best, candidate in zip(self.networks, self.networks[1:]):
+            Match.objects.create(training_run=self.training_run, candidate=candidate, current_best=best,
+                                 parameters={}, games_to_finish=20, candidate_wins=15, best_wins=5, done=True,
+                                 elo_processed=candidate.network_number < 4)
+
+    @override_settings(MATCHES={**settings.MATCHES, 'elo_history': 1})
+    def test_only_recent_matches_are_refitted(self):
+        with mock.patch('core.scripts.update_elo.render_collections'):
+            update_elo()
+
+        elos = [network.elo for network in Network.objects.filter(
+            training_run=self.training_run).order_by('network_number')]
+        # network 2 also played the match left out of the window, it keeps its rating as the anchor
+        self.assertEqual(elos[:2], [0.0, 100.0])
+        self.assertGreater(elos[3], elos[2])
+        self.assertFalse(Match.objects.filter(elo_processed=False).exists())
+
+
+class RatingTest(SimpleTestCase):
+    def setUp(self):
+        # a chain of candidate against best matches and some matches a few networks apart
+        rng = np.random.default_rng(1)
+        self.players = 200
+        self.elo = np.cumsum(rng.normal(20, 30, self.players))
+        self.elo -= self.elo[0]
+        earlier = rng.integers(0, self.players - 5, 100)
+        self.first = np.concatenate([np.arange(1, self.players), earlier + rng.integers(2, 6, 100)])
+        self.second = np.concatenate([np.arange(self.players - 1), earlier])
+
+    def expected_results(self, games):
+        score = 1 / (1 + 10 ** (-(self.elo[self.first] - self.elo[self.second]) / 400))
+        return games * score, np.zeros(len(self.first)), games * (1 - score)
+
+    def test_ratings_converge_to_the_true_ones(self):
+        wins, draws, losses = self.expected_results(4000)
+        ratings, errors, iterations = fit_ratings(self.players, self.first, self.second, wins, draws, losses,
+                                                  anchors={0: 0.0})
+        self.assertLess(np.abs(ratings - self.elo).max(), 5)
+        self.assertLessEqual(iterations, 5)
+        self.assertTrue(np.all(errors > 0))
+
+        # a warm start from the fit is already converged
+        refit, _, iterations = fit_ratings(self.players, self.first, self.second, wins, draws, losses,
+                                           initial=ratings, anchors={0: 0.0})
+        self.assertEqual(iterations, 1)
+        self.assertLess(np.abs(refit - ratings).max(), 0.01)
+
+    def test_clean_sweep_stays_finite(self):
+        ratings, errors, _ = fit_ratings(2, np.array([1]), np.array([0]), np.array([20.0]), np.array([0.0]),
+                                         np.array([0.0]), anchors={0: 0.0})
+        self.assertTrue(np.all(np.isfinite(ratings)) and np.all(np.isfinite(errors)))
+        self.assertGreater(ratings[1], 200)
@@ -0,0 +1,328 @@
+import hashlib
+import os
+import tarfile
+import tempfile
+import weakref
+import zlib
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+from prometheus_client import Counter
+from .files import temp_directory, remove_quietly
+
+# bounds memory used by gzip inflation of a single chunk
+INFLATE_CHUNK_SIZE = 1024 * 1024
+
+# served with the monitoring metrics from the default registry
+UPLOAD_BYTES = Counter('ppz_upload_bytes_total', 'Bytes of uploaded files streamed to disk.', ['field'])
+
+
+class StreamedUploadedFile(UploadedFile):
+    '''
+    Upload written to a temporary file in the temporary directory of the directory
+    it ends up in (see core.files), so save_as() is an atomic rename. The temporary
+    file is removed on close or garbage collection unless the upload was saved.
+    '''
+
+    def __init__(self, directory, name, content_type, charset, content_type_extra=None, inflate=False):
+        fd, path = tempfile.mkstemp(dir=temp_directory(directory))
+        super().__init__(os.fdopen(fd, 'w+b'), name, content_type, 0, charset, content_type_extra)
+        self._finalizer = weakref.finalize(self, remove_quietly, path)
+        self._path = path
+
+        self._sha256 = hashlib.sha256()
+        # hash of the gunzipped content, networks are identified by it
+        self._content_sha256 = hashlib.sha256() if inflate else None
+        self._inflater = zlib.decompressobj(16 + zlib.MAX_WBITS) if inflate else None
+        self.content_size = 0
+        self.corrupted = False
+
+    def temporary_file_path(self):
+        return self._path
+
+    @property
+    def sha256(self):
+        return self._sha256.hexdigest()
+
+    @property
+    def content_sha256(self):
+        if self._content_sha256 is None or self.corrupted or not self._inflater.eof:
+            return None
+        return self._content_sha256.hexdigest()
+
+    def write_chunk(self, data):
+        self.file.write(data)
+        self.size += len(data)
+        self._sha256.update(data)
+
+        if self._inflater is not None and not self.corrupted:
+            try:
+                self._inflate(data)
+            except zlib.error:
+                self.corrupted = True
+
+    def _inflate(self, data):
+        while data:
+            if self._inflater.eof:
+                # next member of a multi-member gzip file
+                data = self._inflater.unused_data + data
+                self._inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+            content = self._inflater.decompress(data, INFLATE_CHUNK_SIZE)
+            self._content_sha256.update(content)
+            self.content_size += len(content)
+            data = self._inflater.unconsumed_tail
+
+    def complete(self):
+        self.file.flush()
+        self.seek(0)
+
+    def save_as(self, path):
+        '''
+        Atomically moves the upload to path, replacing an existing file.
+        path must be on the same file system as the temporary file.
+        '''
+        self.file.flush()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self._path, path)
+        self._finalizer.detach()
+        self._path = path
+
+    def close(self):
+        self.file.close()
+        self._finalizer()
+
+
+class StreamedTarUpload:
+    '''
+    Plain tar archive whose regular members are written to StreamedUploadedFiles while the
+    upload streams in, so every member is written once and the archive itself never is.
+    Members are grouped by name without extension, e.g. 1.sgf with 1.gz.
+
+    error is set for an invalid archive or an unexpected member and truncated when a member
+    would start a group past max_groups; nothing is written after either.
+    '''
+
+    def __init__(self, name, directories, max_groups=None):
+        self.name = name
+        # member extension -> directory
+        self.directories = directories
+        self.max_groups = max_groups
+        # member name without extension -> {extension: StreamedUploadedFile}
+        self.groups = {}
+        self.error = None
+        self.truncated = False
+        self.size = 0
+
+        self._buffer = bytearray()
+        self._ended = False
+        # bytes of the current member left, padding included, and how many of them are data
+        self._remaining = 0
+        self._data_left = 0
+        self._write = None
+        self._on_end = None
+        # name from a GNU long name or pax header for the next member
+        self._next_name = None
+
+    def write_chunk(self, data):
+        self.size += len(data)
+        if self._ended or self.error is not None or self.truncated:
+            return
+
+        self._buffer += data
+        try:
+            self._parse()
+        except (tarfile.TarError, ValueError):
+            self._fail('Not a tar archive.')
+
+    def complete(self):
+        if not self._ended and self.error is None and not self.truncated:
+            self._fail('Truncated tar archive.')
+
+    def close(self):
+        for files in self.groups.values():
+            for upload in files.values():
+                upload.close()
+
+    def _parse(self):
+        while self._buffer:
+            if self._remaining:
+                data = bytes(self._buffer[:self._remaining])
+                del self._buffer[:len(data)]
+                self._remaining -= len(data)
+
+                if self._write is not None and self._data_left:
+                    self._write(data[:self._data_left])
+                self._data_left = max(0, self._data_left - len(data))
+
+                if not self._remaining:
+                    self._end_member()
+                continue
+
+            if len(self._buffer) < tarfile.BLOCKSIZE:
+                return
+
+            block = bytes(self._buffer[:tarfile.BLOCKSIZE])
+            del self._buffer[:tarfile.BLOCKSIZE]
+            if not any(block):
+                # end of archive marker
+                self._ended = True
+                self._buffer.clear()
+                return
+
+            self._start_member(tarfile.TarInfo.frombuf(block, tarfile.ENCODING, 'surrogateescape'))
+
+    def _start_member(self, info):
+        self._remaining = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        self._data_left = info.size
+        self._write = None
+        self._on_end = None
+
+        if info.type in (tarfile.GNUTYPE_LONGNAME, tarfile.XHDTYPE):
+            header = bytearray()
+            self._write = header.extend
+            self._on_end = lambda: self._read_name(info.type, bytes(header))
+        elif info.isreg():
+            name, self._next_name = self._next_name or info.name, None
+            self._write = self._open_member(name)
+            if self._write is None:
+                return
+        else:
+            self._next_name = None
+
+        if not self._remaining:
+            self._end_member()
+
+    def _end_member(self):
+        if self._on_end is not None:
+            self._on_end()
+        self._write = None
+        self._on_end = None
+
+    def _read_name(self, header_type, data):
+        if header_type == tarfile.GNUTYPE_LONGNAME:
+            self._next_name = data.split(b'\0', 1)[0].decode(tarfile.ENCODING, 'surrogateescape')
+            return
+
+        # pax records are "<length> <keyword>=<value>\n"
+        position = 0
+        while position < len(data):
+            length = int(data[position:data.index(b' ', position)])
+            keyword, _, value = data[data.index(b' ', position) + 1:position + length - 1].partition(b'=')
+            if keyword == b'path':
+                self._next_name = value.decode('utf-8', 'surrogateescape')
+            position += length
+
+    def _open_member(self, name):
+        base, extension = os.path.splitext(name)
+        if extension not in self.directories:
+            self._fail(f'Unexpected file {name} in the archive.')
+            return None
+
+        files = self.groups.get(base)
+        if files is None:
+            if self.max_groups is not None and len(self.groups) >= self.max_groups:
+                self.truncated = True
+                self._stop()
+                return None
+            files = self.groups[base] = {}
+        elif extension in files:
+            self._fail(f'Duplicate file {name} in the archive.')
+            return None
+
+        files[extension] = StreamedUploadedFile(self.directories[extension], os.path.basename(name),
+                                                'application/octet-stream', None)
+        return files[extension].write_chunk
+
+    def _fail(self, error):
+        self.error = error
+        self._stop()
+
+    def _stop(self):
+        self._buffer.clear()
+        self._write = None
+        self.close()
+        self.groups = {}
+
+
+class StreamingUploadHandler(FileUploadHandler):
+    '''
+    Streams the given file fields to disk chunk by chunk, hashing them on the way,
+    and splits the given tar fields into their members. Other fields are passed to the next handlers.
+    '''
+
+    def __init__(self, request=None, directories=None, inflate_fields=(), archives=None, archive_max_groups=None):
+        super().__init__(request)
+        # file field -> directory the upload ends up in
+        self.directories = directories or {}
+        self.inflate_fields = set(inflate_fields)
+        # tar field -> member extension -> directory the member ends up in
+        self.archives = archives or {}
+        self.archive_max_groups = archive_max_groups
+        self.upload = None
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+
+        if field_name in self.archives:
+            self.upload = StreamedTarUpload(self.file_name, self.archives[field_name], self.archive_max_groups)
+            raise StopFutureHandlers()
+
+        directory = self.directories.get(field_name)
+        if directory is None:
+            self.upload = None
+            return
+
+        self.upload = StreamedUploadedFile(directory, self.file_name, self.content_type, self.charset,
+                                           self.content_type_extra, inflate=field_name in self.inflate_fields)
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.upload is None:
+            return raw_data
+
+        self.upload.write_chunk(raw_data)
+
+    def file_complete(self, file_size):
+        upload, self.upload = self.upload, None
+        if upload is not None:
+            upload.complete()
+            UPLOAD_BYTES.labels(self.field_name).inc(file_size)
+        return upload
+
+    def upload_interrupted(self):
+        if self.upload is not None:
+            self.upload.close()
+            self.upload = None
+
+
+class StreamingUploadMixin:
+    '''
+    APIView mixin that streams the file fields listed in upload_directories
+    to the directories named by the corresponding settings, and the members of
+    tar fields listed in upload_archives likewise (see StreamedTarUpload).
+    '''
+    # file field -> name of the setting with the destination directory
+    upload_directories = {}
+    # file fields whose gunzipped content is hashed too
+    inflate_fields = ()
+    # tar field -> member extension -> name of the setting with the destination directory
+    upload_archives = {}
+
+    def get_upload_directories(self):
+        return {field: getattr(settings, name) for field, name in self.upload_directories.items()}
+
+    def get_archive_max_groups(self):
+        return None
+
+    def initialize_request(self, request, *args, **kwargs):
+        directories = self.get_upload_directories()
+        archives = {
+            field: {extension: getattr(settings, name) for extension, name in members.items()}
+            for field, members in self.upload_archives.items()
+        }
+        request.upload_handlers = [
+            StreamingUploadHandler(request, directories, self.inflate_fields, archives, self.get_archive_max_groups()),
+            *request.upload_handlers
+        ]
+        return super().initialize_request(request, *args, **kwargs)
@@ -1,13 +1,25 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from .models import TrainingGame, User, Match, MatchGame, TrainingRun, Network
+from .scheduler import scheduler
+from .matches import (lease_match_game, record_match_game_result, finalise_match, match_games_to_finish,
+                      MATCH_RESULT_FIELDS)
+from .counters import game_counters
+from .uploadhandlers import StreamingUploadMixin, StreamedUploadedFile
+from .delta import xor_stream, DeltaError
+from .network_cache import network_cache
+from .downloads import blob_response, sendfile_response
+from .spool import spool
+from .scripts.compact_examples import enqueue_compaction
+from .sampler import sample_batches, encode_batch
 from rest_framework.exceptions import ValidationError
 from rest_framework.parsers import MultiPartParser, JSONParser
 import gzip
-import hashlib
+from collections import Counter
 from django.conf import settings
-from django.http import FileResponse, HttpResponseRedirect
+from django.http import HttpResponseRedirect, StreamingHttpResponse
 from django.core.exceptions import ObjectDoesNotExist
+import itertools
 import os
 
 # TODO https://docs.djangoproject.com/en/3.0/topics/db/optimization/
@@ -36,33 +48,32 @@ class NextGameView(APIView):
     def post(self, request, *args, **kwargs):
         user = check_user(request)
 
-        training_run = TrainingRun.objects.select_related('best_network').filter(active=True).order_by('?').first()
+        training_run = scheduler.choose_training_run(user.id)
 
         if training_run is None:
             return Response({'error': 'No active training runs.'})
 
-        # узнал, что невозможно сохранить
-        user.assigned_training_run = training_run
-        user.save(update_fields=['assigned_training_run'])
+        # assignment is sticky, so this write happens only when the set of runs changes
+        if user.assigned_training_run_id != training_run.id:
+            user.assigned_training_run_id = training_run.id
+            user.save(update_fields=['assigned_training_run'])
 
-        match = Match.objects.filter(training_run=training_run, done=False).first()
-
-        if match:
-            match_game = MatchGame.objects.create(user=user, match=match)
-            candidate_turns_first = bool(match_game.id % 2)
-
-            match_game.candidate_turns_first = candidate_turns_first
-            match_game.save()
+        for match in scheduler.open_matches(training_run):
+            match_game, leased_until = lease_match_game(match.id, user)
+            if match_game is None:
+                # every game is in progress, fall through to training until a lease expires
+                scheduler.mark_leased(match.id, leased_until)
+                continue
 
             result = {
                 'game_type': 'match',
                 'match_game_id': match_game.id,
-                'best_network_sha': match.current_best.sha,
-                'candidate_sha': match.candidate.sha,
+                'best_network_sha': match.current_best_sha,
+                'candidate_sha': match.candidate_sha,
                 'parameters': match.parameters,
                 'field_width': training_run.field_width,
                 'field_height': training_run.field_height,
-                'candidate_turns_first': candidate_turns_first
+                'candidate_turns_first': match_game.candidate_turns_first
             }
 
             return Response(result)
@@ -70,8 +81,8 @@ class NextGameView(APIView):
         result = {
             'game_type': 'train',
             'training_run_id': training_run.id,
-            'network_id': training_run.best_network.id,
-            'best_network_sha': training_run.best_network.sha,
+            'network_id': training_run.best_network_id,
+            'best_network_sha': training_run.best_network_sha,
             'parameters': training_run.training_parameters,
             'field_width': training_run.field_width,
             'field_height': training_run.field_height,
@@ -81,8 +92,10 @@ class NextGameView(APIView):
         return Response(result)
 
 
-class UploadNetworkView(APIView):
+class UploadNetworkView(StreamingUploadMixin, APIView):
     parser_classes = [MultiPartParser]
+    upload_directories = {'network': 'NETWORKS_PATH'}
+    inflate_fields = ['network']
 
     def post(self, request):
         # TODO make upload possible only for admins
@@ -90,28 +103,29 @@ class UploadNetworkView(APIView):
         if new_network_file is None:
             raise ValidationError({'error': 'Need network file.'})
 
-        # TODO error handle not a gziped file
         prev_network_sha = request.data.get('prev_delta_sha', None)
         if prev_network_sha is not None:
-            prev_network = Network.objects.filter(sha=prev_network_sha).first()
-
-            if prev_network is None:
+            if not Network.objects.filter(sha=prev_network_sha).exists():
                 raise ValidationError({'error': 'Unknown previous network'})
 
-            try:
-                prevData = gzip.open(prev_network.file.name).read()
-            except OSError:
-                raise ValidationError({'error': 'Corrupted previous network.'})
+            # uploaded file is a delta, rebuild the full network next to its final location
+            delta_file = new_network_file
+            new_network_file = StreamedUploadedFile(settings.NETWORKS_PATH, delta_file.name, delta_file.content_type, None)
 
-            deltaData = gzip.decompress(new_network_file.read())
-            print(len(prevData), len(deltaData))
-            if len(prevData) != len(deltaData):
-                raise ValidationError({'error': "Data lengths don't match."})
-
-            changes = bytes(p ^ d for d, p in zip(deltaData, prevData))
-            sha = hashlib.sha256(changes).hexdigest()
+            try:
+                with network_cache.open(prev_network_sha) as prev_file, \
+                        gzip.open(delta_file) as delta_data, \
+                        gzip.open(new_network_file.file, 'wb') as output:
+                    sha = xor_stream(prev_file, delta_data, output)
+            except DeltaError as e:
+                raise ValidationError({'error': str(e)})
+            except (OSError, EOFError):
+                raise ValidationError({'error': 'Corrupted previous network or delta.'})
         else:
-            sha = hashlib.sha256(gzip.decompress(new_network_file.read())).hexdigest()
+            # hashed while the upload was streamed to disk
+            sha = new_network_file.content_sha256
+            if sha is None:
+                raise ValidationError({'error': 'Network file is not a gzip file.'})
 
         if Network.objects.filter(sha=sha).exists():
             raise ValidationError({'error': "Network exists."})
@@ -137,13 +151,16 @@ class UploadNetworkView(APIView):
         )
 
         # save new network file
-        if settings.CLOUD_STOREAGE:
-            settings.S3.upload_fileobj(new_network_file, settings.S3_NETWORKS_BUCKET_NAME, sha+'.gz')
+        if settings.CLOUD_STORAGE:
+            # a rebuilt network may still be buffered, the local copy is not needed afterwards
+            new_network_file.complete()
+            try:
+                settings.S3.upload_file(new_network_file.temporary_file_path(),
+                                        settings.S3_NETWORKS_BUCKET_NAME, sha+'.gz')
+            finally:
+                new_network_file.close()
         else:
-            network_path = os.path.join(settings.NETWORKS_PATH, sha + '.gz')
-            os.makedirs(os.path.dirname(network_path), exist_ok=True)
-            with open(network_path, 'wb') as f:
-                f.write(new_network_file.read())
+            new_network_file.save_as(os.path.join(settings.NETWORKS_PATH, sha + '.gz'))
 
         # create match
         best_network = training_run.best_network
@@ -152,7 +169,7 @@ class UploadNetworkView(APIView):
 
         Match.objects.create(training_run=training_run, candidate=new_network, current_best=best_network,
                              parameters=training_run.match_parameters,
-                             games_to_finish=settings.MATCHES['games_to_finish'])
+                             games_to_finish=match_games_to_finish(training_run.match_parameters))
 
         # regression check
         # prev_network1 = training_run.networks.filter(network_number=best_network.network_number - 3).first()
@@ -168,8 +185,23 @@ class UploadNetworkView(APIView):
         return Response({'message': 'Network uploaded successfully.'})
 
 
-class UploadTrainingGameView(APIView):
+class SpooledUploadMixin(StreamingUploadMixin):
+    '''
+    Streams uploads into the spool when INGEST['spool'] is set, spool.append() takes them from there.
+    '''
+
+    def get_upload_directories(self):
+        if settings.INGEST['spool']:
+            return {field: settings.INGEST['spool_path'] for field in self.upload_directories}
+        return super().get_upload_directories()
+
+
+class UploadTrainingGameView(SpooledUploadMixin, APIView):
     parser_classes = [MultiPartParser]
+    upload_directories = {
+        'training_game_sgf': 'TRAINING_SGF_PATH',
+        'training_example': 'TRAINING_EXAMPLES_PATH',
+    }
 
     def post(self, request):
         user = check_user(request)
@@ -183,11 +215,6 @@ class UploadTrainingGameView(APIView):
         except ValueError:
             raise ValidationError({'error': 'Training run id need to be an integer.'})
 
-        try:
-            training_run = TrainingRun.objects.get(id=training_run_id)
-        except ObjectDoesNotExist:
-            raise ValidationError({'error': 'Invalid training id.'})
-
         network_id = request.data.get('network_id', None)
         if network_id is None:
             raise ValidationError({'error': 'Provide network id.'})
@@ -197,11 +224,6 @@ class UploadTrainingGameView(APIView):
         except ValueError:
             raise ValidationError({'error': 'Network id need to be an integer.'})
 
-        try:
-            network = Network.objects.get(id=network_id)
-        except ObjectDoesNotExist:
-            raise ValidationError({'error': 'Invalid network id.'})
-
         training_game_sgf = request.FILES.get('training_game_sgf', None)
         if training_game_sgf is None:
             raise ValidationError({'error': 'Need a training game sgf.'})
@@ -210,38 +232,159 @@ class UploadTrainingGameView(APIView):
         if training_example is None:
             raise ValidationError({'error': 'Need a training example.'})
 
-        network.games_played += 1
-        network.save(update_fields=['games_played'])
-        training_run.last_game += 1
-        training_run.save(update_fields=['last_game'])
+        # ids are checked when the spool is drained
+        if settings.INGEST['spool']:
+            spool.append('training_game', {
+                'user_id': user.id,
+                'training_run_id': training_run_id,
+                'network_id': network_id,
+            }, {
+                'training_game_sgf': training_game_sgf,
+                'training_example': training_example,
+            })
+            return Response({'message': 'Training game uploaded successfully.'})
+
+        if not Network.objects.filter(id=network_id, training_run_id=training_run_id).exists():
+            raise ValidationError({'error': 'Invalid network id.'})
+
+        # reservation also checks that the training run exists
+        try:
+            game_number, = game_counters.next_game_numbers(training_run_id)
+        except ObjectDoesNotExist:
+            raise ValidationError({'error': 'Invalid training id.'})
 
-        training_game = TrainingGame.objects.create(user=user, training_run=training_run,
-                                                    network=network, game_number=training_run.last_game)
+        game_counters.count_games(network_id)
 
-        # save sgf
-        sgf_path = os.path.join(settings.TRAINING_SGF_PATH, str(training_run.id), str(training_run.last_game) + '.sgf')
-        os.makedirs(os.path.dirname(sgf_path), exist_ok=True)
-        with open(sgf_path, 'wb') as f:
-            f.write(training_game_sgf.read())
-
-        # save example
-        example_path = os.path.join(settings.TRAINING_EXAMPLES_PATH,
-                                    str(training_run.id), str(training_run.last_game) + '.gz')
-        os.makedirs(os.path.dirname(example_path), exist_ok=True)
-        with open(example_path, 'wb') as f:
-            f.write(training_example.read())
+        # files are already on disk, move them in place before the row makes them visible to compaction
+        training_game_sgf.save_as(os.path.join(settings.TRAINING_SGF_PATH, str(training_run_id),
+                                               str(game_number) + '.sgf'))
+        training_example.save_as(os.path.join(settings.TRAINING_EXAMPLES_PATH, str(training_run_id),
+                                              str(game_number) + '.gz'))
+
+        TrainingGame.objects.create(user=user, training_run_id=training_run_id,
+                                    network_id=network_id, game_number=game_number)
+        enqueue_compaction(training_run_id, [game_number])
 
         return Response({'message': 'Training game uploaded successfully.'})
 
 
+class UploadTrainingGamesView(StreamingUploadMixin, APIView):
+    '''
+    Uploads a batch of training games in one request: either repeated training_game_sgf and
+    training_example fields (n-th sgf goes with n-th example) or an uncompressed tar file in the
+    games field with <name>.sgf and <name>.gz members. network_id is given once or once per game.
+    '''
+    parser_classes = [MultiPartParser]
+    upload_directories = {
+        'training_game_sgf': 'TRAINING_SGF_PATH',
+        'training_example': 'TRAINING_EXAMPLES_PATH',
+    }
+    upload_archives = {
+        'games': {'.sgf': 'TRAINING_SGF_PATH', '.gz': 'TRAINING_EXAMPLES_PATH'},
+    }
+
+    def get_archive_max_groups(self):
+        return settings.INGEST['batch_max_games']
+
+    def post(self, request):
+        user = check_user(request)
+
+        training_run_id = request.data.get('training_run_id', None)
+        if training_run_id is None:
+            raise ValidationError({'error': 'Need training run id.'})
+
+        try:
+            training_run_id = int(training_run_id)
+        except ValueError:
+            raise ValidationError({'error': 'Training run id need to be an integer.'})
+
+        games_file = request.FILES.get('games', None)
+        if games_file is not None:
+            games = self.games_tar_files(games_file)
+        else:
+            sgfs = request.FILES.getlist('training_game_sgf')
+            examples = request.FILES.getlist('training_example')
+            if len(sgfs) != len(examples):
+                raise ValidationError({'error': 'Need a training example for every training game sgf.'})
+            games = list(zip(sgfs, examples))
+
+        if not games:
+            raise ValidationError({'error': 'Need at least one training game.'})
+
+        if len(games) > settings.INGEST['batch_max_games']:
+            raise ValidationError({'error': f"At most {settings.INGEST['batch_max_games']} games in a batch."})
+
+        network_ids = request.data.getlist('network_id')
+        if len(network_ids) == 1:
+            network_ids *= len(games)
+        if len(network_ids) != len(games):
+            raise ValidationError({'error': 'Provide one network id or one per game.'})
+
+        try:
+            network_ids = [int(network_id) for network_id in network_ids]
+        except ValueError:
+            raise ValidationError({'error': 'Network id need to be an integer.'})
+
+        if Network.objects.filter(id__in=set(network_ids),
+                                  training_run_id=training_run_id).count() != len(set(network_ids)):
+            raise ValidationError({'error': 'Invalid network id.'})
+
+        # one reservation for the whole batch, it also checks that the training run exists
+        try:
+            game_numbers = game_counters.next_game_numbers(training_run_id, len(games))
+        except ObjectDoesNotExist:
+            raise ValidationError({'error': 'Invalid training id.'})
+
+        for network_id, count in Counter(network_ids).items():
+            game_counters.count_games(network_id, count)
+
+        # files are already on disk, move them in place before the rows make them visible to compaction
+        for (training_game_sgf, training_example), game_number in zip(games, game_numbers):
+            training_game_sgf.save_as(os.path.join(settings.TRAINING_SGF_PATH, str(training_run_id),
+                                                   str(game_number) + '.sgf'))
+            training_example.save_as(os.path.join(settings.TRAINING_EXAMPLES_PATH, str(training_run_id),
+                                                  str(game_number) + '.gz'))
+
+        TrainingGame.objects.bulk_create([
+            TrainingGame(user=user, training_run_id=training_run_id, network_id=network_id, game_number=game_number)
+            for network_id, game_number in zip(network_ids, game_numbers)
+        ])
+        enqueue_compaction(training_run_id, game_numbers)
+
+        return Response({'message': 'Training games uploaded successfully.', 'game_numbers': game_numbers})
+
+    @staticmethod
+    def games_tar_files(games_file):
+        '''
+        :param games_file: StreamedTarUpload, its members are already on disk.
+        :return: list of (sgf, example) StreamedUploadedFile pairs in archive order.
+        '''
+        if games_file.error is not None:
+            raise ValidationError({'error': f'Invalid games archive: {games_file.error}'})
+
+        # members past the limit were not written
+        if games_file.truncated:
+            raise ValidationError({'error': f"At most {settings.INGEST['batch_max_games']} games in a batch."})
+
+        if any(len(files) != 2 for files in games_file.groups.values()):
+            raise ValidationError({'error': 'Need a training example for every training game sgf.'})
+
+        return [(files['.sgf'], files['.gz']) for files in games_file.groups.values()]
+
+
 class DownloadNetworkView(APIView):
-    def get(self, request):
-        sha = request.data.get('sha', None)
+    def get(self, request, sha=None):
+        # old clients send sha in the query or body of download_network
+        immutable = sha is not None or 'sha' in request.query_params
+        if sha is None:
+            sha = request.query_params.get('sha', None) or request.data.get('sha', None)
         if sha is None:
             raise ValidationError({'error': 'No sha.'})
 
-        network = Network.objects.filter(sha=sha).first()
-        if network is None:
+        # only shas of known networks become file names
+        have_sha = request.query_params.get('have_sha', None)
+        known_shas = set(Network.objects.filter(sha__in=[sha, have_sha]).values_list('sha', flat=True))
+        if sha not in known_shas:
             raise ValidationError({'error': 'Invalid sha.'})
 
         filename = sha + '.gz'
@@ -256,12 +399,78 @@ class DownloadNetworkView(APIView):
             )
             return HttpResponseRedirect(url)
 
-        network_file = open(os.path.join(settings.NETWORKS_PATH, filename), 'rb')
-        return FileResponse(network_file, filename=network_file.name)
+        # client that has a network of the same architecture only needs the changed bits
+        if have_sha in known_shas and have_sha != sha:
+            try:
+                delta_path = network_cache.delta_path(have_sha, sha)
+            except FileNotFoundError:
+                delta_path = None
+
+            if delta_path is not None:
+                return self.delta_response(request, delta_path, have_sha, sha, immutable)
 
+        if settings.NETWORK_DOWNLOADS['sendfile']:
+            return sendfile_response(request, os.path.join(settings.NETWORKS_PATH, filename), sha, filename,
+                                     immutable=immutable)
 
-class UploadMatchGameView(APIView):
+        try:
+            data = network_cache.get_compressed(sha)
+        except FileNotFoundError:
+            raise ValidationError({'error': 'Invalid sha.'})
+
+        return blob_response(request, data, sha, filename, immutable=immutable)
+
+    @staticmethod
+    def delta_response(request, delta_path, have_sha, sha, immutable):
+        filename = os.path.basename(delta_path)
+        etag = f'{have_sha}_{sha}'
+
+        if settings.NETWORK_DOWNLOADS['sendfile']:
+            response = sendfile_response(request, delta_path, etag, filename, immutable=immutable)
+        else:
+            with open(delta_path, 'rb') as f:
+                response = blob_response(request, f.read(), etag, filename, immutable=immutable)
+
+        # gunzipped body XOR have_sha network is the requested network
+        response['X-Delta-From'] = have_sha
+        return response
+
+
+class SampleExamplesView(APIView):
+    '''
+    Streams batches of positions sampled from the window of a training run, see core.sampler.
+    Every batch is a 4 byte big endian position count followed by length-prefixed positions.
+    '''
+    def get(self, request):
+        training_run_id = request.query_params.get('training_run_id', None)
+        if training_run_id is None:
+            raise ValidationError({'error': 'Need training run id.'})
+
+        try:
+            training_run_id = int(training_run_id)
+            batch_size = int(request.query_params.get('batch_size', settings.SAMPLER['batch_size']))
+            batches = int(request.query_params.get('batches', settings.SAMPLER['max_batches']))
+        except ValueError:
+            raise ValidationError({'error': 'Training run id, batch size and batches need to be integers.'})
+
+        if not 0 < batch_size <= settings.SAMPLER['max_batch_size']:
+            raise ValidationError({'error': f"Batch size must be from 1 to {settings.SAMPLER['max_batch_size']}."})
+
+        # a request holds a worker while it streams
+        if not 0 < batches <= settings.SAMPLER['max_batches']:
+            raise ValidationError({'error': f"Batches must be from 1 to {settings.SAMPLER['max_batches']}."})
+
+        if not TrainingRun.objects.filter(id=training_run_id).exists():
+            raise ValidationError({'error': 'Invalid training id.'})
+
+        # ends early if the window has no readable games
+        stream = (encode_batch(batch) for batch in itertools.islice(sample_batches(training_run_id, batch_size), batches))
+        return StreamingHttpResponse(stream, content_type='application/octet-stream')
+
+
+class UploadMatchGameView(SpooledUploadMixin, APIView):
     parser_classes = [MultiPartParser]
+    upload_directories = {'match_game_sgf': 'MATCH_SGF_PATH'}
 
     def post(self, request):
         user = check_user(request)
@@ -280,11 +489,6 @@ class UploadMatchGameView(APIView):
         except ValueError:
             raise ValidationError({'error': 'Match game id need to be an integer.'})
 
-        match_game = MatchGame.objects.select_related(
-            'match', 'match__training_run').filter(id=match_game_id).first()
-        if match_game is None:
-            raise ValidationError({'error': 'Invalid match game.'})
-
         result = request.data.get('result', None)
 
         if result is None:
@@ -295,55 +499,39 @@ class UploadMatchGameView(APIView):
         except ValueError:
             raise ValidationError({'error': 'Result need to be an integer.'})
 
-        match = match_game.match
-        if result == 0:
-            match.draws += 1
-            update_fields = ['draws']
-        elif result == -1:
-            match.best_wins += 1
-            update_fields = ['best_wins']
-        elif result == 1:
-            match.candidate_wins += 1
-            update_fields = ['candidate_wins']
-        else:
+        if result not in MATCH_RESULT_FIELDS:
             raise ValidationError({'error': 'Bad result.'})
 
-        match_game.result = result
-        match_game.done = True
-
-        match_game.save(update_fields=['result', 'done'])
-
-        # save sgf
-        sgf_path = os.path.join(settings.MATCH_SGF_PATH, str(match.training_run_id),
-                                str(match.id), str(match_game.id) + '.sgf')
-        os.makedirs(os.path.dirname(sgf_path), exist_ok=True)
+        # games of unknown or done matches are dropped when the spool is drained
+        if settings.INGEST['spool']:
+            spool.append('match_game', {
+                'user_id': user.id,
+                'match_game_id': match_game_id,
+                'result': result,
+            }, {
+                'match_game_sgf': match_game_sgf,
+            })
+            return Response({'message': 'Match game uploaded successfully.'})
+
+        match_game = MatchGame.objects.select_related('match').filter(id=match_game_id).first()
+        if match_game is None:
+            raise ValidationError({'error': 'Invalid match game.'})
 
-        with open(sgf_path, 'wb') as f:
-            f.write(match_game_sgf.read())
+        if match_game.done:
+            raise ValidationError({'error': 'Match game already is done.'})
 
+        match = match_game.match
         if match.done:
             raise ValidationError({'error': 'Match already is done.'})
 
-        games_count = match.candidate_wins + match.best_wins + match.draws
-
-        if games_count >= match.games_to_finish:
-            match.done = True
+        # checks above are only a shortcut, this one is race-free
+        if not record_match_game_result(match_game.id, match.id, result):
+            raise ValidationError({'error': 'Match game or match already is done.'})
 
-            w = match.candidate_wins/games_count
-            d = match.draws/games_count
-
-            mu = w + d/2
-
-            passed = mu >= settings.MATCHES['update_threshold']
-
-            match.passed = passed
-
-            if passed:
-                match.training_run.best_network = match.candidate
-                match.training_run.save()
-
-            update_fields += ['done', 'passed']
+        # save sgf
+        match_game_sgf.save_as(os.path.join(settings.MATCH_SGF_PATH, str(match.training_run_id),
+                                            str(match.id), str(match_game.id) + '.sgf'))
 
-        match.save(update_fields=update_fields)
+        finalise_match(match.id)
 
         return Response({'message': 'Match game uploaded successfully.'})
@@ -0,0 +1,76 @@
+'''
+Cache of serialized monitoring responses. Keys carry the versions of the topics a view
+depends on, and saving networks, matches, training runs or game rollups bumps those versions,
+see monitoring.signals. Versions live in the cache backend,
+so web and Celery processes must share it (Redis, see CACHES).
+'''
+import hashlib
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from rest_framework.renderers import JSONRenderer
+from core.downloads import etag_matches
+
+NETWORKS = 'networks'
+MATCHES = 'matches'
+TRAINING_RUNS = 'training_runs'
+# per minute game rollups
+GAMES = 'games'
+
+KEY_PREFIX = 'monitoring'
+
+
+def _version_key(topic):
+    return f'{KEY_PREFIX}:version:{topic}'
+
+
+def bump_versions(*topics):
+    for topic in topics:
+        try:
+            cache.incr(_version_key(topic))
+        except ValueError:
+            # evicted or never read, a fresh version can't collide with an old one
+            cache.set(_version_key(topic), time.time_ns(), None)
+
+
+def topic_versions(topics):
+    keys = [_version_key(topic) for topic in topics]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, time.time_ns(), None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+class CachedResponseMixin:
+    '''
+    APIView mixin that answers GET from the cache with get_data(request, *args, **kwargs)
+    as the fallback. Responses carry an ETag of the body, so polling with If-None-Match gets 304.
+    Data not covered by a topic, such as game counters of networks, is stale for at most
+    MONITORING_CACHE['timeout'] seconds.
+    '''
+    cache_topics = ()
+
+    def get(self, request, *args, **kwargs):
+        versions = '.'.join(map(str, topic_versions(self.cache_topics)))
+        path = hashlib.sha1(request.get_full_path().encode()).hexdigest()
+        key = f'{KEY_PREFIX}:response:{path}:{versions}'
+
+        entry = cache.get(key)
+        if entry is None:
+            body = JSONRenderer().render(self.get_data(request, *args, **kwargs))
+            entry = (hashlib.sha1(body).hexdigest(), body)
+            cache.set(key, entry, settings.MONITORING_CACHE['timeout'])
+
+        etag, body = entry
+        quoted_etag = f'"{etag}"'
+        if etag_matches(request.META.get('HTTP_IF_NONE_MATCH'), quoted_etag):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(body, content_type='application/json')
+
+        response['ETag'] = quoted_etag
+        response['Cache-Control'] = 'no-cache'
+        return response
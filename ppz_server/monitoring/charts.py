@@ -0,0 +1,110 @@
+'''
+Progress chart of a training run: Elo of rated networks against the games played up to them.
+The running total is a window function over the rated networks, so only the requested
+page leaves the database, and pages are downsampled to a fixed number of points.
+'''
+from django.db import connection
+from core.models import Network
+
+CHART_FIELDS = ('network_number', 'elo', 'games_played')
+
+
+def parse_cursor(after):
+    '''
+    :param after: chart_next of the previous page, '<network number>:<network id>',
+        or a network number to start after all networks with that number.
+    :return: (network number, network id or None)
+    :raises ValueError: malformed cursor.
+    '''
+    network_number, _, network_id = after.partition(':')
+    return int(network_number), int(network_id) if network_id else None
+
+
+def progress_chart(training_run_id, after=None, limit=None, points=None, downsample='lttb'):
+    '''
+    :param after: (network number, network id) the previous page ended with, see parse_cursor.
+        Pages are keyed by both, network numbers of a run are not unique.
+    :param limit: rated networks in the page, all after the cursor if None.
+    :param points: downsample the page to this many points, first and last network are kept.
+    :param downsample: 'lttb' keeps the shape of the curve, 'step' takes evenly spaced networks.
+    :return: (list of dicts of CHART_FIELDS, cursor to pass as after for the next page or None)
+    '''
+    table = Network._meta.db_table
+    # networks without games still count as one, like the old chart did
+    query = f'''
+        SELECT network_number, elo, games_played, id FROM (
+            SELECT id, network_number, elo, SUM(GREATEST(games_played, 1)) OVER (ORDER BY network_number, id) AS games_played
+            FROM {table} WHERE training_run_id = %s AND elo IS NOT NULL
+        ) AS rated
+    '''
+    parameters = [training_run_id]
+    if after is not None:
+        after_number, after_id = after
+        if after_id is None:
+            query += ' WHERE network_number > %s'
+            parameters.append(after_number)
+        else:
+            query += ' WHERE (network_number, id) > (%s, %s)'
+            parameters.extend([after_number, after_id])
+    query += ' ORDER BY network_number, id'
+    if limit is not None:
+        # one more row tells whether there is a next page
+        query += ' LIMIT %s'
+        parameters.append(limit + 1)
+
+    with connection.cursor() as cursor:
+        cursor.execute(query, parameters)
+        rows = cursor.fetchall()
+
+    next_after = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_after = f'{rows[-1][0]}:{rows[-1][3]}'
+
+    if points is not None:
+        rows = lttb(rows, points) if downsample == 'lttb' else every_kth(rows, points)
+
+    return [dict(zip(CHART_FIELDS, row)) for row in rows], next_after
+
+
+def every_kth(rows, points):
+    '''
+    :return: points rows evenly spaced over rows, including the first and the last one.
+    '''
+    if len(rows) <= points:
+        return rows
+    if points < 2:
+        return rows[-points:] if points else []
+
+    step = (len(rows) - 1) / (points - 1)
+    return [rows[round(i * step)] for i in range(points)]
+
+
+def lttb(rows, points):
+    '''
+    Largest-Triangle-Three-Buckets downsampling of (network_number, elo, games_played, ...) rows,
+    games played on the x axis and Elo on the y axis.
+    :return: points rows including the first and the last one.
+    '''
+    if len(rows) <= points or points < 3:
+        return every_kth(rows, points)
+
+    bucket = (len(rows) - 2) / (points - 2)
+    sampled = [rows[0]]
+    previous = rows[0]
+    for i in range(points - 2):
+        start = int(i * bucket) + 1
+        end = int((i + 1) * bucket) + 1
+
+        # average point of the next bucket, the last row for the last bucket
+        next_bucket = rows[end:min(int((i + 2) * bucket) + 1, len(rows))]
+        average_x = sum(row[2] for row in next_bucket) / len(next_bucket)
+        average_y = sum(row[1] for row in next_bucket) / len(next_bucket)
+
+        previous_y, previous_x = previous[1], previous[2]
+        previous = max(rows[start:end], key=lambda row: abs(
+            (previous_x - average_x) * (row[1] - previous_y) - (previous_x - row[2]) * (average_y - previous_y)))
+        sampled.append(previous)
+
+    sampled.append(rows[-1])
+    return sampled
@@ -0,0 +1,113 @@
+'''
+Prometheus metrics of web and Celery processes, served by MetricsView at /metrics.
+
+Metrics of core modules, such as core.uploadhandlers.UPLOAD_BYTES, are registered in the
+default registry too. Gunicorn workers and Celery pool processes each keep their own samples. Set the
+PROMETHEUS_MULTIPROC_DIR environment variable to an empty directory shared by all of them
+before they start, and the endpoint merges the samples of every process from there.
+'''
+import os
+import time
+from celery.signals import task_prerun, task_postrun
+from django.db import connection
+from django.db.models import F, Sum
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+REQUEST_DURATION = Histogram('ppz_request_duration_seconds', 'Time to build a response.', ['view', 'method', 'status'])
+DB_QUERIES = Counter('ppz_db_queries_total', 'Database queries.', ['operation'])
+DB_QUERY_DURATION = Counter('ppz_db_query_seconds_total', 'Time spent in database queries.', ['operation'])
+TASK_DURATION = Histogram('ppz_task_duration_seconds', 'Celery task run time.', ['task', 'state'],
+                          buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, float('inf')))
+
+
+class QueryTimer:
+    '''
+    Database execute wrapper counting queries and their time under an operation label,
+    the view or task name.
+    '''
+
+    def __init__(self, operation):
+        self.operation = operation
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            DB_QUERIES.labels(self.operation).inc()
+            DB_QUERY_DURATION.labels(self.operation).inc(time.perf_counter() - start)
+
+
+class BacklogCollector:
+    '''
+    Gauges read at scrape time: work the spool drain and compaction have yet to do.
+    '''
+
+    def describe(self):
+        # keeps registration from running collect
+        return []
+
+    def collect(self):
+        from django.conf import settings
+        from core.models import TrainingRun
+        from core.spool import SEALED_SUFFIX, OPEN_SUFFIX, BLOB_SUFFIX
+
+        segments = GaugeMetricFamily('ppz_spool_segments', 'Spool segments not drained yet.', labels=['state'])
+        spool_bytes = GaugeMetricFamily('ppz_spool_bytes', 'Bytes of spool segments and uploads not drained yet.')
+        counts = {SEALED_SUFFIX: 0, OPEN_SUFFIX: 0}
+        size = 0
+        if os.path.isdir(settings.INGEST['spool_path']):
+            for entry in os.scandir(settings.INGEST['spool_path']):
+                suffix = os.path.splitext(entry.name)[1]
+                if suffix in counts:
+                    counts[suffix] += 1
+                elif suffix != BLOB_SUFFIX:
+                    continue
+
+                try:
+                    size += entry.stat().st_size
+                except FileNotFoundError:
+                    pass
+        segments.add_metric(['sealed'], counts[SEALED_SUFFIX])
+        segments.add_metric(['open'], counts[OPEN_SUFFIX])
+        spool_bytes.add_metric([], size)
+        yield segments
+        yield spool_bytes
+
+        games = TrainingRun.objects.aggregate(games=Sum(F('last_game') - F('compacted_game')))['games']
+        yield GaugeMetricFamily('ppz_compaction_backlog_games', 'Training games not compacted yet.', value=games or 0)
+
+
+backlog_collector = BacklogCollector()
+REGISTRY.register(backlog_collector)
+
+
+def render_metrics():
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return generate_latest(REGISTRY)
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(backlog_collector)
+    return generate_latest(registry)
+
+
+# Celery tasks are timed in the process that runs them
+_task_starts = {}
+
+
+@task_prerun.connect
+def _start_task(task_id, task, **kwargs):
+    timer = QueryTimer(task.name)
+    connection.execute_wrappers.append(timer)
+    _task_starts[task_id] = (time.perf_counter(), timer)
+
+
+@task_postrun.connect
+def _finish_task(task_id, task, state=None, **kwargs):
+    start, timer = _task_starts.pop(task_id, (None, None))
+    if timer in connection.execute_wrappers:
+        connection.execute_wrappers.remove(timer)
+    if start is not None:
+        TASK_DURATION.labels(task.name, state or 'UNKNOWN').observe(time.perf_counter() - start)
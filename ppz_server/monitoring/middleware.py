@@ -0,0 +1,28 @@
+import time
+from django.db import connection
+from .metrics import REQUEST_DURATION, QueryTimer
+
+
+class MetricsMiddleware:
+    '''
+    Times every request and counts its database queries, labelled by the resolved view.
+    Streaming responses are timed until their first byte.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        timer = QueryTimer('unresolved')
+        with connection.execute_wrapper(timer):
+            # the view is known only after resolving, process_view fills it in
+            request._metrics_timer = timer
+            response = self.get_response(request)
+
+        REQUEST_DURATION.labels(timer.operation, request.method, response.status_code).observe(
+            time.perf_counter() - start)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._metrics_timer.operation = request.resolver_match.view_name
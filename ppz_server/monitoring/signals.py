@@ -0,0 +1,26 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from core.models import TrainingRun, Network, Match, GameRollup
+from core.signals import bulk_saved
+from .cache import bump_versions, NETWORKS, MATCHES, TRAINING_RUNS, GAMES
+
+
+@receiver([post_save, post_delete, bulk_saved], sender=TrainingRun)
+def invalidate_training_runs(sender, **kwargs):
+    bump_versions(TRAINING_RUNS)
+
+
+@receiver([post_save, post_delete, bulk_saved], sender=Network)
+def invalidate_networks(sender, **kwargs):
+    # training runs show the number of their best network
+    bump_versions(NETWORKS, TRAINING_RUNS)
+
+
+@receiver([post_save, post_delete, bulk_saved], sender=Match)
+def invalidate_matches(sender, **kwargs):
+    bump_versions(MATCHES)
+
+
+@receiver(bulk_saved, sender=GameRollup)
+def invalidate_games(sender, **kwargs):
+    bump_versions(GAMES)
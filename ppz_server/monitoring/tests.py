@@ -1,3 +1,93 @@
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+from core.models import TrainingRun, Network, GameRollup
+from core.signals import bulk_saved
+from core.testing import BenchmarkMixin, benchmark_settings, seed, FIELD_SIZE
+from .cache import topic_versions, NETWORKS, GAMES
+from .charts import progress_chart, parse_cursor
 
-# Create your tests here.
+
+@override_settings(**benchmark_settings())
+class MonitoringApiBenchmark(BenchmarkMixin, TestCase):
+    '''
+    Query budgets and timings of monitoring.urls endpoints with a cold and a warm response cache,
+    see core.testing.
+    '''
+    suite = 'monitoring'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed()
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def measure_cached(self, name, budget, path, **params):
+        '''
+        Measures path with an empty cache, then from the cache and with a matching ETag.
+        '''
+        request = lambda: self.client.get(path, params)  # noqa: E731
+        response = self.measure(f'{name} cold', budget, request, before=cache.clear)
+        self.measure(f'{name} warm', 0, request)
+        self.measure(f'{name} not modified', 0, lambda: self.client.get(
+            path, params, HTTP_IF_NONE_MATCH=response['ETag']), status=304)
+        return response
+
+    def test_progress(self):
+        training_run_id = self.data.training_run_ids[0]
+        response = self.measure_cached('progress', 2, f'/progress/{training_run_id}')
+        self.assertEqual(len(response.json()['chart']), 100)
+        self.assertGreater(response.json()['last_day_games_count'], 0)
+
+        response = self.measure_cached('progress page', 2, f'/progress/{training_run_id}', after=10, limit=20, points=20)
+        self.assertEqual(response.json()['chart'][0]['network_number'], 11)
+
+    def test_networks(self):
+        self.measure_cached('networks', 1, '/networks')
+
+    def test_matches(self):
+        self.measure_cached('matches', 1, '/matches')
+
+    def test_training_runs(self):
+        response = self.measure_cached('training_runs', 1, '/training_runs')
+        self.assertEqual(len(response.json()), len(self.data.training_run_ids))
+
+    def test_metrics(self):
+        self.measure('metrics', 1, lambda: self.client.get('/metrics'))
+
+
+class ProgressChartTest(TestCase):
+    def test_pages_cover_networks_with_one_number(self):
+        training_run = TrainingRun.objects.create(field_width=FIELD_SIZE, field_height=FIELD_SIZE,
+                                                  training_parameters={}, match_parameters={})
+        # a network number repeats when a run is restarted from an older network
+        numbers = [1, 2, 2, 2, 3]
+        Network.objects.bulk_create([
+            Network(training_run=training_run, network_number=number, sha=str(i) * 64, elo=float(i),
+                    games_played=1, field_width=FIELD_SIZE, field_height=FIELD_SIZE)
+            for i, number in enumerate(numbers)
+        ])
+
+        elos = []
+        after = None
+        while True:
+            chart, after = progress_chart(training_run.id, after and parse_cursor(after), limit=2)
+            elos.extend(point['elo'] for point in chart)
+            if after is None:
+                break
+        self.assertEqual(elos, [0.0, 1.0, 2.0, 3.0, 4.0])
+
+        chart, _ = progress_chart(training_run.id, parse_cursor('2'))
+        self.assertEqual([point['network_number'] for point in chart], [3])
+
+
+class CacheInvalidationTest(TestCase):
+    def test_bulk_writes_of_core_bump_versions(self):
+        before = topic_versions([NETWORKS, GAMES])
+        bulk_saved.send(sender=Network)
+        bulk_saved.send(sender=GameRollup)
+        after = topic_versions([NETWORKS, GAMES])
+        self.assertNotEqual(before[0], after[0])
+        self.assertNotEqual(before[1], after[1])
@@ -1,9 +1,11 @@
 from django.urls import path
-from .views import (Progress, MatchesView, NetworksView,)
+from .views import (Progress, MatchesView, NetworksView, TrainingRunsView, MetricsView,)
 
 
 urlpatterns = [
     path('progress/<int:training_run_id>', Progress.as_view()),
     path('matches', MatchesView.as_view()),
     path('networks', NetworksView.as_view()),
+    path('training_runs', TrainingRunsView.as_view()),
+    path('metrics', MetricsView.as_view()),
 ]
@@ -1,80 +1,94 @@
 from rest_framework.views import APIView
-from rest_framework.response import Response
-from core.models import Network, Match, TrainingRun, TrainingGame
-from django.db.models import F
-from datetime import datetime, timedelta
-
-
-class Progress(APIView):
-    def get(self, request, training_run_id):
-        chart = self.chart(training_run_id)
-        last_day_games_count = TrainingGame.objects.filter(
-            created_at__gte=datetime.today()-timedelta(days=1)).count()
-        last_hour_games_count = TrainingGame.objects.filter(
-            created_at__gte=datetime.today() - timedelta(hours=1)).count()
+from rest_framework.exceptions import ValidationError
+from django.conf import settings
+from django.http import HttpResponse
+from prometheus_client import CONTENT_TYPE_LATEST
+from core.models import Network, Match, TrainingRun, GameRollup
+from django.db.models import F, Q, Sum
+from django.utils import timezone
+from datetime import timedelta
+from .cache import CachedResponseMixin, NETWORKS, MATCHES, TRAINING_RUNS, GAMES
+from .charts import progress_chart, parse_cursor
+from .metrics import render_metrics
+
+
+class Progress(CachedResponseMixin, APIView):
+    '''
+    Query parameters select the chart page: after (chart_next of the previous page, or a network number),
+    limit (rated networks in the page, whole chart by default), points and downsample ('lttb' or 'step').
+    '''
+    cache_topics = (NETWORKS, GAMES)
+
+    def get_data(self, request, training_run_id):
+        after = request.query_params.get('after', None)
+        try:
+            after = parse_cursor(after) if after is not None else None
+        except ValueError:
+            raise ValidationError({'error': 'After must be chart_next of the previous page or a network number.'})
+
+        try:
+            limit = int(request.query_params.get('limit', settings.PROGRESS_CHART['max_limit']))
+            points = int(request.query_params.get('points', settings.PROGRESS_CHART['points']))
+        except ValueError:
+            raise ValidationError({'error': 'Limit and points need to be integers.'})
+
+        if not 0 < limit <= settings.PROGRESS_CHART['max_limit']:
+            raise ValidationError({'error': f"Limit must be from 1 to {settings.PROGRESS_CHART['max_limit']}."})
+        if not 2 <= points <= settings.PROGRESS_CHART['max_points']:
+            raise ValidationError({'error': f"Points must be from 2 to {settings.PROGRESS_CHART['max_points']}."})
+
+        downsample = request.query_params.get('downsample', settings.PROGRESS_CHART['downsample'])
+        if downsample not in ('lttb', 'step'):
+            raise ValidationError({'error': 'Downsample must be lttb or step.'})
+
+        chart, chart_next = progress_chart(training_run_id, after, limit, points, downsample)
+
+        # per minute rollups lag behind uploads by up to a couple of minutes
+        now = timezone.now()
+        counts = GameRollup.objects.filter(training_run_id=training_run_id,
+                                           minute__gte=now - timedelta(days=1)).aggregate(
+            last_day=Sum('games'), last_hour=Sum('games', filter=Q(minute__gte=now - timedelta(hours=1))))
 
         response = {
-            'last_day_games_count': last_day_games_count,
-            'last_hour_games_count': last_hour_games_count,
-            'chart': chart
+            'last_day_games_count': counts['last_day'] or 0,
+            'last_hour_games_count': counts['last_hour'] or 0,
+            'chart': chart,
+            'chart_next': chart_next,
         }
 
-        return Response(response)
-
-    def chart(self, training_run_id):
-        networks = Network.objects.filter(training_run_id=training_run_id).values(
-            'network_number', 'elo', 'games_played').order_by('id').all()
+        return response
 
-        remove_idx = []
-        aggregated_count = 0
-        for idx, network in enumerate(networks):
-            if network['elo'] is None:
-                remove_idx.append(idx)
-                continue
 
-            if network['games_played'] == 0:
-                aggregated_count += 1
-            else:
-                aggregated_count += network['games_played']
+class NetworksView(CachedResponseMixin, APIView):
+    cache_topics = (NETWORKS,)
 
-            network['games_played'] = aggregated_count
+    def get_data(self, request):
+        return Network.objects.values('network_number', 'sha', 'training_run_id', 'blocks',
+                                      'filters', 'created_at', 'elo', 'elo_error', 'games_played'
+                                      ).order_by('-id')[:100]
 
-        # remove rating networks with undefined rating
-        networks = list(networks)
-        remove_idx.reverse()
-        for idx in remove_idx:
-            networks.pop(idx)
 
-        # limit response
-        networks = networks[:100]
+class MatchesView(CachedResponseMixin, APIView):
+    cache_topics = (MATCHES,)
 
-        return networks
+    def get_data(self, request):
+        return Match.objects.values('id', 'training_run_id', 'passed',
+                                    'done', 'created_at').order_by('-id')[:100]
 
 
+class TrainingRunsView(CachedResponseMixin, APIView):
+    cache_topics = (TRAINING_RUNS,)
 
-class NetworksView(APIView):
-    def get(self, request):
-        networks = Network.objects.values('network_number', 'sha', 'training_run_id', 'blocks',
-                                          'filters', 'create_at', 'elo', 'games_played'
-                                          ).order_by('-id')[:100]
-
-        return Response(networks)
+    def get_data(self, request):
+        return TrainingRun.objects.annotate(
+            best_network_number=F('best_network__network_number')).values(
+            'id', 'best_network_number', 'active',
+            'description', 'training_parameters').order_by('id')
 
 
-class MatchesView(APIView):
+class MetricsView(APIView):
+    '''
+    Prometheus text exposition of monitoring.metrics.
+    '''
     def get(self, request):
-        matches = Match.objects.values('id', 'training_run_id', 'passed',
-                                        'done', 'create_at').order_by('-id')[:100]
-
-        return Response(matches)
-
-
-class TrainingRunsView(APIView):
-    def get(self, request):
-        training_runs = TrainingRun.objects.annotate(
-            best_network__network_number=F('best_network_number')).values(
-            'best_network__network_number', 'active',
-            'description', 'training_params').all()
-
-        return Response(training_runs)
-
+        return HttpResponse(render_metrics(), content_type=CONTENT_TYPE_LATEST)
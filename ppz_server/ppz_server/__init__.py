@@ -0,0 +1,4 @@
+# web processes send tasks too, they need the app configured from settings
+from .celery import app as celery_app
+
+__all__ = ('celery_app',)
@@ -40,6 +40,7 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     # есть 2 способа записи приложения: путь к папке с приложением
     'core.apps.CoreConfig',      # и путь к конфигурации (предпочтительнее)
+    'monitoring.apps.MonitoringConfig',
     'rest_framework'
 ]
 
@@ -52,6 +53,8 @@ REST_FRAMEWORK = {
 
 
 MIDDLEWARE = [
+    # first, so it times the other middleware too
+    'monitoring.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -98,6 +101,19 @@ DATABASES = {
 }
 
 
+# monitoring responses and their versions are shared by web and Celery processes
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://localhost:6379/1',
+    }
+}
+MONITORING_CACHE = {
+    # seconds a response is kept, bounds staleness of game counters which don't bump versions
+    'timeout': 60,
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -138,9 +154,32 @@ USE_TZ = True
 STATIC_URL = '/static/'
 
 
+SCHEDULER = {
+    # seconds before other processes' changes to runs and matches are picked up
+    'cache_ttl': 30,
+}
+
+
 MATCHES = {
     'update_threshold': 0.55,
-    'games_to_finish': 20
+    'games_to_finish': 20,
+    # seconds a client has to finish a match game before it is handed to another one
+    'lease_time': 600,
+    # processes reading match sgfs in update_elo; every Celery worker process starts its own pool
+    'collection_workers': 1,
+    # done matches before the unprocessed ones that update_elo refits ratings over, None for the whole history
+    'elo_history': 1000,
+    # defaults for runs with 'sprt' in match_parameters: the match stops as soon as
+    # the candidate is shown elo1 stronger (passed) or not more than elo0 stronger (failed),
+    # after at least min_games games; undecided after max_games games it fails
+    'sprt': {
+        'elo0': 0,
+        'elo1': 35,
+        'alpha': 0.05,
+        'beta': 0.05,
+        'min_games': 20,
+        'max_games': 400,
+    },
 }
 
 
@@ -149,8 +188,87 @@ MATCH_COLLECTION_SGF_PATH = os.path.join(BASE_DIR, 'sgf', 'match_collection')
 TRAINING_SGF_PATH = os.path.join(BASE_DIR, 'sgf', 'training')
 TRAINING_EXAMPLES_PATH = os.path.join(BASE_DIR, 'examples')
 NETWORKS_PATH = os.path.join(BASE_DIR, 'networks')
+# xor deltas between networks, served to clients that have the previous network
+NETWORK_DELTAS_PATH = os.path.join(BASE_DIR, 'networks', 'deltas')
+
+NETWORK_DOWNLOADS = {
+    # None to serve networks from the web workers, 'x-accel-redirect' (nginx) or 'x-sendfile'
+    'sendfile': None,
+    # nginx internal location that aliases accel_root, deltas are under it too
+    'accel_prefix': '/protected/networks/',
+    'accel_root': NETWORKS_PATH,
+}
+
+NETWORK_CACHE = {
+    'memory_bytes': 512 * 1024 * 1024,
+    'disk_bytes': 4 * 1024 * 1024 * 1024,
+    # decompressed networks evicted from memory
+    'spill_path': os.path.join(BASE_DIR, 'cache', 'networks'),
+}
 
 TRAINING_CHUNK_SIZE = 100
+COMPACTION = {
+    # seconds between the upload that closes a chunk and its compaction
+    'delay': 30,
+    # games after the end of a chunk before its missing numbers are treated as gaps
+    'lag': TRAINING_CHUNK_SIZE,
+    # processes packing chunks at once; every Celery worker process starts its own pool,
+    # so more than 1 only pays off with a low worker concurrency
+    'workers': 1,
+    # 'tar' or 'shard' (core.shards, indexed and memory-mappable); run_training hands the format
+    # to the trainer, which reads shards only once it supports them. Shards stay on the server.
+    'format': 'tar',
+    # keep examples gzipped inside shards, False trades disk for reads without decompression
+    'shard_compressed': True,
+}
+INGEST = {
+    # game numbers reserved per process at once, so uploads don't all update the run row;
+    # the rest of a block is a gap after a restart or game_number_block_age seconds.
+    # COMPACTION['lag'] must stay above the block times the web and drain processes
+    'game_number_block': 10,
+    'game_number_block_age': 10,
+    # seconds Network.games_played increments are summed per process before they are written
+    'games_played_flush': 10,
+    'batch_max_games': 1000,
+    # accept training and match games into a local spool, core.tasks.task_drain_spool commits them
+    'spool': False,
+    'spool_path': os.path.join(BASE_DIR, 'spool'),
+    'spool_segment_bytes': 64 * 1024 * 1024,
+    'spool_segment_age': 10,
+    'spool_batch': 500,
+    'spool_fsync': True,
+}
+GAME_ROLLUPS = {
+    # seconds a game waits before it is counted, longer than any upload transaction
+    'lag': 10,
+    'batch': 100000,
+    # minutes recounted by every run, so games committed late are counted; a game whose upload
+    # commits more than this after it was created is missed
+    'recount_minutes': 5,
+    # per minute counters older than this are deleted
+    'retention_days': 30,
+}
+PROGRESS_CHART = {
+    # points of a chart page, downsampled with 'lttb' or 'step'
+    'points': 100,
+    'max_points': 1000,
+    'downsample': 'lttb',
+    # rated networks in a page, also the default page
+    'max_limit': 100000,
+}
+SAMPLER = {
+    # games sampled from, overridden by training_parameters['window']
+    'window': 250000,
+    # positions held for shuffling, memory is about this times the position size
+    'shuffle_buffer': 8192,
+    'batch_size': 512,
+    'max_batch_size': 8192,
+    # batches streamed by one sample_examples request
+    'max_batches': 1000,
+    'open_shards': 16,
+    # dotted path of a function: decompressed game example -> list of positions
+    'decoder': 'core.sampler.whole_example',
+}
 TRAINING_PATH = '/home/pymole/PycharmProjects/ppz-training/'
 
 
@@ -180,9 +298,20 @@ CELERY_BEAT_SCHEDULE = {
     #     'schedule': crontab(minute=0, hour='*/3'),
     # },
 
+    'drain-spool': {
+        'task': 'core.tasks.task_drain_spool',
+        'schedule': 10.0,
+    },
+
+    'rollup-games': {
+        'task': 'core.tasks.task_rollup_games',
+        'schedule': 60.0,
+    },
+
+    # chunks are compacted when they fill up, this only catches missed ones
     'compact-examples': {
         'task': 'core.tasks.task_compact_examples',
-        'schedule': crontab(minute='*/1'),
+        'schedule': crontab(minute='*/10'),
     },
 }
 